@@ -9,24 +9,14 @@ from pynetdicom.sop_class import (
 from pydicom.dataset import Dataset
 from datetime import datetime
 import os
+from rate_limiter import build_limiter
+from discovery import build_patient_query, patient_row, insert_patients
 
 self_dir = os.path.dirname(os.path.realpath(__file__))
-config_path = os.path.join(self_dir, "config.json")
+# DICOM_DOWNLOADER_CONFIG points the script at another config, e.g. for the benchmarks
+config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
 # debug_logger()
 
-# Super complex script for detecting patients that are in THLHP cohort
-def detect_thlhp_patient(patient):
-    if len(patient_id) > 5 and patient_id[4] == '-' and int(patient_id[:4]) < 5000:
-        return True
-    if patient_id == '999999-002':
-        print("Adding 999999-002 for phantom scans")
-        return True
-    if patient_id == '266-QHK-VW3N':
-        print("Adding 266-QHK-VW3N")
-        return True
-    # print(patient_id + " not added")
-    return False
-
 # Load credentials
 with open(config_path, 'r') as f:
     credentials = json.load(f)
@@ -57,17 +47,18 @@ PACS_AET = pacs_credentials['aet']
 LOCAL_AET = pacs_credentials['local_aet']
 
 # Define the query dataset
-ds = Dataset()
-ds.QueryRetrieveLevel = 'PATIENT'
-ds.PatientID = ''
-ds.PatientName = ''
-ds.PatientSex = ''
+ds = build_patient_query()
+
+# Draw from the PACS request budget, shared with the other scripts if configured
+limiter = build_limiter(credentials, 'discovery')
 
 # Perform the association with the PACS
+limiter.acquire()
 assoc = ae.associate(PACS_IP, PACS_PORT, ae_title=PACS_AET)
 
 if assoc.is_established:
     # Send the C-FIND request
+    limiter.acquire()
     responses = assoc.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind)
     
     batch_data = []
@@ -75,43 +66,26 @@ if assoc.is_established:
 
     for (status, identifier) in responses:
         if status.Status in (0xFF00, 0xFF01):
-            patient_id = identifier.PatientID if 'PatientID' in identifier else None
-            patient_name = str(identifier.PatientName) if 'PatientName' in identifier else None
-            patient_sex = identifier.PatientSex if 'PatientSex' in identifier else None
-
-            if patient_id and detect_thlhp_patient(patient_id):
-                batch_data.append((patient_id, patient_name, patient_sex))
+            row = patient_row(identifier)
+            if row:
+                batch_data.append(row)
 
                 if len(batch_data) >= batch_size:
-                    extras.execute_values(cur, sql.SQL("""
-                        INSERT INTO fieldsite.patients (patient_id, patient_name, patient_sex)
-                        VALUES %s
-                        ON CONFLICT (patient_id) DO UPDATE
-                        SET patient_name = EXCLUDED.patient_name,
-                            patient_sex = EXCLUDED.patient_sex,
-                            date_modified = CURRENT_TIMESTAMP;
-                    """), batch_data)
-                    conn.commit()
+                    insert_patients(conn, cur, batch_data)
                     batch_data = []
 
     # Insert any remaining data in the batch
     if batch_data:
-        extras.execute_values(cur, sql.SQL("""
-            INSERT INTO fieldsite.patients (patient_id, patient_name, patient_sex)
-            VALUES %s
-            ON CONFLICT (patient_id) DO UPDATE
-            SET patient_name = EXCLUDED.patient_name,
-                patient_sex = EXCLUDED.patient_sex,
-                date_modified = CURRENT_TIMESTAMP;
-        """), batch_data)
-        conn.commit()
+        insert_patients(conn, cur, batch_data)
 
     # Release the association
     assoc.release()
 else:
+    limiter.penalize()
     print("Association rejected, aborted or never connected")
 
 # Close the database connection
+limiter.close()
 cur.close()
 conn.close()
 
@@ -1,7 +1,6 @@
 import json
 import psycopg2
 from psycopg2 import sql
-from psycopg2.extras import execute_values
 from tqdm import tqdm
 from pynetdicom import AE
 import os
@@ -10,10 +9,18 @@ from pynetdicom.sop_class import (
     StudyRootQueryRetrieveInformationModelFind
 )
 from pydicom.dataset import Dataset
-import pandas as pd
+from datetime import datetime
+import csv
+from pacs_association import FindExecutor
+from rate_limiter import build_limiter
+from watermarks import discovery_settings
+from queries import PATIENTS_TO_QUERY
+from discovery import STUDY_COLUMNS, build_study_query, study_row, status_text
+from db_writer import StagingWriter
 
 self_dir = os.path.dirname(os.path.realpath(__file__))
-config_path = os.path.join(self_dir, "config.json")
+# DICOM_DOWNLOADER_CONFIG points the script at another config, e.g. for the benchmarks
+config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
 
 # Load credentials
 with open(config_path, 'r') as f:
@@ -21,6 +28,7 @@ with open(config_path, 'r') as f:
 
 pacs_credentials = credentials['pacs']
 db_credentials = credentials['database']
+discovery = discovery_settings(credentials, "Query the PACS for the studies of every patient in the database")
 
 # PostgreSQL connection
 conn = psycopg2.connect(
@@ -32,11 +40,16 @@ conn = psycopg2.connect(
 )
 cur = conn.cursor()
 
-# Query all patients from the patients table
-cur.execute("SELECT patient_id FROM fieldsite.patients")
+if discovery['incremental']:
+    # Only query patients that are new, had a recent study or are due for a periodic refresh
+    cur.execute(PATIENTS_TO_QUERY, discovery)
+else:
+    # Query all patients from the patients table
+    cur.execute("SELECT patient_id, NULL FROM fieldsite.patients")
 patients = cur.fetchall()
 
 patient_ids = [patient[0] for patient in patients]
+print(f"Querying studies for {len(patient_ids)} patients")
 
 # Initialize the Application Entity (AE)
 ae = AE()
@@ -50,75 +63,72 @@ PACS_PORT = pacs_credentials['port']
 PACS_AET = pacs_credentials['aet']
 LOCAL_AET = pacs_credentials['local_aet']
 
-# List to hold study data for batch insertion
-studies_data = []
-
-for patient_id in tqdm(patient_ids, desc="Querying studies for patients"):
-    # Define the query dataset
-    ds = Dataset()
-    ds.QueryRetrieveLevel = 'STUDY'
-    ds.PatientID = patient_id
-    ds.StudyInstanceUID = ''
-    ds.StudyDate = ''
-    ds.StudyTime = ''
-    ds.StudyID = ''
-    ds.AccessionNumber = ''
-
-    # Perform the association with the PACS
-    assoc = ae.associate(PACS_IP, PACS_PORT, ae_title=PACS_AET)
-
-    if assoc.is_established:
-        # Send the C-FIND request
-        responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
-        
+# Keep the request rate just under the PACS ceiling, shared with the other scripts if configured
+limiter = build_limiter(credentials, 'discovery')
+
+# Concurrent workers, each reusing its own association for all C-FIND requests
+executor = FindExecutor(ae, PACS_IP, PACS_PORT, PACS_AET,
+                        workers=pacs_credentials.get('find_workers', 4), limiter=limiter)
+
+# Stream studies into the database in batches so progress survives a crash
+studies_writer = StagingWriter(
+    conn, 'fieldsite.studies',
+    STUDY_COLUMNS,
+    ['studyinstanceuid'],
+    update_columns=['patient_id', 'study_datetime', 'accession_number']
+)
+
+# Record when each patient was queried, only after its studies have been stored
+watermark_writer = StagingWriter(
+    conn, 'fieldsite.discovery_watermarks',
+    ['level', 'key', 'last_checked'],
+    ['level', 'key'],
+    touch_modified=False,
+    depends_on=[studies_writer]
+)
+
+# Also keep a CSV copy of the studies for diagnose_studies_data.py
+csv_file_path = credentials['path'].get('studies_csv', os.path.join(self_dir, 'studies_data.csv'))
+csv_file = open(csv_file_path, 'w', newline='')
+csv_writer = csv.writer(csv_file)
+csv_writer.writerow(['StudyID', 'PatientID', 'StudyDatetime', 'StudyInstanceUID', 'AccessionNumber'])
+
+# Patients due for a full refresh have no watermark so they match every StudyDate.
+# The watermark is taken as each query is submitted, before the PACS answers, so studies
+# stored while the C-FIND runs are still matched by the next date range.
+queries = (((patient_id, datetime.now()), build_study_query(patient_id, discovery, last_checked))
+           for patient_id, last_checked in patients)
+results = executor.map(queries, StudyRootQueryRetrieveInformationModelFind)
+
+for (patient_id, checked), responses in tqdm(results, total=len(patient_ids), desc="Querying studies for patients"):
+    if responses is not None:
+        final_status = None
         for (status, identifier) in responses:
             if status.Status in (0xFF00, 0xFF01):
-                study_id = identifier.StudyID if 'StudyID' in identifier else None
-                study_instance_uid = identifier.StudyInstanceUID if 'StudyInstanceUID' in identifier else None
-                accession_number = identifier.AccessionNumber if 'AccessionNumber' in identifier else None
-                study_date = identifier.StudyDate if 'StudyDate' in identifier else None
-                study_time = identifier.StudyTime if 'StudyTime' in identifier else None
-
-                if study_date and study_time:
-                    study_datetime = f"{study_date} {study_time}"
-                elif study_date:
-                    study_datetime = study_date
-                elif study_time:
-                    study_datetime = study_time
-                else:
-                    study_datetime = None
-
-                if study_id and patient_id and study_instance_uid:
-                    studies_data.append(
-                        (study_id, patient_id, study_datetime, study_instance_uid, accession_number)
-                    )
-
-        # Release the association
-        assoc.release()
+                row = study_row(patient_id, identifier)
+                if row:
+                    studies_writer.add(row)
+                    csv_writer.writerow(row)
+            else:
+                final_status = status.Status
+
+        # A failed query may have missed studies, leave the patient due for the next run
+        if final_status == 0x0000:
+            watermark_writer.add(('patient', patient_id, checked))
+        else:
+            print(f"C-FIND for PatientID {patient_id} ended with {status_text(final_status)}")
     else:
         print(f"Association rejected, aborted or never connected for PatientID: {patient_id}")
 
-# Convert studies data to a DataFrame
-studies_df = pd.DataFrame(studies_data, columns=['StudyID', 'PatientID', 'StudyDatetime', 'StudyInstanceUID', 'AccessionNumber'])
-
-# Save DataFrame to CSV
-csv_file_path = os.path.join(self_dir, 'studies_data.csv')
-studies_df.to_csv(csv_file_path, index=False)
-
-# Insert studies data in batch
-if studies_data:
-    insert_query = """
-        INSERT INTO fieldsite.studies (studyid, patient_id, study_datetime, studyinstanceuid, accession_number)
-        VALUES %s
-        ON CONFLICT (studyinstanceuid) DO UPDATE
-        SET patient_id = EXCLUDED.patient_id,
-            study_datetime = EXCLUDED.study_datetime,
-            studyinstanceuid = EXCLUDED.studyinstanceuid,
-            accession_number = EXCLUDED.accession_number,
-            date_modified = CURRENT_TIMESTAMP;
-    """
-    execute_values(cur, insert_query, studies_data)
-    conn.commit()
+# Release the associations
+executor.shutdown()
+limiter.close()
+print(executor.summary())
+
+# Store the remaining studies and then their watermarks
+watermark_writer.flush()
+csv_file.close()
+print(f"{studies_writer.written} studies written")
 
 # Close the database connection
 cur.close()
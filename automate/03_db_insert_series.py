@@ -5,10 +5,18 @@ from tqdm import tqdm
 from pynetdicom import AE
 from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
 from pydicom.dataset import Dataset
+from datetime import datetime
 import os
+from pacs_association import FindExecutor
+from rate_limiter import build_limiter
+from watermarks import discovery_settings
+from queries import STUDIES_TO_QUERY
+from discovery import SERIES_COLUMNS, build_series_query, series_row, status_text
+from db_writer import StagingWriter
 
 self_dir = os.path.dirname(os.path.realpath(__file__))
-config_path = os.path.join(self_dir, "config.json")
+# DICOM_DOWNLOADER_CONFIG points the script at another config, e.g. for the benchmarks
+config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
 
 # Load credentials
 with open(config_path, 'r') as f:
@@ -16,6 +24,7 @@ with open(config_path, 'r') as f:
 
 pacs_credentials = credentials['pacs']
 db_credentials = credentials['database']
+discovery = discovery_settings(credentials, "Query the PACS for the series of every study in the database")
 
 # PostgreSQL connection
 conn = psycopg2.connect(
@@ -27,11 +36,17 @@ conn = psycopg2.connect(
 )
 cur = conn.cursor()
 
-# Query all studies from the studies table
-cur.execute("SELECT studyid, studyinstanceuid FROM fieldsite.studies")
+if discovery['incremental']:
+    # Only query studies that are new, recent or due for a periodic refresh
+    cur.execute(STUDIES_TO_QUERY, discovery)
+else:
+    # Query all studies from the studies table
+    cur.execute("SELECT studyid, studyinstanceuid, NULL FROM fieldsite.studies")
 studies = cur.fetchall()
 
-study_map = {study[1]: study[0] for study in studies}  # Map studyinstanceuid to studyid
+# Map studyinstanceuid to studyid and the last time the study was checked
+study_map = {study[1]: (study[0], study[2]) for study in studies}
+print(f"Querying series for {len(study_map)} studies")
 
 # Initialize the Application Entity (AE)
 ae = AE()
@@ -45,133 +60,62 @@ PACS_PORT = pacs_credentials['port']
 PACS_AET = pacs_credentials['aet']
 LOCAL_AET = pacs_credentials['local_aet']
 
-# List to hold series data for batch insertion
-series_data = []
-
-for studyinstanceuid, studyid in tqdm(study_map.items(), desc="Querying series for studies"):
-    # Define the query dataset
-    ds = Dataset()
-    ds.QueryRetrieveLevel = 'SERIES'
-    ds.StudyInstanceUID = studyinstanceuid
-    ds.SeriesInstanceUID = ''
-    ds.SeriesDate = ''
-    ds.SeriesTime = ''
-    ds.SeriesNumber = ''
-    ds.Modality = ''
-    ds.InstitutionName = ''
-    ds.InstitutionalDepartmentName = ''
-    ds.SeriesDescription = ''
-    ds.BodyPartExamined = ''
-    ds.NumberOfSeriesRelatedInstances = ''
-    ds.add_new((0x0040, 0x0310), 'ST', '')
-    ds.add_new((0x0018, 0x1210), 'SH', '')
-    ds.add_new((0x0018, 0x1030), 'LO', '')
-    ds.add_new((0x0018, 0x0050), 'DS', '')
-    ds.add_new((0x0054, 0x0081), 'US', '')
-    ds.add_new((0x0018, 0x0088), 'DS', '')
-    ds.add_new((0x0018, 0x0060), 'DS', '')
-    ds.add_new((0x0018, 0x7005), 'CS', '')
-    ds.add_new((0x1092, 0x7005), 'CS', '')
-    ds.add_new((0x100B, 0x7005), 'CS', '')
-    ds.add_new((0x0010, 0x4000), 'LT', '')
-    ds.add_new((0x0018, 0x0022), 'CS', '')
-    ds.add_new((0x1011, 0x7005), 'UN', '')
-
-    # Perform the association with the PACS
-    assoc = ae.associate(PACS_IP, PACS_PORT, ae_title=PACS_AET)
-
-    if assoc.is_established:
-        # Send the C-FIND request
-        responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
-        
+# Keep the request rate just under the PACS ceiling, shared with the other scripts if configured
+limiter = build_limiter(credentials, 'discovery')
+
+# Concurrent workers, each reusing its own association for all C-FIND requests
+executor = FindExecutor(ae, PACS_IP, PACS_PORT, PACS_AET,
+                        workers=pacs_credentials.get('find_workers', 4), limiter=limiter)
+
+# Stream series into the database in batches so progress survives a crash
+series_writer = StagingWriter(
+    conn, 'fieldsite.series',
+    SERIES_COLUMNS,
+    ['seriesinstanceuid']
+)
+
+# Record when each study was queried, only after its series have been stored
+watermark_writer = StagingWriter(
+    conn, 'fieldsite.discovery_watermarks',
+    ['level', 'key', 'last_checked'],
+    ['level', 'key'],
+    touch_modified=False,
+    depends_on=[series_writer]
+)
+
+# Studies due for a full refresh have no watermark so they match every SeriesDate.
+# The watermark is taken as each query is submitted, before the PACS answers.
+queries = (((studyinstanceuid, studyid, datetime.now()), build_series_query(studyinstanceuid, discovery, last_checked))
+           for studyinstanceuid, (studyid, last_checked) in study_map.items())
+results = executor.map(queries, StudyRootQueryRetrieveInformationModelFind)
+
+for (studyinstanceuid, studyid, checked), responses in tqdm(results, total=len(study_map), desc="Querying series for studies"):
+    if responses is not None:
+        final_status = None
         for (status, identifier) in responses:
             if status.Status in (0xFF00, 0xFF01):
-                series_instance_uid = identifier.SeriesInstanceUID if 'SeriesInstanceUID' in identifier else None
-                series_number = identifier.SeriesNumber if 'SeriesNumber' in identifier else None
-                modality = identifier.Modality if 'Modality' in identifier else None
-                institution_name = identifier.InstitutionName if 'InstitutionName' in identifier else None
-                institutional_department_name = identifier.InstitutionalDepartmentName if 'InstitutionalDepartmentName' in identifier else None
-                series_description = identifier.SeriesDescription if 'SeriesDescription' in identifier else None
-                body_part_examined = identifier.BodyPartExamined if 'BodyPartExamined' in identifier else None
-                number_of_images = identifier.NumberOfSeriesRelatedInstances if 'NumberOfSeriesRelatedInstances' in identifier else None
-                series_date = identifier.SeriesDate if 'SeriesDate' in identifier else None
-                series_time = identifier.SeriesTime if 'SeriesTime' in identifier else None
-                comments_on_radiation_dose = identifier[(0x0040, 0x0310)].value if (0x0040, 0x0310) in identifier else None
-                convolution_kernel = identifier[(0x0018, 0x1210)].value if (0x0018, 0x1210) in identifier else None
-                protocol_name = identifier[(0x0018, 0x1030)].value if (0x0018, 0x1030) in identifier else None
-                slice_thickness = identifier[(0x0018, 0x0050)].value if (0x0018, 0x0050) in identifier else None
-                number_of_slices = identifier[(0x0054, 0x0081)].value if (0x0054, 0x0081) in identifier else None
-                spacing_between_slices = identifier[(0x0018, 0x0088)].value if (0x0018, 0x0088) in identifier else None
-                kvp = identifier[(0x0018, 0x0060)].value if (0x0018, 0x0060) in identifier else None
-                detector_configuration = identifier[(0x0018, 0x7005)].value if (0x0018, 0x7005) in identifier else None
-                aice = identifier[(0x1092, 0x7005)].value if (0x1092, 0x7005) in identifier else None
-                aidr_3d_estd = identifier[(0x100B, 0x7005)].value if (0x100B, 0x7005) in identifier else None
-                patient_comments = identifier[(0x0010, 0x4000)].value if (0x0010, 0x4000) in identifier else None
-                scan_options = identifier[(0x0018, 0x0022)].value if (0x0018, 0x0022) in identifier else None
-                vol = identifier[(0x1011, 0x7005)].value if (0x1011, 0x7005) in identifier else None
-
-                if series_date and series_time:
-                    series_datetime = f"{series_date} {series_time}"
-                elif series_date:
-                    series_datetime = series_date
-                elif series_time:
-                    series_datetime = series_time
-                else:
-                    series_datetime = None
-
-                if series_instance_uid:
-                    series_data.append(
-                        (studyid, series_instance_uid, series_datetime, series_number, modality,
-                         institution_name, institutional_department_name, series_description,
-                         body_part_examined, number_of_images, comments_on_radiation_dose,
-                         convolution_kernel, protocol_name, slice_thickness, number_of_slices,
-                         spacing_between_slices, kvp, detector_configuration, aice, aidr_3d_estd,
-                         patient_comments, scan_options, vol, studyinstanceuid)
-                    )
-
-        # Release the association
-        assoc.release()
+                row = series_row(studyid, studyinstanceuid, identifier)
+                if row:
+                    series_writer.add(row)
+            else:
+                final_status = status.Status
+
+        # A failed query may have missed series, leave the study due for the next run
+        if final_status == 0x0000:
+            watermark_writer.add(('study', studyinstanceuid, checked))
+        else:
+            print(f"C-FIND for StudyInstanceUID {studyinstanceuid} ended with {status_text(final_status)}")
     else:
         print(f"Association rejected, aborted or never connected for StudyInstanceUID: {studyinstanceuid}")
 
-# Insert series data in batch
-if series_data:
-    insert_query = """
-        INSERT INTO fieldsite.series (studyid, seriesinstanceuid, series_datetime, seriesnumber, modality,
-                                      institutionname, institutionaldepartmentname, seriesdescription,
-                                      bodypartexamined, numberofimages, comments_on_radiation_dose, 
-                                      convolution_kernel, protocol_name, slice_thickness, number_of_slices, 
-                                      spacing_between_slices, kvp, detector_configuration, aice, 
-                                      aidr_3d_estd, patient_comments, scan_options, vol, studyinstanceuid)
-        VALUES %s
-        ON CONFLICT (seriesinstanceuid) DO UPDATE
-        SET studyid = EXCLUDED.studyid,
-            series_datetime = EXCLUDED.series_datetime,
-            seriesnumber = EXCLUDED.seriesnumber,
-            modality = EXCLUDED.modality,
-            institutionname = EXCLUDED.institutionname,
-            institutionaldepartmentname = EXCLUDED.institutionaldepartmentname,
-            seriesdescription = EXCLUDED.seriesdescription,
-            bodypartexamined = EXCLUDED.bodypartexamined,
-            numberofimages = EXCLUDED.numberofimages,
-            comments_on_radiation_dose = EXCLUDED.comments_on_radiation_dose,
-            convolution_kernel = EXCLUDED.convolution_kernel,
-            protocol_name = EXCLUDED.protocol_name,
-            slice_thickness = EXCLUDED.slice_thickness,
-            number_of_slices = EXCLUDED.number_of_slices,
-            spacing_between_slices = EXCLUDED.spacing_between_slices,
-            kvp = EXCLUDED.kvp,
-            detector_configuration = EXCLUDED.detector_configuration,
-            aice = EXCLUDED.aice,
-            aidr_3d_estd = EXCLUDED.aidr_3d_estd,
-            patient_comments = EXCLUDED.patient_comments,
-            scan_options = EXCLUDED.scan_options,
-            vol = EXCLUDED.vol,
-            studyinstanceuid = EXCLUDED.studyinstanceuid,
-            date_modified = CURRENT_TIMESTAMP;
-    """
-    extras.execute_values(cur, insert_query, series_data)
-    conn.commit()
+# Release the associations
+executor.shutdown()
+limiter.close()
+print(executor.summary())
+
+# Store the remaining series and then their watermarks
+watermark_writer.flush()
+print(f"{series_writer.written} series written")
 
 # Close the database connection
 cur.close()
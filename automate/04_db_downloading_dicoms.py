@@ -1,184 +1,130 @@
 import os
 import json
-import psycopg2
-from psycopg2 import sql
-from tqdm import tqdm
 import time
-from pynetdicom import AE, evt, build_role, debug_logger
-from pynetdicom.sop_class import (
-    PatientRootQueryRetrieveInformationModelFind,
-    PatientRootQueryRetrieveInformationModelGet,
-    StudyRootQueryRetrieveInformationModelFind,
-    CTImageStorage,
-    MRImageStorage,
-    SecondaryCaptureImageStorage,
-)
-from pydicom.dataset import Dataset
-from datetime import datetime
+import queue
+import signal
+import argparse
+import threading
+from pynetdicom import debug_logger
+from series_downloader import SeriesDownloader
 
 # debug_logger()
-
 self_dir = os.path.dirname(os.path.realpath(__file__))
-config_path = os.path.join(self_dir, "config.json")
+# DICOM_DOWNLOADER_CONFIG points the script at another config, e.g. for the benchmarks
+config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
+
+parser = argparse.ArgumentParser(description="Download the pending series from the PACS")
+parser.add_argument('--daemon', action='store_true',
+                    help="Keep running and wait for new series instead of exiting once none are left")
+args = parser.parse_args()
 
 # Load credentials
 with open(config_path, 'r') as f:
     credentials = json.load(f)
 
-pacs_credentials = credentials['pacs']
-db_credentials = credentials['database']
-
-# Define the local storage directory
-storage_dir = '/mnt/blockstorage/dicoms'
-
-# PostgreSQL connection
-conn = psycopg2.connect(
-    dbname=db_credentials['dbname'],
-    user=db_credentials['user'],
-    password=db_credentials['password'],
-    host=db_credentials['host'],
-    port=db_credentials['port']
-)
-cur = conn.cursor()
-
-# Define the PACS server details
-PACS_IP = pacs_credentials['ip']
-PACS_PORT = pacs_credentials['port']
-PACS_AET = pacs_credentials['aet']
-LOCAL_AET = pacs_credentials['local_aet']
-
-def current_timestamp():
-    """Return the current timestamp as a human-readable string."""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-# Define a handler for incoming C-STORE requests
-def handle_store(event):
-    """Handle a C-STORE request event."""
-    ds = event.dataset
-    ds.file_meta = event.file_meta
-    
-    # Define the filename and save the dataset
-    patient_id = ds.PatientID
-    series_instance_uid = ds.SeriesInstanceUID
-    sop_instance_uid = ds.SOPInstanceUID
-    series_name = ds.SeriesDescription if 'SeriesDescription' in ds else 'Unknown_Series'
-
-    series_dir = os.path.join(storage_dir, patient_id, series_name)
-    os.makedirs(series_dir, exist_ok=True)
-
-    filename = os.path.join(series_dir, f"{sop_instance_uid}.dcm")
-    ds.save_as(filename, write_like_original=False)
-    # print(f"Saved file to {filename}")
-    return 0x0000
-
-handlers = [(evt.EVT_C_STORE, handle_store)]
-
-# Initialize the Application Entity (AE)
-ae = AE()
-ae.acse_timeout = 3000
-ae.dimse_timeout = 3000
-ae.network_timeout = 3000
-saved_files = set()
-
-# Add requested presentation contexts for C-GET and storage of images
-ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
-ae.add_requested_context(PatientRootQueryRetrieveInformationModelGet)
-ae.add_requested_context(CTImageStorage)
-ae.add_requested_context(MRImageStorage)
-ae.add_requested_context(SecondaryCaptureImageStorage)
-
-# Create an SCP/SCU Role Selection Negotiation item for each storage SOP class
-storage_sop_classes = [CTImageStorage, MRImageStorage, SecondaryCaptureImageStorage]
-roles = [build_role(sop_class, scp_role=True) for sop_class in storage_sop_classes]
-
-# Function to download series data for a given series instance UID
-def download_series(ae, pacs_address, pacs_port, called_aet, local_aet, patient_id, study_instance_uid, series_instance_uid, series_name, max_retries=20, wait_time=30):
-    # Define the query dataset
-    ds = Dataset()
-    ds.QueryRetrieveLevel = 'SERIES'
-    ds.PatientID = patient_id
-    ds.StudyInstanceUID = study_instance_uid
-    ds.SeriesInstanceUID = series_instance_uid
-
-    retries = 0
-    while retries < max_retries:
+# Number of concurrent C-GET or C-MOVE associations and how many series to claim per database round-trip
+download_settings = credentials.get('download', {})
+DOWNLOAD_WORKERS = download_settings.get('workers', 3)
+CLAIM_BATCH = download_settings.get('claim_batch', DOWNLOAD_WORKERS * 2)
+
+# In daemon mode an idle downloader sleeps until the database announces new series,
+# but looks for work at least every poll_interval seconds, e.g. for expired leases
+POLL_INTERVAL = download_settings.get('poll_interval', 300)
+
+# Claims, leases, C-GET or C-MOVE with its Storage SCP and the disk writers, see series_downloader.py
+downloader = SeriesDownloader(credentials)
+
+def download_worker(work_queue):
+    """Download the series handed out by the main thread until told to stop."""
+    while True:
+        series_info = work_queue.get()
+        if series_info is None:
+            work_queue.task_done()
+            break
+
+        try:
+            downloader.download(series_info)
+        except Exception as e:
+            # Keep the worker alive and hand the series back so another attempt can claim it
+            print(f"Error downloading SeriesInstanceUID {series_info[0]}: {e}")
+            try:
+                downloader.rollback()
+                downloader.release_series(series_info[0], failed=True)
+            except Exception as e:
+                print(f"Could not release SeriesInstanceUID {series_info[0]}, its lease will expire: {e}")
+        finally:
+            work_queue.task_done()
+
+# Start the download workers, each runs its own C-GET or C-MOVE association
+work_queue = queue.Queue()
+workers = [threading.Thread(target=download_worker, args=(work_queue,), name=f"download-{i}")
+           for i in range(DOWNLOAD_WORKERS)]
+for worker in workers:
+    worker.start()
+
+downloader.start()
+
+if args.daemon:
+    # Listen before the first claim so no notification is missed, SIGTERM stops like Ctrl-C
+    downloader.listen()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+# Main loop to claim series in batches and feed them to the workers
+claim_failures = 0
+try:
+    while True:
+        # Only claim more work once the workers are about to run out
+        if work_queue.unfinished_tasks > DOWNLOAD_WORKERS:
+            time.sleep(1)
+            continue
+
+        try:
+            claimed = downloader.claim_series(CLAIM_BATCH)
+            claim_failures = 0
+        except Exception as e:
+            # The database may be restarting or the connection dropped, back off and claim again
+            claim_failures += 1
+            wait = min(5 * 2 ** (claim_failures - 1), POLL_INTERVAL)
+            print(f"Could not claim series, retrying in {wait} seconds: {e}")
+            try:
+                downloader.rollback()
+            except Exception as e:
+                print(f"Could not reconnect to the database: {e}")
+            time.sleep(wait)
+            continue
+
+        if not claimed:
+            if work_queue.unfinished_tasks == 0:
+                if not args.daemon:
+                    print("No more series to download. Exiting...")
+                    break
+                downloader.wait_for_series(POLL_INTERVAL)
+                continue
+            time.sleep(5)
+            continue
+
+        for series_info in claimed:
+            work_queue.put(series_info)
+except KeyboardInterrupt:
+    # Hand back the series that were claimed but never started
+    while True:
+        try:
+            series_info = work_queue.get_nowait()
+        except queue.Empty:
+            break
         try:
-            # Perform the association with the PACS for C-GET
-            assoc = ae.associate(pacs_address, pacs_port, ae_title=called_aet, ext_neg=roles, evt_handlers=handlers)
-
-            if assoc.is_established:
-                # Update the download_status to 'in_progress'
-                update_download_status(series_instance_uid, 'in_progress')
-
-                # Send the C-GET request
-                responses = assoc.send_c_get(ds, PatientRootQueryRetrieveInformationModelGet)
-                
-                # Process the responses
-                for (status, identifier) in responses:
-                    if status and hasattr(status, 'Status') and status.Status in (0xFF00, 0xFF01):
-                        # Identifier contains the matched dataset
-                        pass
-                    elif status and hasattr(status, 'Status') and status.Status == 0x0000:
-                        # Completed
-                        break
-                    else:
-                        print(f"Failed to retrieve series {series_instance_uid}: 0x{status.Status:04X}")
-
-                # Release the association
-                assoc.release()
-
-                # Update the download_status to 'complete'
-                update_download_status(series_instance_uid, 'complete')
-                break  # Break out of the retry loop
-            else:
-                print(f"Association rejected, aborted or never connected for SeriesInstanceUID: {series_instance_uid}")
-
-        except AttributeError as e:
-            print(f"AttributeError: {e}")
-            retries += 1
-            if retries < max_retries:
-                print(f"Retrying in {wait_time} seconds... (Attempt {retries}/{max_retries})")
-                time.sleep(wait_time)
-            else:
-                print(f"Failed to download series {series_instance_uid} after {max_retries} attempts")
-                break
-
-def update_download_status(series_instance_uid, status):
-    """Update the download status in the PostgreSQL database."""
-    cur.execute("""
-        UPDATE fieldsite.series
-        SET download_status = %s, date_modified = CURRENT_TIMESTAMP
-        WHERE seriesinstanceuid = %s
-    """, (status, series_instance_uid))
-    conn.commit()
-
-# Main loop to download series
-while True:
-    # Query the database to get the next series to download
-    cur.execute("""
-        SELECT s.seriesinstanceuid, s.seriesdescription, p.patient_id, st.studyinstanceuid, s.numberofimages
-        FROM fieldsite.series s
-        JOIN fieldsite.studies st ON s.studyinstanceuid = st.studyinstanceuid
-        JOIN fieldsite.patients p ON st.patient_id = p.patient_id
-        WHERE s.download_status IS NULL OR s.download_status = ''
-        LIMIT 1
-        FOR UPDATE SKIP LOCKED
-    """)
-    series_info = cur.fetchone()
-
-    if not series_info:
-        print("No more series to download. Exiting...")
-        break
-
-    series_instance_uid, series_name, patient_id, study_instance_uid, numimages = series_info
-    print(f"{current_timestamp()} START: {patient_id} - {series_name} - {numimages}")
-    
-    download_series(ae, PACS_IP, PACS_PORT, PACS_AET, LOCAL_AET, patient_id, study_instance_uid, series_instance_uid, series_name)
-    
-    print(f"{current_timestamp()} END: {patient_id} - {series_name} - {numimages}")
-
-# Close the database connection
-cur.close()
-conn.close()
+            downloader.release_series(series_info[0])
+        except Exception as e:
+            print(f"Could not release SeriesInstanceUID {series_info[0]}, its lease will expire: {e}")
+        work_queue.task_done()
+finally:
+    # Stop the workers once the queue has been drained, also when the loop failed
+    for worker in workers:
+        work_queue.put(None)
+    for worker in workers:
+        worker.join()
+
+    # Close the disk writers and the database connection
+    downloader.close()
 
 print("Series data has been downloaded.")
@@ -3,8 +3,7 @@
 # using curl (10 second timeout, retry up to 5 times):
 curl -m 10 --retry 5 https://hc-ping.com/hLLDZXOBn0N0ABea5bVJKQ/smk-compressor-chile-dicoms/start
 
-source /root/miniconda3/bin/activate base
-cd /root/dicom_downloader/automate/
-snakemake --cores 2 --rerun-incomplete -s 05_db_compress_dicoms.smk
+# Patients are packaged in parallel by packaging.workers processes (see config.json)
+/root/miniconda3/envs/sql/bin/python /root/dicom_downloader/automate/05_db_compress_dicoms.py
 
 curl -m 10 --retry 5 https://hc-ping.com/hLLDZXOBn0N0ABea5bVJKQ/smk-compressor-chile-dicoms/$?
\ No newline at end of file
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import time
+import psycopg2
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dicom_packaging import package_patient, remove_stale_indexes
+from db_writer import StagingWriter
+from queries import PATIENTS_READY_TO_PACKAGE
+
+self_dir = os.path.dirname(os.path.realpath(__file__))
+# DICOM_DOWNLOADER_CONFIG points the script at another config, e.g. for the benchmarks
+config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
+
+def get_patients_with_complete_downloads(cur):
+    """Return (patient_id, total_series) for every patient whose series are all downloaded."""
+    cur.execute(PATIENTS_READY_TO_PACKAGE)
+    return cur.fetchall()
+
+def package(patient_id, index_path, download_dir, compressed_dir, delimiter, codec, level):
+    """Package one patient in a worker process and return its index."""
+    index = package_patient(os.path.join(download_dir, patient_id), compressed_dir, index_path, codec, level)
+    remove_stale_indexes(compressed_dir, patient_id, delimiter, index_path)
+    return index
+
+if __name__ == "__main__":
+    # Load credentials
+    with open(config_path, 'r') as f:
+        credentials = json.load(f)
+
+    download_dir = credentials['path']['download']
+    compressed_dir = credentials['path']['compressed']
+    delimiter = credentials['delimiter']
+    packaging = credentials.get('packaging', {})
+
+    # Number of patients packaged at once, defaults to one per core
+    workers = packaging.get('workers') or os.cpu_count()
+    codec = packaging.get('codec', 'deflate')
+    level = packaging.get('level')
+
+    # PostgreSQL connection
+    db_credentials = credentials['database']
+    conn = psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['user'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+    cur = conn.cursor()
+
+    # Checksum of every archive, so transfers can be verified and deduplicated from the database
+    archives_writer = StagingWriter(
+        conn, 'fieldsite.archives',
+        ['archive', 'patient_id', 'series_name', 'codec', 'files', 'size_bytes', 'checksum'],
+        ['archive']
+    )
+
+    # Patients whose index for the current series count exists are already packaged
+    pending = []
+    for patient_id, total_series in get_patients_with_complete_downloads(cur):
+        index_path = os.path.join(compressed_dir, f"{patient_id}{delimiter}{total_series}.json")
+        if not os.path.exists(index_path) and os.path.isdir(os.path.join(download_dir, patient_id)):
+            pending.append((patient_id, index_path))
+    print(f"Packaging {len(pending)} patients with {workers} workers using {codec}")
+
+    os.makedirs(compressed_dir, exist_ok=True)
+    start = time.monotonic()
+    total_bytes = 0
+    failed = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(package, patient_id, index_path, download_dir, compressed_dir,
+                                   delimiter, codec, level): patient_id
+                   for patient_id, index_path in pending}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Packaging patients", unit="patient"):
+            patient_id = futures[future]
+            try:
+                index = future.result()
+            except Exception as e:
+                print(f"Failed to package patient {patient_id}: {e}")
+                failed += 1
+                continue
+            for series in index['series']:
+                total_bytes += series['archive_bytes']
+                archives_writer.add((f"{patient_id}/{series['archive']}", patient_id, series['name'],
+                                     series['codec'], series['files'], series['archive_bytes'], series['checksum']))
+
+    archives_writer.flush()
+
+    # Close the database connection
+    cur.close()
+    conn.close()
+
+    elapsed = max(time.monotonic() - start, 1e-6)
+    print(f"Packaged {len(pending) - failed} patients ({total_bytes / 1e6:.1f} MB of archives) in {elapsed:.1f}s, "
+          f"{failed} failed")
+    if failed:
+        sys.exit(1)
@@ -1,6 +1,7 @@
 import os
 import json
 import psycopg2
+from dicom_packaging import package_patient, remove_stale_indexes
 
 configfile: "config.json"
 
@@ -36,15 +37,21 @@ def get_patients_with_complete_downloads():
 
 rule all:
     input:
-        expand(config['path']['compressed'] + "{patient_id[0]}{delimiter}{patient_id[1]}.zip", 
+        expand(config['path']['compressed'] + "{patient_id[0]}{delimiter}{patient_id[1]}.json", 
         patient_id = get_patients_with_complete_downloads(), delimiter=config['delimiter'])
 
-rule zip_directories:
+# Each series gets its own archive and only new or changed series are packaged again.
+# The output is the index of the patient's series archives, named after the series count
+# so that a patient gaining a series is packaged again.
+rule package_patient:
     input:
         zip_input
     output:
-        config['path']['compressed'] + "{input}.zip"
+        config['path']['compressed'] + "{input}.json"
     resources:
         cpus=1
-    shell:
-        'zip -r "{output}" "{input}" > /dev/null'
+    run:
+        package_patient(input[0], config['path']['compressed'], output[0],
+                        config.get('packaging', {}).get('codec', 'deflate'), config.get('packaging', {}).get('level'))
+        remove_stale_indexes(config['path']['compressed'], wildcards.input.split(config['delimiter'])[0],
+                             config['delimiter'], output[0])
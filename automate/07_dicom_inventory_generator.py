@@ -1,25 +1,42 @@
 import os
+import csv
 import psycopg2
-import pandas as pd
-from datetime import datetime
+from psycopg2 import extras
+from datetime import datetime, timedelta
 import glob
 import json
+import argparse
 # Using the requests library:
 import requests
 
+# pyarrow is optional, the Parquet dataset is only written when it is installed
 try:
-    requests.get("https://hc-ping.com/hLLDZXOBn0N0ABea5bVJKQ/dicom_inventory_generator/start", timeout=10)
-except requests.RequestException as e:
-    # Log ping failure here...
-    print("Ping failed: %s" % e)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+parser = argparse.ArgumentParser(description="Export the inventory of all patients, studies and series")
+parser.add_argument('--full', action='store_true', help="Rewrite every partition of the Parquet dataset")
+args = parser.parse_args()
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
-credentials_path = os.path.join(script_dir, 'credentials.json')
+credentials_path = os.environ.get('DICOM_DOWNLOADER_CONFIG', os.path.join(script_dir, 'credentials.json'))
 
 # Load credentials from 'credentials.json'
 with open(credentials_path, 'r') as f:
     credentials = json.load(f)
 
+# Benchmark runs turn the pings off so they do not show up on the monitoring
+healthchecks = credentials.get('healthchecks', True)
+
+if healthchecks:
+    try:
+        requests.get("https://hc-ping.com/hLLDZXOBn0N0ABea5bVJKQ/dicom_inventory_generator/start", timeout=10)
+    except requests.RequestException as e:
+        # Log ping failure here...
+        print("Ping failed: %s" % e)
+
 db_credentials = credentials['database']
 
 # PostgreSQL connection
@@ -30,18 +47,27 @@ conn = psycopg2.connect(
     host=db_credentials['host'],
     port=db_credentials['port']
 )
-cur = conn.cursor()
 
 # Directory to save the CSV file
 output_dir = credentials['path']['asu_path']
 os.makedirs(output_dir, exist_ok=True)
 
-# Remove any previously created CSV files
-for filepath in glob.glob(os.path.join(output_dir, 'dicom_inventory_*.csv')):
-    os.remove(filepath)
+inventory = credentials.get('inventory', {})
+
+# Rows per CSV file, Excel can not open more than 1048576 rows including the header
+max_rows = inventory.get('max_rows', 1048575)
+
+# Tables of the inventory, shared by the CSV and the Parquet queries
+inventory_from = """
+    FROM
+    "fieldsite"."patients"
+    
+    LEFT JOIN "fieldsite"."studies" AS "Studies" ON "fieldsite"."patients"."patient_id" = "Studies"."patient_id"
+    LEFT JOIN "fieldsite"."series" AS "Series" ON "Studies"."studyid" = "Series"."studyid"
+"""
 
 # Query to get all series
-query = """
+query = f"""
     SELECT
     "fieldsite"."patients"."patient_id" AS "patient_id",
     "fieldsite"."patients"."patient_name" AS "patient_name",
@@ -62,51 +88,313 @@ query = """
     "Series"."seriesdescription" AS "Series__seriesdescription",
     "Series"."bodypartexamined" AS "Series__bodypartexamined",
     "Series"."numberofimages" AS "Series__numberofimages"
-    FROM
-    "fieldsite"."patients"
-    
-    LEFT JOIN "fieldsite"."studies" AS "Studies" ON "fieldsite"."patients"."patient_id" = "Studies"."patient_id"
-    LEFT JOIN "fieldsite"."series" AS "Series" ON "Studies"."studyid" = "Series"."studyid"
-    LIMIT
-    1048575
+    {inventory_from}
 """
 
-# Fetch all data
-cur.execute(query)
-data = cur.fetchall()
-
 # Column names
 columns = ["patient_id","patient_name","patient_sex","Studies__studyid","Studies__patient_id","Studies__study_datetime","Studies__studyinstanceuid","Studies__accession_number","Series__series_id","Series__studyid","Series__seriesinstanceuid","Series__series_datetime","Series__seriesnumber","Series__modality","Series__institutionname","Series__institutionaldepartmentname","Series__seriesdescription","Series__bodypartexamined","Series__numberofimages"]
 
-# Create a DataFrame
-df = pd.DataFrame(data, columns=columns)
+def open_part(part):
+    """Open a temporary CSV file for the given part and write the header."""
+    path = os.path.join(output_dir, f'.dicom_inventory_{timestamp}_{part}.csv.tmp')
+    f = open(path, 'w', newline='')
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    return path, f, writer
+
+def close_part(f):
+    """Flush a CSV file to disk before it is renamed into place."""
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+# Stream the rows from a server-side cursor so memory stays flat however many series there are
+cur = conn.cursor(name='dicom_inventory')
+cur.itersize = 10000
+cur.execute(query)
 
+timestamp = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
+parts = []
+f = None
+rows_in_part = 0
+total_rows = 0
 
-# Check if the DataFrame is not empty
-if not df.empty:
-    # Generate a filename with the current date
-    timestamp = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
-    filename = os.path.join(output_dir, f'dicom_inventory_{timestamp}.csv')
+try:
+    for row in cur:
+        # Start a new file instead of dropping rows once a file is full
+        if f is None or rows_in_part >= max_rows:
+            if f is not None:
+                close_part(f)
+            path, f, writer = open_part(len(parts) + 1)
+            parts.append(path)
+            rows_in_part = 0
+        writer.writerow(row)
+        rows_in_part += 1
+        total_rows += 1
+    if f is not None:
+        close_part(f)
+except Exception:
+    # Leave the previous inventory in place if the export fails
+    if f is not None:
+        f.close()
+    for path in parts:
+        os.remove(path)
+    raise
 
-    # Save to CSV
-    df.to_csv(filename, index=False)
+# Check if any data was retrieved
+if parts:
+    # Move the complete files into place, a single file keeps the old name
+    filenames = []
+    for part, path in enumerate(parts, start=1):
+        suffix = f'_part{part}' if len(parts) > 1 else ''
+        filename = os.path.join(output_dir, f'dicom_inventory_{timestamp}{suffix}.csv')
+        os.replace(path, filename)
+        filenames.append(filename)
 
-    print(f'Series list saved to {filename}')
+    print(f'Series list of {total_rows} rows saved to {", ".join(filenames)}')
 
     # Remove any previously created CSV files
     for filepath in glob.glob(os.path.join(output_dir, 'dicom_inventory_*.csv')):
-        if filepath != filename:
+        if filepath not in filenames:
             os.remove(filepath)
             print(f'Removed old CSV file: {filepath}')
 else:
     print("No data retrieved. No new CSV file created.")
 
-# Close the database connection
 cur.close()
+
+# Partition keys of the Parquet dataset, rows without a study or modality go to 'unknown'
+partition_query = f"""
+    SELECT COALESCE(EXTRACT(YEAR FROM "Studies__study_datetime")::int::text, 'unknown') AS study_year,
+           COALESCE(NULLIF("Series__modality", ''), 'unknown') AS modality_key,
+           inventory.*
+    FROM ({query}) inventory
+"""
+
+# Rows of the patients, studies and series modified since the watermark, each branch is an index lookup
+changed_rows_query = f"""
+    SELECT * FROM ({partition_query}) changed
+    WHERE "patient_id" IN (SELECT patient_id FROM fieldsite.patients WHERE date_modified > %(since)s)
+    UNION
+    SELECT * FROM ({partition_query}) changed
+    WHERE "Studies__studyid" IN (SELECT studyid FROM fieldsite.studies WHERE date_modified > %(since)s)
+    UNION
+    SELECT * FROM ({partition_query}) changed
+    WHERE "Series__series_id" IN (SELECT series_id FROM fieldsite.series WHERE date_modified > %(since)s)
+"""
+
+# Positions of the columns that identify an inventory row
+PATIENT_COLUMN = columns.index("patient_id")
+STUDY_COLUMN = columns.index("Studies__studyid")
+SERIES_COLUMN = columns.index("Series__series_id")
+
+if pa is not None:
+    parquet_schema = pa.schema(
+        [(column, pa.timestamp('us') if column.endswith('_datetime')
+                  else pa.int64() if column in ("Series__series_id", "Series__seriesnumber", "Series__numberofimages")
+                  else pa.string())
+         for column in columns]
+    )
+
+def row_key(row):
+    """Key of an inventory row in fieldsite.inventory_partitions, the most specific entity it belongs to."""
+    if row[SERIES_COLUMN] is not None:
+        return f"s:{row[SERIES_COLUMN]}"
+    if row[STUDY_COLUMN] is not None:
+        return f"t:{row[STUDY_COLUMN]}"
+    return f"p:{row[PATIENT_COLUMN]}"
+
+def partition_path(dataset_dir, study_year, modality):
+    """Return the hive style Parquet file of a partition."""
+    directory = os.path.join(dataset_dir, f"study_year={study_year}", f"modality={modality.replace(os.sep, '_')}")
+    return os.path.join(directory, 'part-0.parquet')
+
+class PartitionWriter:
+    """Write the rows of one partition to a temporary file that replaces the partition once closed."""
+
+    def __init__(self, final_path):
+        self.final_path = final_path
+        self.tmp_path = os.path.join(os.path.dirname(final_path), '.part-0.parquet.tmp')
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        self.writer = pq.ParquetWriter(self.tmp_path, parquet_schema)
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= 10000:
+            self.flush()
+
+    def flush(self):
+        arrays = [pa.array(list(values), type=field.type) for values, field in zip(zip(*self.rows), parquet_schema)]
+        self.writer.write_batch(pa.record_batch(arrays, schema=parquet_schema))
+        self.rows = []
+
+    def close(self):
+        if self.rows:
+            self.flush()
+        self.writer.close()
+        os.replace(self.tmp_path, self.final_path)
+
+def record_partitions(conn, keys):
+    """Record the partition every (row_key, study_year, modality_key) now lives in."""
+    cur = conn.cursor()
+    for i in range(0, len(keys), 10000):
+        extras.execute_values(cur, """
+            INSERT INTO fieldsite.inventory_partitions (row_key, study_year, modality_key)
+            VALUES %s
+            ON CONFLICT (row_key) DO UPDATE
+            SET study_year = EXCLUDED.study_year, modality_key = EXCLUDED.modality_key
+        """, keys[i:i + 10000])
+    cur.close()
+
+def write_all_partitions(conn, dataset_dir):
+    """Rewrite every partition from a single streamed query and record where each row went."""
+    cur = conn.cursor()
+    cur.execute("TRUNCATE fieldsite.inventory_partitions")
+    cur.execute("DELETE FROM fieldsite.inventory_deleted")
+    cur.close()
+
+    stream = conn.cursor(name='dicom_inventory_partitions')
+    stream.itersize = 10000
+    stream.execute(f"{partition_query} ORDER BY study_year, modality_key")
+
+    written = []
+    keys = []
+    key = None
+    writer = None
+    for row in stream:
+        if (row[0], row[1]) != key:
+            if writer is not None:
+                writer.close()
+                written.append(writer.final_path)
+            key = (row[0], row[1])
+            writer = PartitionWriter(partition_path(dataset_dir, *key))
+        writer.add(row[2:])
+        keys.append((row_key(row[2:]), row[0], row[1]))
+        if len(keys) >= 10000:
+            record_partitions(conn, keys)
+            keys = []
+    if writer is not None:
+        writer.close()
+        written.append(writer.final_path)
+    stream.close()
+
+    record_partitions(conn, keys)
+    conn.commit()
+    return written
+
+def refresh_partitions(conn, dataset_dir, since):
+    """Rewrite the old and the new partition of every row changed or deleted since the given time.
+
+    Partitions are read back from their Parquet file, the replaced rows are
+    dropped and the changed rows appended, so the database only reads the
+    rows that changed. A row replaces the placeholder row of its study or
+    patient, e.g. the row of a study without series once its first series
+    arrives. Returns the partitions written and removed.
+    """
+    cur = conn.cursor()
+    cur.execute(changed_rows_query, {'since': since})
+    new_rows = {}
+    changed_keys = set()
+    stale_keys = set()
+    new_keys = []
+    for row in cur.fetchall():
+        values = row[2:]
+        key = row_key(values)
+        changed_keys.add(key)
+        new_keys.append((key, row[0], row[1]))
+        new_rows.setdefault((row[0], row[1]), []).append(values)
+        if values[SERIES_COLUMN] is not None:
+            stale_keys.add(f"t:{values[STUDY_COLUMN]}")
+        if values[STUDY_COLUMN] is not None:
+            stale_keys.add(f"p:{values[PATIENT_COLUMN]}")
+
+    cur.execute("SELECT row_key FROM fieldsite.inventory_deleted WHERE deleted_at > %s", (since,))
+    stale_keys.update(row[0] for row in cur.fetchall())
+    stale_keys -= changed_keys
+    replaced = changed_keys | stale_keys
+
+    # Old partitions of the replaced rows, together with the partitions the changed rows go to
+    cur.execute("""
+        SELECT DISTINCT study_year, modality_key FROM fieldsite.inventory_partitions WHERE row_key = ANY(%s)
+    """, (list(replaced),))
+    partitions = set(new_rows) | set(cur.fetchall())
+
+    written = []
+    removed = []
+    for partition in sorted(partitions):
+        final_path = partition_path(dataset_dir, *partition)
+        kept = []
+        if os.path.exists(final_path):
+            for record in pq.ParquetFile(final_path).read().to_pylist():
+                values = tuple(record[column] for column in columns)
+                if row_key(values) not in replaced:
+                    kept.append(values)
+        rows = kept + new_rows.get(partition, [])
+
+        if rows:
+            writer = PartitionWriter(final_path)
+            for values in rows:
+                writer.add(values)
+            writer.close()
+            written.append(final_path)
+        elif os.path.exists(final_path):
+            os.remove(final_path)
+            removed.append(final_path)
+
+    if stale_keys:
+        cur.execute("DELETE FROM fieldsite.inventory_partitions WHERE row_key = ANY(%s)", (list(stale_keys),))
+    record_partitions(conn, new_keys)
+    cur.execute("DELETE FROM fieldsite.inventory_deleted WHERE deleted_at <= %s", (since,))
+    conn.commit()
+    cur.close()
+    return written, removed
+
+# Refresh only the Parquet partitions with rows modified since the last run
+if pa is None:
+    print("pyarrow is not installed. No Parquet dataset created.")
+elif inventory.get('parquet', True):
+    dataset_dir = inventory.get('parquet_path') or os.path.join(output_dir, 'dicom_inventory_parquet')
+    state_path = os.path.join(dataset_dir, '_inventory_state.json')
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    state = {}
+    if os.path.exists(state_path) and not args.full:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+
+    cur = conn.cursor()
+    cur.execute("SELECT LOCALTIMESTAMP")
+    started = cur.fetchone()[0]
+    cur.close()
+
+    if state.get('watermark'):
+        # Rows written by transactions still open at the last run carry an older timestamp, hence the overlap
+        since = datetime.fromisoformat(state['watermark']) - timedelta(minutes=inventory.get('watermark_overlap_minutes', 10))
+        written, removed = refresh_partitions(conn, dataset_dir, since)
+    else:
+        written = write_all_partitions(conn, dataset_dir)
+        # A full rebuild also removes partitions that no longer have any rows
+        removed = []
+        for filepath in glob.glob(os.path.join(dataset_dir, 'study_year=*', 'modality=*', 'part-0.parquet')):
+            if filepath not in written:
+                os.remove(filepath)
+                removed.append(filepath)
+    for filepath in removed:
+        print(f'Removed empty partition: {filepath}')
+
+    tmp_state_path = f"{state_path}.tmp"
+    with open(tmp_state_path, 'w') as f:
+        json.dump({'watermark': started.isoformat()}, f)
+    os.replace(tmp_state_path, state_path)
+    print(f'Refreshed {len(written)} Parquet partitions in {dataset_dir}')
+
+# Close the database connection
 conn.close()
 
-try:
-    requests.get("https://hc-ping.com/hLLDZXOBn0N0ABea5bVJKQ/dicom_inventory_generator", timeout=10)
-except requests.RequestException as e:
-    # Log ping failure here...
-    print("Ping failed: %s" % e)
+if healthchecks:
+    try:
+        requests.get("https://hc-ping.com/hLLDZXOBn0N0ABea5bVJKQ/dicom_inventory_generator", timeout=10)
+    except requests.RequestException as e:
+        # Log ping failure here...
+        print("Ping failed: %s" % e)
@@ -3,11 +3,20 @@ import shutil
 import pydicom
 import json
 import re
+import time
+import argparse
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Only these tags are read from each file, the pixel data is never loaded
+HEADER_TAGS = ['PatientID', 'SeriesDescription', 'SeriesInstanceUID']
+
+# Directories already created by this worker process
+known_dirs = set()
 
 def get_dicom_metadata(filepath):
     try:
-        dicom_file = pydicom.dcmread(filepath)
+        dicom_file = pydicom.dcmread(filepath, stop_before_pixels=True, specific_tags=HEADER_TAGS)
         patient_id = getattr(dicom_file, 'PatientID', 'Unknown')
         series_description = getattr(dicom_file, 'SeriesDescription', 'No Description').replace(' ', '_')
         # Replacing spaces with underscores and removing special characters makes the string more suitable for use in filenames
@@ -17,42 +26,100 @@ def get_dicom_metadata(filepath):
         print(f"Error reading {filepath}: {e}")
         return None, None, None
 
-def organize_dicoms(input_dir, output_dir, test=False):
+def organize_directory(root, files, output_dir, test=False):
+    """Move the DICOM files of one directory into the organized tree.
+
+    Files are renamed when the directory is on the same device as output_dir
+    and copied otherwise. Returns the number of files handled and bytes moved.
+    """
+    same_device = os.path.exists(output_dir) and os.stat(root).st_dev == os.stat(output_dir).st_dev
+    handled = 0
+    moved_bytes = 0
+
+    for file in files:
+        filepath = os.path.join(root, file)
+
+        patient_id, series_description, series_uid = get_dicom_metadata(filepath)
+        handled += 1
+        if not all([patient_id, series_description, series_uid]):
+            continue
+
+        output_patient_dir = os.path.join(output_dir, str(patient_id))
+        output_series_dir = os.path.join(output_patient_dir, f"{series_description}___{series_uid}")
+
+        if test:
+            print(f"Would move {filepath} to {output_series_dir}")
+            continue
+
+        if output_series_dir not in known_dirs:
+            os.makedirs(output_series_dir, exist_ok=True)
+            known_dirs.add(output_series_dir)
+        destination_file_path = os.path.join(output_series_dir, file)
+        size = os.path.getsize(filepath)
+
+        # If the destination file exists, delete the source file
+        if os.path.exists(destination_file_path):
+            print(f"Destination file already exists: {destination_file_path}. Deleting source file: {filepath}")
+            os.remove(filepath)
+        elif same_device:
+            os.rename(filepath, destination_file_path)
+        else:
+            shutil.move(filepath, destination_file_path)
+        moved_bytes += size
+
+    return handled, moved_bytes
+
+def organize_dicoms(input_dir, output_dir, test=False, workers=None):
+    """Organize every directory of input_dir on a pool of worker processes.
+
+    Moves are idempotent: organized files leave input_dir, and a file whose
+    destination already exists is deleted from input_dir. An interrupted run
+    therefore resumes by running again, only the files left behind are read.
+    """
+    if not test:
+        os.makedirs(output_dir, exist_ok=True)
+
     pbar = tqdm(desc="Organizing DICOM files", unit="files")
-    
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if file.lower().endswith('.dcm'):
-                filepath = os.path.join(root, file)
-                
-                patient_id, series_description, series_uid = get_dicom_metadata(filepath)
-                if not all([patient_id, series_description, series_uid]):
-                    pbar.update(1)  # update progress bar even for skipped files
-                    continue
-                
-                output_patient_dir = os.path.join(output_dir, str(patient_id))
-                output_series_dir = os.path.join(output_patient_dir, f"{series_description}___{series_uid}")
-                
-                if test:
-                    print(f"Would move {filepath} to {output_series_dir}")
-                else:
-                    os.makedirs(output_series_dir, exist_ok=True)
-                    destination_file_path = os.path.join(output_series_dir, file)
-                    
-                    # If the destination file exists, delete the source file
-                    if os.path.exists(destination_file_path):
-                        print(f"Destination file already exists: {destination_file_path}. Deleting source file: {filepath}")
-                        os.remove(filepath)
-                    else:
-                        shutil.move(filepath, output_series_dir)
-                    
-                pbar.update(1)  # update progress bar
-                
+    total_files = 0
+    total_bytes = 0
+    start = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for root, _, files in os.walk(input_dir):
+            dicom_files = [file for file in files if file.lower().endswith('.dcm')]
+            if not dicom_files:
+                continue
+            futures[executor.submit(organize_directory, root, dicom_files, output_dir, test)] = root
+
+        for future in as_completed(futures):
+            root = futures[future]
+            try:
+                handled, moved_bytes = future.result()
+            except Exception as e:
+                print(f"Error organizing {root}: {e}")
+                continue
+
+            total_files += handled
+            total_bytes += moved_bytes
+
+            elapsed = max(time.monotonic() - start, 1e-6)
+            pbar.update(handled)
+            pbar.set_postfix(files_s=f"{total_files / elapsed:.1f}", mb_s=f"{total_bytes / elapsed / 1e6:.1f}")
+
     pbar.close()
 
+    elapsed = max(time.monotonic() - start, 1e-6)
+    print(f"Organized {total_files} files ({total_bytes / 1e6:.1f} MB) in {elapsed:.1f}s: "
+          f"{total_files / elapsed:.1f} files/s, {total_bytes / elapsed / 1e6:.1f} MB/s")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Organize the downloaded DICOM files by patient and series")
+    parser.add_argument('--test', action='store_true', help="Only print where each file would be moved")
+    args = parser.parse_args()
+
     self_dir = os.path.dirname(os.path.realpath(__file__))
-    config_path = os.path.join(self_dir, "config.json")
+    config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
 
     # Load credentials
     with open(config_path, 'r') as f:
@@ -60,6 +127,7 @@ if __name__ == "__main__":
 
     input_directory = credentials['path']['download']
     output_directory = credentials['path']['organized']
-    test = False
-    
-    organize_dicoms(input_directory, output_directory, test=test)
+    organize = credentials.get('organize', {})
+
+    organize_dicoms(input_directory, output_directory, test=args.test,
+                    workers=organize.get('workers') or os.cpu_count())
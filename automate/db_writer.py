@@ -0,0 +1,118 @@
+import csv
+import io
+import time
+from collections.abc import Sequence
+
+from psycopg2 import sql
+
+
+def _copy_value(value):
+    """Convert a value to its text form for COPY, keeping None as NULL."""
+    if value is None:
+        return r'\N'
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        # Multi-valued DICOM elements are stored with the DICOM value delimiter
+        return '\\'.join(str(item) for item in value)
+    return str(value)
+
+
+class StagingWriter:
+    """Stream rows into a table through a temporary staging table.
+
+    Rows are buffered until flush_rows rows or flush_seconds have accumulated,
+    then copied into a temporary staging table with COPY and merged into the
+    target with a single INSERT ... ON CONFLICT. Every flush is committed, so
+    memory stays flat and a crash only loses the rows of the current batch.
+
+    Writers listed in depends_on are flushed first, which lets watermarks be
+    written only after the rows they describe are stored.
+    """
+
+    def __init__(self, conn, table, columns, conflict_columns, update_columns=None,
+                 touch_modified=True, flush_rows=1000, flush_seconds=30, depends_on=()):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.columns = columns
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.depends_on = list(depends_on)
+        self.rows = []
+        self.written = 0
+        self.last_flush = time.monotonic()
+
+        schema_name, table_name = table.split('.')
+        target = sql.Identifier(schema_name, table_name)
+        staging = sql.Identifier(f"staging_{table_name}")
+        column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+        conflict_list = sql.SQL(', ').join(map(sql.Identifier, conflict_columns))
+
+        if update_columns is None:
+            update_columns = [column for column in columns if column not in conflict_columns]
+        updates = [sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column)) for column in update_columns]
+        if touch_modified:
+            updates.append(sql.SQL("date_modified = CURRENT_TIMESTAMP"))
+
+        # Staging table only copies the column types, not the defaults or constraints of the target
+        self.cur.execute(sql.SQL("""
+            CREATE TEMP TABLE IF NOT EXISTS {staging} AS
+            SELECT {columns} FROM {target} WITH NO DATA
+        """).format(staging=staging, columns=column_list, target=target))
+        self.cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS staging_seq BIGSERIAL").format(staging))
+        self.conn.commit()
+
+        self.copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+            staging, column_list).as_string(self.cur)
+
+        # Keep only the last row added for each key, ON CONFLICT can not update a row twice
+        self.merge_query = sql.SQL("""
+            INSERT INTO {target} ({columns})
+            SELECT DISTINCT ON ({conflict}) {columns}
+            FROM {staging}
+            ORDER BY {conflict}, staging_seq DESC
+            ON CONFLICT ({conflict}) DO {action};
+        """).format(
+            target=target,
+            columns=column_list,
+            conflict=conflict_list,
+            staging=staging,
+            action=sql.SQL("UPDATE SET {}").format(sql.SQL(', ').join(updates)) if updates else sql.SQL("NOTHING")
+        )
+        self.truncate_query = sql.SQL("TRUNCATE {}").format(staging)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, row):
+        """Buffer a row and flush if the batch is full or old enough."""
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Copy the buffered rows into the staging table, merge them and commit."""
+        for writer in self.depends_on:
+            writer.flush()
+
+        self.last_flush = time.monotonic()
+        if not self.rows:
+            return
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in self.rows:
+            writer.writerow([_copy_value(value) for value in row])
+        buffer.seek(0)
+
+        self.cur.copy_expert(self.copy_query, buffer)
+        self.cur.execute(self.merge_query)
+        self.cur.execute(self.truncate_query)
+        self.conn.commit()
+
+        self.written += len(self.rows)
+        self.rows = []
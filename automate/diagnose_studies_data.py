@@ -1,8 +1,15 @@
 import pandas as pd
 import os
+import json
 
 self_dir = os.path.dirname(os.path.realpath(__file__))
-csv_file_path = os.path.join(self_dir, 'studies_data.csv')
+# DICOM_DOWNLOADER_CONFIG points the script at another config, e.g. for the benchmarks
+config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
+
+# Read the CSV written by 02_db_insert_studies.py
+with open(config_path, 'r') as f:
+    credentials = json.load(f)
+csv_file_path = credentials['path'].get('studies_csv', os.path.join(self_dir, 'studies_data.csv'))
 
 # Load the CSV file into a DataFrame
 studies_df = pd.read_csv(csv_file_path)
@@ -15,5 +22,5 @@ study_counts.columns = ['StudyID', 'Count']
 print(study_counts)
 
 # Optionally save the counts to a new CSV file
-counts_csv_file_path = os.path.join(self_dir, 'study_counts.csv')
+counts_csv_file_path = os.path.join(os.path.dirname(csv_file_path), 'study_counts.csv')
 study_counts.to_csv(counts_csv_file_path, index=False)
@@ -0,0 +1,228 @@
+import glob
+import json
+import os
+import shutil
+import tarfile
+import zipfile
+from datetime import datetime
+
+from pydicom.filereader import read_file_meta_info
+
+from hashing import ALGORITHM, CHUNK_SIZE, HashingReader, HashingWriter
+
+# zstandard is optional, it is only needed for the zstd codec
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ('stored', 'deflate', 'zstd')
+
+
+def series_files(series_dir):
+    """Return the DICOM files of a series directory sorted by name, skipping the .part files still being written."""
+    return [entry for entry in sorted(os.scandir(series_dir), key=lambda entry: entry.name)
+            if entry.is_file() and entry.name.endswith('.dcm')]
+
+
+def series_fingerprint(series_dir):
+    """Return the number of DICOM files, their total size and the newest modification time of a series directory."""
+    files = 0
+    size = 0
+    newest = 0
+    for entry in series_files(series_dir):
+        stat = entry.stat()
+        files += 1
+        size += stat.st_size
+        newest = max(newest, stat.st_mtime_ns)
+    return [files, size, newest]
+
+
+def has_compressed_pixels(path):
+    """Return True if the file's transfer syntax already compresses the pixel data."""
+    try:
+        return read_file_meta_info(path).TransferSyntaxUID.is_compressed
+    except Exception:
+        return False
+
+
+def _add_to_tar(archive, entry, arcname):
+    """Stream one file into a tar archive and return its size and checksum."""
+    info = archive.gettarinfo(entry.path, arcname)
+    with open(entry.path, 'rb') as src:
+        reader = HashingReader(src)
+        archive.addfile(info, reader)
+    return reader.size, reader.checksum
+
+
+def _add_to_zip(archive, entry, arcname, compress_type):
+    """Stream one file into a zip archive and return its size and checksum."""
+    info = zipfile.ZipInfo.from_file(entry.path, arcname)
+    info.compress_type = compress_type
+    with open(entry.path, 'rb') as src, archive.open(info, 'w') as dst:
+        reader = HashingReader(src)
+        shutil.copyfileobj(reader, dst, CHUNK_SIZE)
+    return reader.size, reader.checksum
+
+
+def package_series(series_dir, archive_base, arcroot, codec='deflate', level=None):
+    """Write the DICOM files of one series directory to an archive under arcroot and return its manifest.
+
+    stored and deflate write archive_base.zip. With deflate, files whose pixel
+    data is already encapsulated (JPEG, JPEG 2000, RLE ...) are stored as is
+    instead of being compressed again. zstd streams archive_base.tar.zst
+    through a zstandard compressor at the given level, or writes a plain
+    archive_base.tar if the series is already compressed. Files are read
+    straight from the series directory without intermediate copies.
+
+    Every file and the archive itself are hashed while they are written and
+    the checksums are saved in a manifest next to the archive, so a transfer
+    can be verified without reading the files a second time. The archive is
+    written under a temporary name and renamed into place, so an interrupted
+    run never leaves a truncated archive behind.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}, expected one of {', '.join(CODECS)}")
+    entries = series_files(series_dir)
+    files = []
+
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("The zstd codec needs the zstandard package")
+        compressed = bool(entries) and has_compressed_pixels(entries[0].path)
+        archive_path = f"{archive_base}.tar" if compressed else f"{archive_base}.tar.zst"
+        tmp_path = f"{archive_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            out = HashingWriter(f)
+            if compressed:
+                stream = out
+            else:
+                compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+                stream = compressor.stream_writer(out, closefd=False)
+            with tarfile.open(fileobj=stream, mode='w|') as archive:
+                for entry in entries:
+                    arcname = os.path.join(arcroot, entry.name)
+                    files.append((arcname,) + _add_to_tar(archive, entry, arcname))
+            if not compressed:
+                stream.close()
+    else:
+        archive_path = f"{archive_base}.zip"
+        tmp_path = f"{archive_path}.tmp"
+        compression = zipfile.ZIP_STORED if codec == 'stored' else zipfile.ZIP_DEFLATED
+        with open(tmp_path, 'wb') as f:
+            out = HashingWriter(f)
+            with zipfile.ZipFile(out, 'w', compression=compression) as archive:
+                for entry in entries:
+                    compress_type = compression
+                    if compression == zipfile.ZIP_DEFLATED and has_compressed_pixels(entry.path):
+                        compress_type = zipfile.ZIP_STORED
+                    arcname = os.path.join(arcroot, entry.name)
+                    files.append((arcname,) + _add_to_zip(archive, entry, arcname, compress_type))
+    os.replace(tmp_path, archive_path)
+
+    manifest = {
+        'archive': os.path.basename(archive_path),
+        'algorithm': ALGORITHM,
+        'checksum': out.checksum,
+        'size_bytes': out.size,
+        'files': [{'name': name, 'size_bytes': size, 'checksum': checksum} for name, size, checksum in files],
+    }
+    write_json(f"{archive_path}.manifest.json", manifest)
+    return manifest
+
+
+def write_json(path, data):
+    """Write data as JSON under a temporary name and rename it into place."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_index(patient_output_dir):
+    """Return the series entries of the current index of a patient, keyed by series directory name."""
+    index_path = os.path.join(patient_output_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r') as f:
+        return {series['name']: series for series in json.load(f)['series']}
+
+
+def remove_archive(patient_output_dir, series):
+    """Remove the archive and the manifest of a series entry of the index."""
+    for path in (series['archive'], f"{series['archive']}.manifest.json"):
+        path = os.path.join(patient_output_dir, path)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def package_patient(patient_dir, output_dir, index_path=None, codec='deflate', level=None):
+    """Package a patient as one archive per series plus an index manifest.
+
+    Series whose directory did not change since they were last packaged keep
+    their archive, so a patient gaining one series only costs that series.
+    Archives of series no longer in the patient directory are removed.
+    The index lists every series archive of the patient and is written to
+    <output_dir>/<patient>/index.json and, if given, to index_path as well.
+    """
+    patient_id = os.path.basename(os.path.normpath(patient_dir))
+    patient_output_dir = os.path.join(output_dir, patient_id)
+    os.makedirs(patient_output_dir, exist_ok=True)
+
+    previous = load_index(patient_output_dir)
+    series_entries = []
+    packaged = 0
+
+    for entry in sorted(os.scandir(patient_dir), key=lambda entry: entry.name):
+        if not entry.is_dir():
+            continue
+        fingerprint = series_fingerprint(entry.path)
+
+        known = previous.get(entry.name)
+        # Archives packaged before checksums were recorded are packaged again to get their manifest
+        if (known is None or known['fingerprint'] != fingerprint or known.get('codec', 'deflate') != codec
+                or 'checksum' not in known
+                or not os.path.exists(os.path.join(patient_output_dir, known['archive']))):
+            manifest = package_series(entry.path, os.path.join(patient_output_dir, entry.name),
+                                      os.path.join(patient_id, entry.name), codec, level)
+            # Remove the archive of an earlier codec
+            if known is not None and known['archive'] != manifest['archive']:
+                remove_archive(patient_output_dir, known)
+            packaged += 1
+            known = {
+                'name': entry.name,
+                'archive': manifest['archive'],
+                'manifest': f"{manifest['archive']}.manifest.json",
+                'codec': codec,
+                'files': fingerprint[0],
+                'bytes': fingerprint[1],
+                'archive_bytes': manifest['size_bytes'],
+                'checksum': manifest['checksum'],
+                'fingerprint': fingerprint,
+                'packaged': datetime.now().isoformat(timespec='seconds'),
+            }
+        series_entries.append(known)
+
+    # Series removed or renamed since the last run must not be shipped with the patient
+    current = {series['name'] for series in series_entries}
+    for name, series in previous.items():
+        if name not in current:
+            remove_archive(patient_output_dir, series)
+
+    index = {
+        'patient_id': patient_id,
+        'series_count': len(series_entries),
+        'series': series_entries,
+    }
+    for path in filter(None, [os.path.join(patient_output_dir, 'index.json'), index_path]):
+        write_json(path, index)
+
+    print(f"Packaged {packaged} of {len(series_entries)} series for patient {patient_id}")
+    return index
+
+
+def remove_stale_indexes(output_dir, patient_id, delimiter, keep):
+    """Remove the index files of earlier series counts of a patient, keeping keep."""
+    for path in glob.glob(os.path.join(output_dir, f"{glob.escape(patient_id)}{delimiter}*.json")):
+        if path != keep:
+            os.remove(path)
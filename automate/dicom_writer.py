@@ -0,0 +1,154 @@
+import os
+import queue
+import threading
+from collections import defaultdict
+
+from hashing import checksum_bytes
+
+
+class DiskWriter:
+    """Write received instances to disk from a pool of writer threads.
+
+    handle_store only queues the encoded bytes, so a slow disk no longer shows
+    up as slow responses to the PACS. The queue is bounded and submit() only
+    blocks once it is full. Each writer takes a batch of files, writes them
+    under a temporary name, fsyncs them together and renames them into place,
+    so a file is either complete or absent.
+
+    Files are tracked per key (the SeriesInstanceUID) so that a series is only
+    marked complete once all of its files are on disk. If on_commit is given it
+    is called from the writer thread as on_commit(key, path, size, checksum,
+    record) for every file that was committed.
+    """
+
+    def __init__(self, workers=4, queue_size=256, batch_size=32, fsync=True, on_commit=None):
+        self.batch_size = batch_size
+        self.on_commit = on_commit
+        self.fsync = fsync
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.known_dirs = set()
+        self.dirs_lock = threading.Lock()
+        self.pending = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.written = defaultdict(int)
+        self.done = threading.Condition()
+        self.threads = [threading.Thread(target=self._run, name=f"disk-writer-{i}", daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, path, data, record=None):
+        """Queue data to be written to path, blocking only while the queue is full."""
+        with self.done:
+            self.pending[key] += 1
+        self.queue.put((key, path, data, record))
+
+    def wait(self, key):
+        """Block until every file queued for key is written and return (written, failed) counts."""
+        with self.done:
+            while self.pending.get(key):
+                self.done.wait()
+            self.pending.pop(key, None)
+            return self.written.pop(key, 0), self.failures.pop(key, 0)
+
+    def close(self):
+        """Write everything still queued and stop the writer threads."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _makedirs(self, directory):
+        with self.dirs_lock:
+            if directory in self.known_dirs:
+                return
+        os.makedirs(directory, exist_ok=True)
+        with self.dirs_lock:
+            self.known_dirs.add(directory)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            # Take whatever else is already waiting to commit it in the same batch
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        opened = []
+        results = []
+        for key, path, data, record in batch:
+            f = None
+            try:
+                self._makedirs(os.path.dirname(path))
+                f = open(f"{path}.part", 'wb')
+                f.write(data)
+                f.flush()
+                checksum = checksum_bytes(data) if self.on_commit else None
+                opened.append((key, path, f, len(data), checksum, record))
+            except OSError as e:
+                print(f"Failed to write {path}: {e}")
+                if f is not None:
+                    f.close()
+                results.append((key, False))
+
+        directories = set()
+        committed = []
+        for key, path, f, size, checksum, record in opened:
+            try:
+                if self.fsync:
+                    os.fsync(f.fileno())
+                f.close()
+                os.replace(f"{path}.part", path)
+                directories.add(os.path.dirname(path))
+                committed.append((key, path, size, checksum, record))
+            except OSError as e:
+                print(f"Failed to write {path}: {e}")
+                f.close()
+                results.append((key, False))
+
+        # One fsync per directory makes all renames of the batch durable
+        if self.fsync:
+            for directory in directories:
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    print(f"Failed to fsync {directory}: {e}")
+
+        for key, path, size, checksum, record in committed:
+            ok = True
+            if self.on_commit is not None:
+                try:
+                    self.on_commit(key, path, size, checksum, record)
+                except Exception as e:
+                    print(f"Failed to record {path}: {e}")
+                    ok = False
+            results.append((key, ok))
+
+        with self.done:
+            for key, ok in results:
+                self.pending[key] -= 1
+                if ok:
+                    self.written[key] += 1
+                else:
+                    self.failures[key] += 1
+            self.done.notify_all()
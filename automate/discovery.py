@@ -0,0 +1,170 @@
+from psycopg2 import extras
+from pydicom.dataset import Dataset
+
+from watermarks import date_range_since
+
+# Columns of the rows built by study_row and series_row, in the order of the tuples
+STUDY_COLUMNS = ['studyid', 'patient_id', 'study_datetime', 'studyinstanceuid', 'accession_number']
+SERIES_COLUMNS = ['studyid', 'seriesinstanceuid', 'series_datetime', 'seriesnumber', 'modality',
+                  'institutionname', 'institutionaldepartmentname', 'seriesdescription',
+                  'bodypartexamined', 'numberofimages', 'comments_on_radiation_dose',
+                  'convolution_kernel', 'protocol_name', 'slice_thickness', 'number_of_slices',
+                  'spacing_between_slices', 'kvp', 'detector_configuration', 'aice',
+                  'aidr_3d_estd', 'patient_comments', 'scan_options', 'vol', 'studyinstanceuid']
+
+# Super complex function for detecting patients that are in THLHP cohort
+def detect_thlhp_patient(patient_id):
+    if len(patient_id) > 5 and patient_id[4] == '-' and int(patient_id[:4]) < 5000:
+        return True
+    if patient_id == '999999-002':
+        print("Adding 999999-002 for phantom scans")
+        return True
+    if patient_id == '266-QHK-VW3N':
+        print("Adding 266-QHK-VW3N")
+        return True
+    # print(patient_id + " not added")
+    return False
+
+def status_text(status):
+    """Format the final status of a C-FIND for the logs, None if the PACS sent none."""
+    return 'no final status' if status is None else f'0x{status:04X}'
+
+def build_patient_query():
+    """Build the PATIENT level C-FIND query dataset matching every patient."""
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'PATIENT'
+    ds.PatientID = ''
+    ds.PatientName = ''
+    ds.PatientSex = ''
+    return ds
+
+def patient_row(identifier):
+    """Return the patients row of a C-FIND response, None if it is not a THLHP patient."""
+    patient_id = identifier.PatientID if 'PatientID' in identifier else None
+    patient_name = str(identifier.PatientName) if 'PatientName' in identifier else None
+    patient_sex = identifier.PatientSex if 'PatientSex' in identifier else None
+    if patient_id and detect_thlhp_patient(patient_id):
+        return (patient_id, patient_name, patient_sex)
+    return None
+
+def insert_patients(conn, cur, rows):
+    """Insert or update a batch of patients rows."""
+    extras.execute_values(cur, """
+        INSERT INTO fieldsite.patients (patient_id, patient_name, patient_sex)
+        VALUES %s
+        ON CONFLICT (patient_id) DO UPDATE
+        SET patient_name = EXCLUDED.patient_name,
+            patient_sex = EXCLUDED.patient_sex,
+            date_modified = CURRENT_TIMESTAMP;
+    """, rows)
+    conn.commit()
+
+def combine_datetime(date, time):
+    """Join a DICOM date and time into one value, None if both are missing."""
+    if date and time:
+        return f"{date} {time}"
+    return date or time or None
+
+def build_study_query(patient_id, discovery, last_checked=None):
+    """Build the STUDY level C-FIND query dataset for a patient.
+
+    Recently active patients that were already checked are only asked for
+    studies dated since their watermark when the PACS supports date ranges.
+    """
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.PatientID = patient_id
+    ds.StudyInstanceUID = ''
+    if last_checked is not None and discovery['date_range_matching']:
+        ds.StudyDate = date_range_since(last_checked, discovery['date_overlap_days'])
+    else:
+        ds.StudyDate = ''
+    ds.StudyTime = ''
+    ds.StudyID = ''
+    ds.AccessionNumber = ''
+    return ds
+
+def study_row(patient_id, identifier):
+    """Return the studies row of a C-FIND response in STUDY_COLUMNS order, None if it is incomplete."""
+    study_id = identifier.StudyID if 'StudyID' in identifier else None
+    study_instance_uid = identifier.StudyInstanceUID if 'StudyInstanceUID' in identifier else None
+    accession_number = identifier.AccessionNumber if 'AccessionNumber' in identifier else None
+    study_date = identifier.StudyDate if 'StudyDate' in identifier else None
+    study_time = identifier.StudyTime if 'StudyTime' in identifier else None
+
+    if study_id and patient_id and study_instance_uid:
+        return (study_id, patient_id, combine_datetime(study_date, study_time), study_instance_uid, accession_number)
+    return None
+
+def build_series_query(studyinstanceuid, discovery, last_checked=None):
+    """Build the SERIES level C-FIND query dataset for a study.
+
+    Recent studies that were already checked are only asked for series dated
+    since their watermark when the PACS supports date ranges.
+    """
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'SERIES'
+    ds.StudyInstanceUID = studyinstanceuid
+    ds.SeriesInstanceUID = ''
+    if last_checked is not None and discovery['date_range_matching']:
+        ds.SeriesDate = date_range_since(last_checked, discovery['date_overlap_days'])
+    else:
+        ds.SeriesDate = ''
+    ds.SeriesTime = ''
+    ds.SeriesNumber = ''
+    ds.Modality = ''
+    ds.InstitutionName = ''
+    ds.InstitutionalDepartmentName = ''
+    ds.SeriesDescription = ''
+    ds.BodyPartExamined = ''
+    ds.NumberOfSeriesRelatedInstances = ''
+    ds.add_new((0x0040, 0x0310), 'ST', '')
+    ds.add_new((0x0018, 0x1210), 'SH', '')
+    ds.add_new((0x0018, 0x1030), 'LO', '')
+    ds.add_new((0x0018, 0x0050), 'DS', '')
+    ds.add_new((0x0054, 0x0081), 'US', '')
+    ds.add_new((0x0018, 0x0088), 'DS', '')
+    ds.add_new((0x0018, 0x0060), 'DS', '')
+    ds.add_new((0x0018, 0x7005), 'CS', '')
+    ds.add_new((0x1092, 0x7005), 'CS', '')
+    ds.add_new((0x100B, 0x7005), 'CS', '')
+    ds.add_new((0x0010, 0x4000), 'LT', '')
+    ds.add_new((0x0018, 0x0022), 'CS', '')
+    ds.add_new((0x1011, 0x7005), 'UN', '')
+    return ds
+
+def series_row(studyid, studyinstanceuid, identifier):
+    """Return the series row of a C-FIND response in SERIES_COLUMNS order, None if it has no SeriesInstanceUID."""
+    series_instance_uid = identifier.SeriesInstanceUID if 'SeriesInstanceUID' in identifier else None
+    if not series_instance_uid:
+        return None
+
+    series_number = identifier.SeriesNumber if 'SeriesNumber' in identifier else None
+    modality = identifier.Modality if 'Modality' in identifier else None
+    institution_name = identifier.InstitutionName if 'InstitutionName' in identifier else None
+    institutional_department_name = identifier.InstitutionalDepartmentName if 'InstitutionalDepartmentName' in identifier else None
+    series_description = identifier.SeriesDescription if 'SeriesDescription' in identifier else None
+    body_part_examined = identifier.BodyPartExamined if 'BodyPartExamined' in identifier else None
+    number_of_images = identifier.NumberOfSeriesRelatedInstances if 'NumberOfSeriesRelatedInstances' in identifier else None
+    series_date = identifier.SeriesDate if 'SeriesDate' in identifier else None
+    series_time = identifier.SeriesTime if 'SeriesTime' in identifier else None
+    comments_on_radiation_dose = identifier[(0x0040, 0x0310)].value if (0x0040, 0x0310) in identifier else None
+    convolution_kernel = identifier[(0x0018, 0x1210)].value if (0x0018, 0x1210) in identifier else None
+    protocol_name = identifier[(0x0018, 0x1030)].value if (0x0018, 0x1030) in identifier else None
+    slice_thickness = identifier[(0x0018, 0x0050)].value if (0x0018, 0x0050) in identifier else None
+    number_of_slices = identifier[(0x0054, 0x0081)].value if (0x0054, 0x0081) in identifier else None
+    spacing_between_slices = identifier[(0x0018, 0x0088)].value if (0x0018, 0x0088) in identifier else None
+    kvp = identifier[(0x0018, 0x0060)].value if (0x0018, 0x0060) in identifier else None
+    detector_configuration = identifier[(0x0018, 0x7005)].value if (0x0018, 0x7005) in identifier else None
+    aice = identifier[(0x1092, 0x7005)].value if (0x1092, 0x7005) in identifier else None
+    aidr_3d_estd = identifier[(0x100B, 0x7005)].value if (0x100B, 0x7005) in identifier else None
+    patient_comments = identifier[(0x0010, 0x4000)].value if (0x0010, 0x4000) in identifier else None
+    scan_options = identifier[(0x0018, 0x0022)].value if (0x0018, 0x0022) in identifier else None
+    vol = identifier[(0x1011, 0x7005)].value if (0x1011, 0x7005) in identifier else None
+
+    return (studyid, series_instance_uid, combine_datetime(series_date, series_time), series_number, modality,
+            institution_name, institutional_department_name, series_description,
+            body_part_examined, number_of_images, comments_on_radiation_dose,
+            convolution_kernel, protocol_name, slice_thickness, number_of_slices,
+            spacing_between_slices, kvp, detector_configuration, aice, aidr_3d_estd,
+            patient_comments, scan_options, vol, studyinstanceuid)
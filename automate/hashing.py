@@ -0,0 +1,124 @@
+import hashlib
+
+# The fastest available hash is used, blake3 and xxhash are optional
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+if blake3 is not None:
+    ALGORITHM = 'blake3'
+elif xxhash is not None:
+    ALGORITHM = 'xxh3_128'
+else:
+    ALGORITHM = 'blake2b'
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def new_hasher(algorithm=ALGORITHM):
+    """Return a new 128 bit hash object of the given algorithm."""
+    if algorithm == 'blake3':
+        return _Blake3(blake3.blake3())
+    if algorithm == 'xxh3_128':
+        return xxhash.xxh3_128()
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    raise ValueError(f"Unknown hash algorithm {algorithm}")
+
+
+class _Blake3:
+    """blake3 hasher truncated to 128 bits like the other algorithms."""
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+
+    def update(self, data):
+        self.hasher.update(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest(length=16)
+
+
+def format_checksum(hasher, algorithm=ALGORITHM):
+    """Return the checksum prefixed with its algorithm, e.g. blake3:9f86d08..."""
+    return f"{algorithm}:{hasher.hexdigest()}"
+
+
+def checksum_bytes(data):
+    """Return the checksum of data."""
+    hasher = new_hasher()
+    hasher.update(data)
+    return format_checksum(hasher)
+
+
+def checksum_file(path, algorithm=ALGORITHM):
+    """Return the checksum of a file, reading it in chunks."""
+    hasher = new_hasher(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return format_checksum(hasher, algorithm)
+
+
+def verify_file(path, checksum):
+    """Return True if the file matches a recorded checksum.
+
+    The file is hashed with the algorithm the checksum was recorded with, so
+    checksums from a machine with another hash library installed still verify.
+    """
+    algorithm, _, _ = checksum.partition(':')
+    return checksum_file(path, algorithm) == checksum
+
+
+class HashingWriter:
+    """Write-only, non-seekable file object that hashes everything written through it.
+
+    Archives are written through it so their checksum is known as soon as they
+    are closed without reading them back. zipfile and tarfile stream into it
+    because it has no seek().
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = new_hasher()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.fileobj.flush()
+
+    @property
+    def checksum(self):
+        return format_checksum(self.hasher)
+
+
+class HashingReader:
+    """Read-only file object that hashes everything read through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = new_hasher()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        self.size += len(data)
+        return data
+
+    @property
+    def checksum(self):
+        return format_checksum(self.hasher)
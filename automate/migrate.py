@@ -0,0 +1,191 @@
+import os
+import json
+import glob
+import hashlib
+import argparse
+import sys
+import psycopg2
+from queries import (
+    CLAIM_SERIES,
+    VALIDATE_FROM_MANIFEST,
+    SERIES_TO_VALIDATE,
+    PENDING_SERIES_OF_STUDY,
+    PATIENTS_READY_TO_PACKAGE,
+)
+
+self_dir = os.path.dirname(os.path.realpath(__file__))
+# DICOM_DOWNLOADER_CONFIG points the script at another config, e.g. for the benchmarks
+config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
+migrations_dir = os.path.join(os.path.dirname(self_dir), 'migrations')
+
+# Any number, only has to be the same for every migrate.py so two of them never run at once
+MIGRATION_LOCK = 7342001
+
+# Queries the pipeline runs all the time, with example parameters and the indexes their plan has to use.
+# A tuple lists indexes that are equally good, the plan has to use one of them.
+HOT_QUERIES = [
+    ("claim pending series", CLAIM_SERIES,
+     {'worker': 'explain', 'lease': 300, 'limit': 6, 'uids': None},
+     ['series_pending_download_idx', 'studies_studyinstanceuid_key']),
+    ("claim queued series", CLAIM_SERIES,
+     {'worker': 'explain', 'lease': 300, 'limit': 1, 'uids': ['1.2.3']},
+     [('series_seriesinstanceuid_key', 'series_pending_download_idx'), 'studies_studyinstanceuid_key']),
+    ("validate from manifest", VALIDATE_FROM_MANIFEST,
+     {'skip': ['CT'], 'uids': None},
+     ['series_pending_validation_idx', 'instances_seriesinstanceuid_idx']),
+    ("series to validate", SERIES_TO_VALIDATE,
+     {'uids': None},
+     ['series_pending_validation_idx']),
+    ("pending series of a study", PENDING_SERIES_OF_STUDY,
+     ('1.2.3',),
+     ['series_studyinstanceuid_idx']),
+    ("patients ready to package", PATIENTS_READY_TO_PACKAGE,
+     None,
+     ['patient_series_summary_complete_idx']),
+]
+
+def list_migrations():
+    """Return (version, name, path) of every migration file, oldest first."""
+    migrations = []
+    for path in sorted(glob.glob(os.path.join(migrations_dir, '*.sql'))):
+        filename = os.path.basename(path)
+        version, _, name = filename[:-4].partition('_')
+        migrations.append((version, name, path))
+    return migrations
+
+def file_checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def applied_migrations(cur):
+    """Return the checksum of every applied migration keyed by version."""
+    cur.execute("""
+        CREATE SCHEMA IF NOT EXISTS fieldsite;
+        CREATE TABLE IF NOT EXISTS fieldsite.schema_migrations (
+            version VARCHAR(16) PRIMARY KEY,
+            name VARCHAR(255),
+            checksum VARCHAR(64),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cur.execute("SELECT version, checksum FROM fieldsite.schema_migrations")
+    return dict(cur.fetchall())
+
+def apply_migrations(conn):
+    """Apply every migration that was not applied yet, each in its own transaction, and return their versions."""
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK,))
+    try:
+        applied = applied_migrations(cur)
+        conn.commit()
+
+        done = []
+        for version, name, path in list_migrations():
+            checksum = file_checksum(path)
+            if version in applied:
+                if applied[version] != checksum:
+                    print(f"Warning: migration {version}_{name} was changed after it was applied")
+                continue
+
+            with open(path, 'r') as f:
+                cur.execute(f.read())
+            cur.execute("""
+                INSERT INTO fieldsite.schema_migrations (version, name, checksum)
+                VALUES (%s, %s, %s)
+            """, (version, name, checksum))
+            conn.commit()
+            print(f"Applied migration {version}_{name}")
+            done.append(version)
+        return done
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK,))
+        conn.commit()
+        cur.close()
+
+def plan_nodes(plan):
+    """Yield every node of an EXPLAIN (FORMAT JSON) plan."""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+def explain_hot_queries(conn):
+    """EXPLAIN every hot query with sequential scans disabled and return the problems found.
+
+    With enable_seqscan off the planner only falls back to a sequential scan
+    if no index can answer the query. Which index wins still depends on the
+    table statistics, so run the check against the production database or
+    a copy of it rather than a nearly empty one.
+    """
+    cur = conn.cursor()
+    problems = []
+    try:
+        for name, query, params, expected_indexes in HOT_QUERIES:
+            cur.execute("SET LOCAL enable_seqscan = off")
+            cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            plan = cur.fetchone()[0][0]['Plan']
+            conn.rollback()
+
+            nodes = list(plan_nodes(plan))
+            used = {node['Index Name'] for node in nodes if 'Index Name' in node}
+            for node in nodes:
+                if node['Node Type'] == 'Seq Scan':
+                    problems.append(f"{name}: sequential scan on {node['Relation Name']}")
+            for indexes in expected_indexes:
+                if isinstance(indexes, str):
+                    indexes = (indexes,)
+                if not used.intersection(indexes):
+                    problems.append(f"{name}: does not use {' or '.join(indexes)}, uses {', '.join(sorted(used)) or 'no index'}")
+            print(f"{name}: {', '.join(sorted(used)) or 'no index'}")
+    finally:
+        conn.rollback()
+        cur.close()
+    return problems
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring the database schema up to date with the migrations directory")
+    parser.add_argument('--status', action='store_true', help="Only list the applied and pending migrations")
+    parser.add_argument('--explain', action='store_true',
+                        help="After migrating, check that every hot query of the pipeline uses its indexes")
+    args = parser.parse_args()
+
+    # Load credentials
+    with open(config_path, 'r') as f:
+        credentials = json.load(f)
+    db_credentials = credentials['database']
+
+    # PostgreSQL connection
+    conn = psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['user'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+
+    failed = False
+    if args.status:
+        cur = conn.cursor()
+        applied = applied_migrations(cur)
+        conn.commit()
+        for version, name, path in list_migrations():
+            state = 'applied' if version in applied else 'pending'
+            if version in applied and applied[version] != file_checksum(path):
+                state = 'applied, changed since'
+            print(f"{version}_{name}: {state}")
+        cur.close()
+    else:
+        done = apply_migrations(conn)
+        print(f"{len(done)} migrations applied, the schema is up to date")
+
+        if args.explain:
+            problems = explain_hot_queries(conn)
+            for problem in problems:
+                print(f"PROBLEM {problem}")
+            failed = bool(problems)
+
+    conn.close()
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,168 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class AssociationManager:
+    """Keep one association with the PACS open and reuse it for many requests.
+
+    Every query used to pay for a full A-ASSOCIATE handshake. The manager opens
+    the association lazily, sends all requests over it and only reconnects when
+    the PACS aborts or releases it. One manager should be used per worker.
+
+    If a limiter is given every handshake and request draws a token from it and
+    rejects or aborts are reported back so that all workers slow down.
+    """
+
+    def __init__(self, ae, address, port, ae_title, max_retries=3, wait_time=5, limiter=None, **assoc_kwargs):
+        self.ae = ae
+        self.address = address
+        self.port = port
+        self.ae_title = ae_title
+        self.max_retries = max_retries
+        self.wait_time = wait_time
+        self.limiter = limiter
+        self.assoc_kwargs = assoc_kwargs
+        self.assoc = None
+        self.handshakes = 0
+        self.requests = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @property
+    def handshakes_saved(self):
+        """Number of handshakes avoided compared to one association per request."""
+        return max(self.requests - self.handshakes, 0)
+
+    def connect(self):
+        """Return an established association, associating again if required."""
+        if self.assoc is not None and self.assoc.is_established:
+            return self.assoc
+
+        if self.limiter is not None:
+            self.limiter.acquire()
+        self.assoc = self.ae.associate(self.address, self.port, ae_title=self.ae_title, **self.assoc_kwargs)
+        self.handshakes += 1
+        if not self.assoc.is_established:
+            self.assoc = None
+            if self.limiter is not None:
+                self.limiter.penalize()
+        return self.assoc
+
+    def send_c_find(self, ds, query_model):
+        """Send a C-FIND request and return its responses as a list.
+
+        If the association is aborted while the responses are being received the
+        partial result is discarded and the query is sent again over a new
+        association. Returns None if no association could be established.
+        """
+        for attempt in range(1, self.max_retries + 1):
+            assoc = self.connect()
+            if assoc is None:
+                if attempt < self.max_retries:
+                    time.sleep(self.wait_time)
+                continue
+
+            if self.limiter is not None:
+                self.limiter.acquire()
+            self.requests += 1
+            responses = list(assoc.send_c_find(ds, query_model))
+            if assoc.is_established:
+                if self.limiter is not None:
+                    self.limiter.recover()
+                return responses
+
+            # Association was aborted mid-query, reconnect on the next attempt
+            self.assoc = None
+            if self.limiter is not None:
+                self.limiter.penalize()
+
+        return None
+
+    def release(self):
+        """Release the association if it is still open."""
+        if self.assoc is not None and self.assoc.is_established:
+            self.assoc.release()
+        self.assoc = None
+
+    def summary(self):
+        return (f"{self.requests} requests sent over {self.handshakes} associations "
+                f"({self.handshakes_saved} handshakes saved)")
+
+
+class FindExecutor:
+    """Send C-FIND requests concurrently from a pool of worker threads.
+
+    Each worker keeps its own AssociationManager and all workers share the
+    limiter, so throughput stays just under the PACS request ceiling.
+    """
+
+    def __init__(self, ae, address, port, ae_title, workers=4, limiter=None, **manager_kwargs):
+        self.ae = ae
+        self.address = address
+        self.port = port
+        self.ae_title = ae_title
+        self.workers = workers
+        self.limiter = limiter
+        self.manager_kwargs = manager_kwargs
+        self.managers = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="c-find")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _manager(self):
+        manager = getattr(self.local, "manager", None)
+        if manager is None:
+            manager = AssociationManager(self.ae, self.address, self.port, self.ae_title,
+                                         limiter=self.limiter, **self.manager_kwargs)
+            self.local.manager = manager
+            with self.lock:
+                self.managers.append(manager)
+        return manager
+
+    def _find(self, key, ds, query_model):
+        return key, self._manager().send_c_find(ds, query_model)
+
+    def map(self, queries, query_model):
+        """Yield (key, responses) for every (key, dataset) in queries as they complete.
+
+        Only a few requests per worker are in flight at once so that very long
+        query lists are not materialised in memory.
+        """
+        pending = set()
+        for key, ds in queries:
+            pending.add(self.pool.submit(self._find, key, ds, query_model))
+            if len(pending) >= self.workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    def shutdown(self):
+        """Wait for the workers and release their associations."""
+        self.pool.shutdown(wait=True)
+        for manager in self.managers:
+            manager.release()
+
+    def summary(self):
+        requests = sum(manager.requests for manager in self.managers)
+        handshakes = sum(manager.handshakes for manager in self.managers)
+        summary = (f"{requests} requests sent over {handshakes} associations by {len(self.managers)} workers "
+                   f"({max(requests - handshakes, 0)} handshakes saved)")
+        if self.limiter is not None:
+            summary += f", final rate {self.limiter.requests_per_minute:.0f} requests/minute"
+        return summary
@@ -0,0 +1,568 @@
+import os
+import json
+import queue
+import signal
+import argparse
+import threading
+from datetime import datetime
+import psycopg2
+from pynetdicom import AE
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind
+)
+from pacs_association import AssociationManager
+from rate_limiter import build_limiter
+from db_writer import StagingWriter
+from watermarks import load_discovery_settings
+from queries import PATIENTS_TO_QUERY, STUDIES_TO_QUERY, PENDING_SERIES_OF_STUDY
+from discovery import (
+    STUDY_COLUMNS,
+    SERIES_COLUMNS,
+    build_patient_query,
+    patient_row,
+    insert_patients,
+    build_study_query,
+    study_row,
+    build_series_query,
+    series_row,
+    status_text,
+)
+from series_downloader import SeriesDownloader, current_timestamp
+from series_validation import (
+    validate_from_manifest,
+    series_to_validate,
+    validate_from_headers,
+    update_validation_statuses,
+)
+
+self_dir = os.path.dirname(os.path.realpath(__file__))
+# DICOM_DOWNLOADER_CONFIG points the script at another config, e.g. for the benchmarks
+config_path = os.environ.get("DICOM_DOWNLOADER_CONFIG", os.path.join(self_dir, "config.json"))
+
+# Marks the end of the work for the workers of a step
+DONE = object()
+
+
+class WorkQueue:
+    """Bounded queue between two pipeline steps that skips keys already waiting or in progress.
+
+    put() blocks while the queue is full, which slows the upstream step down
+    to the pace of the downstream one, and gives up once stop is set. A key
+    can be queued again after the worker that took it called done(key).
+    """
+
+    def __init__(self, maxsize, stop):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stop = stop
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def put(self, key, item):
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self, workers):
+        """Tell each of the workers reading from the queue that no more work will come."""
+        for _ in range(workers):
+            self.queue.put(DONE)
+
+    def get(self, timeout=1):
+        """Return the next item, None if nothing arrived within timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def done(self, key):
+        with self.lock:
+            self.pending.discard(key)
+
+
+def connect(db_credentials):
+    """Open a PostgreSQL connection, every pipeline thread uses its own."""
+    return psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['user'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+
+
+class StepConnection:
+    """Database connection of one pipeline thread and the StagingWriters built on it by build_writers.
+
+    recover() rolls back what a failed item left of the transaction. If the
+    connection itself was lost it is opened again with new writers, which
+    take over the rows the old ones had not written yet.
+    """
+
+    def __init__(self, db_credentials, build_writers=None):
+        self.db_credentials = db_credentials
+        self.build_writers = build_writers or (lambda conn: [])
+        self.open()
+
+    def open(self):
+        self.conn = connect(self.db_credentials)
+        self.cur = self.conn.cursor()
+        self.writers = self.build_writers(self.conn)
+
+    def recover(self):
+        if not self.conn.closed:
+            try:
+                self.conn.rollback()
+                return
+            except psycopg2.Error:
+                pass
+        old_writers = self.writers
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+        self.open()
+        for old, new in zip(old_writers, self.writers):
+            new.rows = old.rows
+
+    def close(self):
+        self.cur.close()
+        self.conn.close()
+
+
+def reset_association(manager):
+    """Forget an association that failed mid-request, the next request opens a new one."""
+    try:
+        manager.release()
+    except Exception:
+        manager.assoc = None
+
+
+class ItemRetry:
+    """Run the work of one queue item and keep the step alive when it fails.
+
+    A transient PACS or database error only costs the item an attempt: the
+    error is logged, recover() is called and the work runs again after wait
+    seconds. The item is dropped once it failed attempts times in a row, the
+    next discovery round queues it again if it is still due.
+    """
+
+    def __init__(self, attempts, wait, stop):
+        self.attempts = attempts
+        self.wait = wait
+        self.stop = stop
+
+    def run(self, step, key, work, recover):
+        """Run work() and return True once it succeeded, False if the item was dropped."""
+        for attempt in range(1, self.attempts + 1):
+            try:
+                work()
+                return True
+            except Exception as e:
+                print(f"{current_timestamp()} {step} ERROR: {key} - attempt {attempt}/{self.attempts} - "
+                      f"{type(e).__name__}: {e}")
+                try:
+                    recover()
+                except Exception as e:
+                    print(f"{current_timestamp()} {step} ERROR: could not recover - {type(e).__name__}: {e}")
+            if attempt < self.attempts and self.stop.wait(self.wait):
+                break
+        print(f"{current_timestamp()} {step} DROPPED: {key}")
+        return False
+
+
+def patient_step(credentials, discovery, ae, limiter, study_queue, series_queue, stop, interval, once, retry):
+    """Query the PACS for patients and queue the patients and studies that are due for discovery.
+
+    Runs one discovery round every interval seconds, or a single round with once.
+    """
+    pacs_credentials = credentials['pacs']
+    db = StepConnection(credentials['database'])
+    manager = AssociationManager(ae, pacs_credentials['ip'], pacs_credentials['port'], pacs_credentials['aet'],
+                                 limiter=limiter)
+
+    def discovery_round():
+        responses = manager.send_c_find(build_patient_query(), PatientRootQueryRetrieveInformationModelFind)
+        if responses is None:
+            print("Association rejected, aborted or never connected")
+        else:
+            rows = [patient_row(identifier) for (status, identifier) in responses
+                    if status.Status in (0xFF00, 0xFF01)]
+            rows = [row for row in rows if row]
+            for i in range(0, len(rows), 100):
+                insert_patients(db.conn, db.cur, rows[i:i + 100])
+            print(f"{current_timestamp()} PATIENTS: {len(rows)} patients in the PACS")
+
+        # Studies that were never queried or are due for a refresh, new studies are queued by the study step
+        if discovery['incremental']:
+            db.cur.execute(STUDIES_TO_QUERY, discovery)
+        else:
+            db.cur.execute("SELECT studyid, studyinstanceuid, NULL FROM fieldsite.studies")
+        studies = db.cur.fetchall()
+
+        if discovery['incremental']:
+            db.cur.execute(PATIENTS_TO_QUERY, discovery)
+        else:
+            db.cur.execute("SELECT patient_id, NULL FROM fieldsite.patients")
+        patients = db.cur.fetchall()
+        db.conn.commit()
+
+        for studyid, studyinstanceuid, last_checked in studies:
+            series_queue.put(studyinstanceuid, (studyid, studyinstanceuid, last_checked))
+        for patient_id, last_checked in patients:
+            study_queue.put(patient_id, (patient_id, last_checked))
+
+    def recover():
+        reset_association(manager)
+        db.recover()
+
+    while not stop.is_set():
+        retry.run('PATIENTS', 'discovery round', discovery_round, recover)
+
+        # Later rounds only query entities that are due again
+        discovery = dict(discovery, incremental=True)
+        if once or stop.wait(interval):
+            break
+
+    manager.release()
+    db.close()
+
+
+def study_writers(conn):
+    studies_writer = StagingWriter(conn, 'fieldsite.studies', STUDY_COLUMNS, ['studyinstanceuid'],
+                                   update_columns=['patient_id', 'study_datetime', 'accession_number'])
+    watermark_writer = StagingWriter(conn, 'fieldsite.discovery_watermarks', ['level', 'key', 'last_checked'],
+                                     ['level', 'key'], touch_modified=False, depends_on=[studies_writer])
+    return [studies_writer, watermark_writer]
+
+
+def study_worker(credentials, discovery, ae, limiter, study_queue, series_queue, stop, retry):
+    """Query the studies of queued patients and queue the studies that are new or recently active."""
+    pacs_credentials = credentials['pacs']
+    db = StepConnection(credentials['database'], study_writers)
+    manager = AssociationManager(ae, pacs_credentials['ip'], pacs_credentials['port'], pacs_credentials['aet'],
+                                 limiter=limiter)
+
+    def query_studies(patient_id, last_checked):
+        studies_writer, watermark_writer = db.writers
+        # Taken before the C-FIND so entities stored while it runs fall in the next date range
+        checked = datetime.now()
+        responses = manager.send_c_find(build_study_query(patient_id, discovery, last_checked),
+                                        StudyRootQueryRetrieveInformationModelFind)
+        if responses is None:
+            print(f"Association rejected, aborted or never connected for PatientID: {patient_id}")
+            return
+
+        study_instance_uids = []
+        final_status = None
+        for (status, identifier) in responses:
+            if status.Status in (0xFF00, 0xFF01):
+                row = study_row(patient_id, identifier)
+                if row:
+                    studies_writer.add(row)
+                    study_instance_uids.append(row[3])
+            else:
+                final_status = status.Status
+
+        # A failed query may have missed studies, leave the patient due for the next round
+        if final_status == 0x0000:
+            watermark_writer.add(('patient', patient_id, checked))
+        else:
+            print(f"{current_timestamp()} C-FIND for PatientID {patient_id} ended with {status_text(final_status)}")
+
+        # Store the studies before handing them on so the series step finds them in the database
+        watermark_writer.flush()
+        db.cur.execute("""
+            SELECT st.studyid, st.studyinstanceuid, w.last_checked
+            FROM fieldsite.studies st
+            LEFT JOIN fieldsite.discovery_watermarks w ON w.level = 'study' AND w.key = st.studyinstanceuid
+            WHERE st.studyinstanceuid = ANY(%(uids)s)
+              AND (w.last_checked IS NULL
+                   OR st.study_datetime > CURRENT_TIMESTAMP - %(active_days)s * INTERVAL '1 day')
+        """, {'uids': study_instance_uids, 'active_days': discovery['active_days']})
+        due = db.cur.fetchall()
+        db.conn.commit()
+        for studyid, studyinstanceuid, study_last_checked in due:
+            series_queue.put(studyinstanceuid, (studyid, studyinstanceuid, study_last_checked))
+        print(f"{current_timestamp()} STUDIES: {patient_id} - {len(study_instance_uids)} studies, {len(due)} queued")
+
+    def recover():
+        reset_association(manager)
+        db.recover()
+
+    while not stop.is_set():
+        item = study_queue.get()
+        if item is None:
+            continue
+        if item is DONE:
+            break
+
+        patient_id, last_checked = item
+        try:
+            retry.run('STUDIES', patient_id, lambda: query_studies(patient_id, last_checked), recover)
+        finally:
+            study_queue.done(patient_id)
+
+    manager.release()
+    db.writers[-1].flush()
+    db.close()
+
+
+def series_writers(conn):
+    series_writer = StagingWriter(conn, 'fieldsite.series', SERIES_COLUMNS, ['seriesinstanceuid'])
+    watermark_writer = StagingWriter(conn, 'fieldsite.discovery_watermarks', ['level', 'key', 'last_checked'],
+                                     ['level', 'key'], touch_modified=False, depends_on=[series_writer])
+    return [series_writer, watermark_writer]
+
+
+def series_worker(credentials, discovery, ae, limiter, series_queue, download_queue, stop, retry):
+    """Query the series of queued studies and queue the series that still have to be downloaded."""
+    pacs_credentials = credentials['pacs']
+    db = StepConnection(credentials['database'], series_writers)
+    manager = AssociationManager(ae, pacs_credentials['ip'], pacs_credentials['port'], pacs_credentials['aet'],
+                                 limiter=limiter)
+
+    def query_series(studyid, studyinstanceuid, last_checked):
+        series_writer, watermark_writer = db.writers
+        # Taken before the C-FIND, like in query_studies
+        checked = datetime.now()
+        responses = manager.send_c_find(build_series_query(studyinstanceuid, discovery, last_checked),
+                                        StudyRootQueryRetrieveInformationModelFind)
+        if responses is None:
+            print(f"Association rejected, aborted or never connected for StudyInstanceUID: {studyinstanceuid}")
+            return
+
+        found = 0
+        final_status = None
+        for (status, identifier) in responses:
+            if status.Status in (0xFF00, 0xFF01):
+                row = series_row(studyid, studyinstanceuid, identifier)
+                if row:
+                    series_writer.add(row)
+                    found += 1
+            else:
+                final_status = status.Status
+
+        # A failed query may have missed series, leave the study due for the next round
+        if final_status == 0x0000:
+            watermark_writer.add(('study', studyinstanceuid, checked))
+        else:
+            print(f"{current_timestamp()} C-FIND for StudyInstanceUID {studyinstanceuid} ended with {status_text(final_status)}")
+
+        # Store the series before handing them on so the downloaders can claim them
+        watermark_writer.flush()
+        db.cur.execute(PENDING_SERIES_OF_STUDY, (studyinstanceuid,))
+        pending = [row[0] for row in db.cur.fetchall()]
+        db.conn.commit()
+        for series_instance_uid in pending:
+            download_queue.put(series_instance_uid, series_instance_uid)
+        print(f"{current_timestamp()} SERIES: {studyinstanceuid} - {found} series, {len(pending)} queued")
+
+    def recover():
+        reset_association(manager)
+        db.recover()
+
+    while not stop.is_set():
+        item = series_queue.get()
+        if item is None:
+            continue
+        if item is DONE:
+            break
+
+        studyid, studyinstanceuid, last_checked = item
+        try:
+            retry.run('SERIES', studyinstanceuid, lambda: query_series(studyid, studyinstanceuid, last_checked), recover)
+        finally:
+            series_queue.done(studyinstanceuid)
+
+    manager.release()
+    db.writers[-1].flush()
+    db.close()
+
+
+def download_worker(downloader, download_queue, validate_queue, stop, idle_poll, drain, retry):
+    """Download queued series, and series left pending by earlier runs whenever the queue is idle.
+
+    With drain the worker keeps claiming pending series after the last queued
+    one until none are left, like 04_db_downloading_dicoms.py.
+    """
+    def download(claimed):
+        for series_info in claimed:
+            try:
+                complete = downloader.download(series_info)
+            except Exception:
+                # Hand the series back, the retry claims it again
+                downloader.rollback()
+                downloader.release_series(series_info[0], failed=True)
+                raise
+            if complete:
+                validate_queue.put(series_info[0], series_info[0])
+        return bool(claimed)
+
+    def claim_and_download(series_instance_uids=None):
+        """Download one claimed series and return False if there was nothing to claim."""
+        claimed = []
+        retry.run('DOWNLOAD', series_instance_uids[0] if series_instance_uids else 'pending series',
+                  lambda: claimed.append(download(downloader.claim_series(1, series_instance_uids))),
+                  downloader.rollback)
+        return any(claimed)
+
+    while not stop.is_set():
+        series_instance_uid = download_queue.get(timeout=idle_poll)
+        if series_instance_uid is DONE:
+            while drain and not stop.is_set():
+                if not claim_and_download():
+                    break
+            break
+
+        if series_instance_uid is None:
+            claim_and_download()
+        else:
+            try:
+                claim_and_download([series_instance_uid])
+            finally:
+                download_queue.done(series_instance_uid)
+
+
+def validate_step(credentials, validate_queue, stop, batch_size, wait, retry):
+    """Validate downloaded series in batches, from the manifest where possible and from the file headers otherwise."""
+    validation = credentials.get('validation', {})
+    storage_dir = credentials['path']['download']
+    workers = validation.get('workers') or os.cpu_count()
+    geometry = validation.get('geometry', False)
+    geometry_modalities = validation.get('geometry_modalities', ['CT']) if geometry else []
+    tolerance = validation.get('spacing_tolerance', 0.1)
+
+    db = StepConnection(credentials['database'])
+
+    def validate(batch):
+        validated = validate_from_manifest(db.conn, db.cur, geometry_modalities, batch)
+        failed = [(patient_id, series_name) for patient_id, series_name, _, _, status in validated if status != 'complete']
+
+        statuses, missing_slices_report, geometry_report = validate_from_headers(
+            series_to_validate(db.cur, batch), storage_dir, workers, geometry, geometry_modalities, tolerance,
+            progress=False)
+        update_validation_statuses(db.conn, db.cur, list(statuses.items()))
+        failed += [(report['patient_id'], report['series_name']) for report in missing_slices_report + geometry_report]
+
+        print(f"{current_timestamp()} VALIDATE: {len(validated) + len(statuses)} series, {len(failed)} failed")
+        for patient_id, series_name in failed:
+            print(f"{current_timestamp()} VALIDATION FAILED: {patient_id} - {series_name}")
+
+    finished = False
+    while not finished and not stop.is_set():
+        # Collect a batch, or whatever arrived within wait seconds
+        batch = []
+        while len(batch) < batch_size:
+            item = validate_queue.get(timeout=wait if not batch else 1)
+            if item is None:
+                break
+            if item is DONE:
+                finished = True
+                break
+            batch.append(item)
+        if not batch:
+            continue
+
+        try:
+            retry.run('VALIDATE', f"{len(batch)} series", lambda: validate(batch), db.recover)
+        finally:
+            for series_instance_uid in batch:
+                validate_queue.done(series_instance_uid)
+
+    db.close()
+
+
+def start_threads(count, name, target, *args):
+    threads = [threading.Thread(target=target, args=args, name=f"{name}-{i}") for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run discovery, download and validation as one long-running pipeline")
+    parser.add_argument('--once', action='store_true',
+                        help="Run a single discovery round, finish every download and validation it started and exit")
+    parser.add_argument('--full', action='store_true',
+                        help="Query every patient and study again in the first round and ignore the watermarks")
+    args = parser.parse_args()
+
+    # Load credentials
+    with open(config_path, 'r') as f:
+        credentials = json.load(f)
+
+    discovery = load_discovery_settings(credentials, full=args.full)
+
+    # Worker count of every step and the size of the queues between them
+    settings = credentials.get('pipeline', {})
+    study_workers = settings.get('study_workers', 2)
+    series_workers = settings.get('series_workers', 4)
+    download_workers = settings.get('download_workers', credentials.get('download', {}).get('workers', 3))
+    queue_size = settings.get('queue_size', 1000)
+
+    stop = threading.Event()
+
+    # A failing item is tried attempts times, retry_wait seconds apart, before the step drops it and moves on
+    retry = ItemRetry(settings.get('attempts', 3), settings.get('retry_wait', 30), stop)
+
+    study_queue = WorkQueue(queue_size, stop)
+    series_queue = WorkQueue(queue_size, stop)
+    download_queue = WorkQueue(queue_size, stop)
+    validate_queue = WorkQueue(queue_size, stop)
+
+    # Stop taking new work on Ctrl-C or SIGTERM, series already downloading are finished first
+    def request_stop(signum, frame):
+        print(f"{current_timestamp()} Stopping, waiting for the running downloads to finish")
+        stop.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # Discovery steps share one AE and one request limiter, every worker keeps its own association
+    ae = AE()
+    ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+    limiter = build_limiter(credentials, 'discovery')
+
+    downloader = SeriesDownloader(credentials)
+    downloader.start()
+
+    patient_threads = start_threads(1, 'patients', patient_step, credentials, discovery, ae, limiter,
+                                    study_queue, series_queue, stop, settings.get('discovery_interval', 3600), args.once,
+                                    retry)
+    study_threads = start_threads(study_workers, 'studies', study_worker, credentials, discovery, ae, limiter,
+                                  study_queue, series_queue, stop, retry)
+    series_threads = start_threads(series_workers, 'series', series_worker, credentials, discovery, ae, limiter,
+                                   series_queue, download_queue, stop, retry)
+    download_threads = start_threads(download_workers, 'download', download_worker, downloader, download_queue,
+                                     validate_queue, stop, settings.get('idle_poll', 30), args.once, retry)
+    validate_threads = start_threads(1, 'validate', validate_step, credentials, validate_queue, stop,
+                                     settings.get('validate_batch', 50), settings.get('validate_wait', 10), retry)
+
+    # Each step is told it is done once every step before it has finished, a stop ends all of them right away
+    steps = [
+        (patient_threads, study_queue, study_workers),
+        (study_threads, series_queue, series_workers),
+        (series_threads, download_queue, download_workers),
+        (download_threads, validate_queue, 1),
+        (validate_threads, None, 0),
+    ]
+    for threads, next_queue, next_workers in steps:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+        if next_queue is not None and not stop.is_set():
+            next_queue.finish(next_workers)
+
+    # Close the disk writers and the database connections
+    downloader.close()
+    limiter.close()
+
+    print("Pipeline has stopped.")
@@ -0,0 +1,100 @@
+# SQL of the queries the pipeline runs all the time. This module imports nothing,
+# so migrate.py can EXPLAIN the queries without loading pynetdicom or the numbered scripts.
+
+# Patients that are new, had a recent study or are due for a periodic refresh.
+# The refresh interval is jittered so that refreshes are spread over several runs.
+PATIENTS_TO_QUERY = """
+    SELECT patient_id, CASE WHEN due THEN NULL ELSE last_checked END
+    FROM (
+        SELECT p.patient_id, w.last_checked,
+               w.last_checked IS NULL
+               OR w.last_checked < CURRENT_TIMESTAMP - %(refresh_days)s * (0.5 + random()) * INTERVAL '1 day' AS due,
+               EXISTS (
+                   SELECT 1 FROM fieldsite.studies st
+                   WHERE st.patient_id = p.patient_id
+                     AND st.study_datetime > CURRENT_TIMESTAMP - %(active_days)s * INTERVAL '1 day'
+               ) AS active
+        FROM fieldsite.patients p
+        LEFT JOIN fieldsite.discovery_watermarks w ON w.level = 'patient' AND w.key = p.patient_id
+    ) candidates
+    WHERE due OR active
+"""
+
+# Studies that are new, recent or due for a periodic refresh
+STUDIES_TO_QUERY = """
+    SELECT studyid, studyinstanceuid, CASE WHEN due THEN NULL ELSE last_checked END
+    FROM (
+        SELECT st.studyid, st.studyinstanceuid, st.study_datetime, w.last_checked,
+               w.last_checked IS NULL
+               OR w.last_checked < CURRENT_TIMESTAMP - %(refresh_days)s * (0.5 + random()) * INTERVAL '1 day' AS due
+        FROM fieldsite.studies st
+        LEFT JOIN fieldsite.discovery_watermarks w ON w.level = 'study' AND w.key = st.studyinstanceuid
+    ) candidates
+    WHERE due OR study_datetime > CURRENT_TIMESTAMP - %(active_days)s * INTERVAL '1 day'
+"""
+
+# Series of a study that no downloader has claimed yet
+PENDING_SERIES_OF_STUDY = """
+    SELECT seriesinstanceuid
+    FROM fieldsite.series
+    WHERE studyinstanceuid = %s AND (download_status IS NULL OR download_status = '')
+"""
+
+# Lease up to limit pending series, or series whose lease expired, only the given uids unless uids is NULL
+CLAIM_SERIES = """
+    UPDATE fieldsite.series s
+    SET download_status = 'in_progress',
+        lease_owner = %(worker)s,
+        lease_expires = CURRENT_TIMESTAMP + %(lease)s * INTERVAL '1 second',
+        date_modified = CURRENT_TIMESTAMP
+    FROM (
+        SELECT pending.series_id, p.patient_id, st.studyinstanceuid
+        FROM fieldsite.series pending
+        JOIN fieldsite.studies st ON pending.studyinstanceuid = st.studyinstanceuid
+        JOIN fieldsite.patients p ON st.patient_id = p.patient_id
+        WHERE (pending.download_status IS NULL OR pending.download_status = ''
+               OR (pending.download_status = 'in_progress'
+                   AND (pending.lease_expires IS NULL OR pending.lease_expires < CURRENT_TIMESTAMP)))
+          AND (%(uids)s::text[] IS NULL OR pending.seriesinstanceuid = ANY(%(uids)s::text[]))
+        LIMIT %(limit)s
+        FOR UPDATE OF pending SKIP LOCKED
+    ) claimed
+    WHERE s.series_id = claimed.series_id
+    RETURNING s.seriesinstanceuid, s.seriesdescription, claimed.patient_id, claimed.studyinstanceuid, s.numberofimages
+"""
+
+# Validate the series with a manifest, except those of the %(skip)s modalities, only the given uids unless uids is NULL
+VALIDATE_FROM_MANIFEST = """
+    WITH manifest AS (
+        SELECT i.seriesinstanceuid, SUM(i.number_of_frames) AS downloaded_num_images
+        FROM fieldsite.instances i
+        JOIN fieldsite.series s ON i.seriesinstanceuid = s.seriesinstanceuid
+        WHERE s.download_status = 'complete' and (s.validation = '' OR s.validation is NULL)
+          AND COALESCE(s.modality, '') <> ALL(%(skip)s)
+          AND (%(uids)s::text[] IS NULL OR s.seriesinstanceuid = ANY(%(uids)s::text[]))
+        GROUP BY i.seriesinstanceuid
+    )
+    UPDATE fieldsite.series s
+    SET validation = CASE WHEN m.downloaded_num_images >= COALESCE(s.numberofimages, 0) THEN 'complete' ELSE 'failed' END,
+        date_modified = CURRENT_TIMESTAMP
+    FROM manifest m, fieldsite.studies st
+    WHERE s.seriesinstanceuid = m.seriesinstanceuid AND s.studyid = st.studyid
+    RETURNING st.patient_id, s.seriesdescription, s.numberofimages, m.downloaded_num_images, s.validation
+"""
+
+# Downloaded series that were not validated yet, only the given uids unless uids is NULL
+SERIES_TO_VALIDATE = """
+    SELECT s.seriesinstanceuid, p.patient_id, s.seriesdescription, s.numberofimages,
+           s.modality, s.spacing_between_slices::text
+    FROM fieldsite.series s
+    JOIN fieldsite.studies st ON s.studyid = st.studyid
+    JOIN fieldsite.patients p ON st.patient_id = p.patient_id
+    WHERE s.download_status = 'complete' and (s.validation = '' OR s.validation is NULL)
+      AND (%(uids)s::text[] IS NULL OR s.seriesinstanceuid = ANY(%(uids)s::text[]))
+"""
+
+# Patients whose series are all downloaded, an index lookup on the counters the series triggers maintain
+PATIENTS_READY_TO_PACKAGE = """
+    SELECT patient_id, total_series
+    FROM fieldsite.patients_with_complete_downloads
+"""
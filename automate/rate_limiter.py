@@ -0,0 +1,196 @@
+import threading
+import time
+
+import psycopg2
+
+
+class TokenBucket:
+    """Thread-safe token bucket that keeps the request rate under the PACS ceiling.
+
+    The PACS resets every connection once it receives more than ~700 requests a
+    minute, so the bucket starts at the configured rate and halves it whenever a
+    worker reports an association reject or abort. The rate then climbs back
+    slowly once the PACS has been quiet for a full minute.
+    """
+
+    def __init__(self, requests_per_minute, burst=10, min_requests_per_minute=60, cooldown=60, grace=5):
+        self.max_rate = requests_per_minute / 60.0
+        self.min_rate = min(min_requests_per_minute, requests_per_minute) / 60.0
+        self.rate = self.max_rate
+        self.capacity = burst
+        self.cooldown = cooldown
+        self.grace = grace
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.penalized = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a request may be sent to the PACS."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self):
+        """Back off after the PACS rejected or aborted an association."""
+        with self.lock:
+            now = time.monotonic()
+            # A connection reset aborts every worker at once, only back off once for it
+            if now - self.penalized < self.grace:
+                return
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            self.penalized = now
+
+    def recover(self):
+        """Raise the rate back towards the ceiling after a successful request."""
+        with self.lock:
+            now = time.monotonic()
+            if self.rate < self.max_rate and now - self.penalized > self.cooldown:
+                self._refill(now)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    @property
+    def requests_per_minute(self):
+        return self.rate * 60
+
+    def close(self):
+        pass
+
+
+class SharedRequestBudget:
+    """Token bucket stored in PostgreSQL and shared by every pipeline process.
+
+    All scripts that talk to the PACS draw from the same row of
+    fieldsite.pacs_request_budget, so together they stay under the request
+    ceiling. Each stage may only take tokens while more than its reserve is
+    left in the bucket, which keeps a share of the budget for downloads when
+    discovery is busy.
+    """
+
+    def __init__(self, db_credentials, requests_per_minute, stage, reserve=0.0, burst=10,
+                 min_requests_per_minute=60, cooldown=60, grace=5, name='pacs'):
+        self.name = name
+        self.stage = stage
+        self.reserve = reserve * burst
+        self.cooldown = cooldown
+        self.grace = grace
+        self.min_rate = min(min_requests_per_minute, requests_per_minute) / 60.0
+        self.max_rate = requests_per_minute / 60.0
+        self.rate = self.max_rate
+        self.recovered = 0.0
+        self.lock = threading.Lock()
+
+        # Separate connection so budget updates never commit the caller's transaction
+        self.conn = psycopg2.connect(
+            dbname=db_credentials['dbname'],
+            user=db_credentials['user'],
+            password=db_credentials['password'],
+            host=db_credentials['host'],
+            port=db_credentials['port']
+        )
+        self.conn.autocommit = True
+        self.cur = self.conn.cursor()
+        self.cur.execute("""
+            INSERT INTO fieldsite.pacs_request_budget (name, tokens, capacity, rate_per_second, max_rate_per_second)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (name) DO UPDATE
+            SET capacity = EXCLUDED.capacity,
+                max_rate_per_second = EXCLUDED.max_rate_per_second,
+                rate_per_second = LEAST(fieldsite.pacs_request_budget.rate_per_second, EXCLUDED.max_rate_per_second)
+        """, (name, float(burst), float(burst), self.max_rate, self.max_rate))
+
+    def acquire(self):
+        """Block until this stage may send a request to the PACS."""
+        while True:
+            with self.lock:
+                self.cur.execute("""
+                    WITH budget AS (
+                        SELECT name, rate_per_second,
+                               LEAST(capacity, tokens + EXTRACT(EPOCH FROM clock_timestamp()::timestamp - refilled_at) * rate_per_second) AS available
+                        FROM fieldsite.pacs_request_budget
+                        WHERE name = %(name)s
+                        FOR UPDATE
+                    )
+                    UPDATE fieldsite.pacs_request_budget b
+                    SET tokens = CASE WHEN budget.available - 1 >= %(reserve)s THEN budget.available - 1 ELSE budget.available END,
+                        refilled_at = clock_timestamp()::timestamp
+                    FROM budget
+                    WHERE b.name = budget.name
+                    RETURNING budget.available - 1 >= %(reserve)s, budget.available, budget.rate_per_second
+                """, {'name': self.name, 'reserve': self.reserve})
+                granted, available, rate = self.cur.fetchone()
+                self.rate = rate
+            if granted:
+                return
+            time.sleep(min(1.0, (self.reserve + 1 - available) / rate))
+
+    def penalize(self):
+        """Halve the shared rate after the PACS rejected or aborted an association."""
+        with self.lock:
+            self.cur.execute("""
+                UPDATE fieldsite.pacs_request_budget
+                SET rate_per_second = GREATEST(%s, rate_per_second / 2),
+                    tokens = 0,
+                    refilled_at = clock_timestamp()::timestamp,
+                    penalized_at = clock_timestamp()::timestamp
+                WHERE name = %s
+                  AND (penalized_at IS NULL OR penalized_at < clock_timestamp()::timestamp - %s * INTERVAL '1 second')
+            """, (self.min_rate, self.name, self.grace))
+
+    def recover(self):
+        """Raise the shared rate back towards the ceiling, at most once a second per process."""
+        with self.lock:
+            now = time.monotonic()
+            if self.rate >= self.max_rate or now - self.recovered < 1:
+                return
+            self.recovered = now
+            self.cur.execute("""
+                UPDATE fieldsite.pacs_request_budget
+                SET tokens = LEAST(capacity, tokens + EXTRACT(EPOCH FROM clock_timestamp()::timestamp - refilled_at) * rate_per_second),
+                    refilled_at = clock_timestamp()::timestamp,
+                    rate_per_second = LEAST(max_rate_per_second, rate_per_second + max_rate_per_second / 100)
+                WHERE name = %s
+                  AND rate_per_second < max_rate_per_second
+                  AND (penalized_at IS NULL OR penalized_at < clock_timestamp()::timestamp - %s * INTERVAL '1 second')
+            """, (self.name, self.cooldown))
+
+    @property
+    def requests_per_minute(self):
+        return self.rate * 60
+
+    def close(self):
+        self.cur.close()
+        self.conn.close()
+
+
+def build_limiter(credentials, stage):
+    """Return the request limiter configured for a pipeline stage.
+
+    Uses the PostgreSQL backed SharedRequestBudget when request_budget.shared
+    is enabled in the config, otherwise a TokenBucket local to this process.
+    """
+    requests_per_minute = credentials['pacs'].get('requests_per_minute', 650)
+    budget = credentials.get('request_budget', {})
+    if not budget.get('shared', False):
+        return TokenBucket(requests_per_minute)
+
+    return SharedRequestBudget(
+        credentials['database'],
+        requests_per_minute,
+        stage=stage,
+        reserve=budget.get('reserve', {}).get(stage, 0.0),
+        burst=budget.get('burst', 10),
+        name=budget.get('name', 'pacs')
+    )
@@ -0,0 +1,602 @@
+import os
+import select
+import socket
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+
+import psycopg2
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pynetdicom import AE, evt, build_role, AllStoragePresentationContexts, ALL_TRANSFER_SYNTAXES
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelGet,
+    PatientRootQueryRetrieveInformationModelMove,
+    CTImageStorage,
+    MRImageStorage,
+    SecondaryCaptureImageStorage,
+)
+
+from rate_limiter import build_limiter
+from dicom_writer import DiskWriter
+from db_writer import StagingWriter
+from queries import CLAIM_SERIES
+
+# The only tags handle_store needs from each instance, all of them come before the pixel data
+STORE_TAGS = ['PatientID', 'SeriesInstanceUID', 'SeriesDescription', 'NumberOfFrames']
+
+# Channel notified by the triggers on fieldsite.series whenever series become pending
+PENDING_CHANNEL = 'series_pending'
+
+# Storage SOP classes the PACS may send back over the C-GET association
+STORAGE_SOP_CLASSES = [CTImageStorage, MRImageStorage, SecondaryCaptureImageStorage]
+
+# C-STORE failure status for instances of a series no C-MOVE of this downloader asked for
+STATUS_UNEXPECTED_INSTANCE = 0xC000
+
+
+def current_timestamp():
+    """Return the current timestamp as a human-readable string."""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def stored_instances(series_dir):
+    """Return the SOPInstanceUIDs already written to a series directory."""
+    try:
+        return {filename[:-4] for filename in os.listdir(series_dir) if filename.endswith('.dcm')}
+    except FileNotFoundError:
+        return set()
+
+
+class SeriesDownloader:
+    """Claim series from the database and download them from the PACS with C-GET or C-MOVE.
+
+    Used by 04_db_downloading_dicoms.py and by the download step of
+    pipeline.py. Series are claimed with a lease that heartbeat() renews while
+    instances arrive, expired leases of dead downloaders are picked up again by
+    the others. download() can be called from several threads at once, each
+    call runs its own C-GET or C-MOVE association and all of them share one
+    database connection, one request limiter and one DiskWriter.
+
+    With C-MOVE the PACS opens its own associations to a Storage SCP that
+    start() runs on download.move_port. The SCP has its own AE, so its limit
+    of move_associations concurrent associations from the PACS does not count
+    the downloader's own C-MOVE associations. It accepts every storage SOP
+    class and routes each instance to the running move of its SeriesInstanceUID.
+    """
+
+    def __init__(self, credentials):
+        pacs_credentials = credentials['pacs']
+        db_credentials = credentials['database']
+        settings = credentials.get('download', {})
+
+        # Define the local storage directory
+        self.storage_dir = credentials['path'].get('download', '/mnt/blockstorage/dicoms')
+
+        # Define the PACS server details
+        self.pacs_ip = pacs_credentials['ip']
+        self.pacs_port = pacs_credentials['port']
+        self.pacs_aet = pacs_credentials['aet']
+        self.local_aet = pacs_credentials['local_aet']
+
+        # 'get' retrieves over the requesting association, 'move' has the PACS send to our Storage SCP
+        self.retrieve = settings.get('retrieve', 'get')
+        if self.retrieve not in ('get', 'move'):
+            raise ValueError(f"Unknown download.retrieve '{self.retrieve}', expected 'get' or 'move'")
+        self.move_aet = settings.get('move_aet') or self.local_aet
+        self.move_port = settings.get('move_port', 11113)
+        self.server = None
+
+        self.lease_seconds = settings.get('lease_seconds', 300)
+        # Series whose download failed this many times are marked 'failed' instead of being claimed again
+        self.max_attempts = settings.get('max_attempts', 5)
+        self.heartbeat_seconds = settings.get('heartbeat_seconds', 60)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        # Write instances exactly as received instead of decoding and re-encoding them
+        self.raw_store = settings.get('raw_store', True)
+
+        # Retries only fetch the instances that are not on disk yet, requesting resume_chunk SOPInstanceUIDs per C-GET
+        self.resume = settings.get('resume', True)
+        self.resume_chunk = settings.get('resume_chunk', 200)
+
+        # PostgreSQL connection and instance manifest, shared by all download threads
+        self.db_credentials = db_credentials
+        self.listen_conn = None
+        self.connect()
+        self.db_lock = threading.Lock()
+
+        # Draw from the PACS request budget, shared with the other scripts if configured
+        self.limiter = build_limiter(credentials, 'download')
+
+        # Received instances are handed to a pool of writer threads so the disk never blocks the network
+        self.disk_writer = DiskWriter(
+            workers=settings.get('writer_threads', 4),
+            queue_size=settings.get('writer_queue_size', 256),
+            fsync=settings.get('fsync', True),
+            on_commit=self.record_instance
+        )
+
+        # Last time each series held by this process saw activity (claimed, started or received an instance)
+        self.held_series = {}
+        # Directory of every series a C-MOVE is running for, keyed by SeriesInstanceUID
+        self.moves = {}
+        self.held_lock = threading.Lock()
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat_thread = None
+
+        # Initialize the Application Entity (AE)
+        self.ae = AE()
+        self.ae.acse_timeout = 3000
+        self.ae.dimse_timeout = 3000
+        self.ae.network_timeout = 3000
+        self.handlers = [(evt.EVT_C_STORE, self.handle_store)]
+
+        self.ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
+        if self.retrieve == 'move':
+            # The requesting association only carries C-FIND and C-MOVE, the instances arrive on the
+            # PACS's associations to the Storage SCP, which accepts any storage SOP class and transfer syntax
+            self.ae.add_requested_context(PatientRootQueryRetrieveInformationModelMove)
+            self.roles = []
+
+            # The Storage SCP gets its own AE so its association limit only applies to the PACS's associations
+            self.scp_ae = AE(ae_title=self.move_aet)
+            self.scp_ae.acse_timeout = 3000
+            self.scp_ae.dimse_timeout = 3000
+            self.scp_ae.network_timeout = 3000
+            for context in AllStoragePresentationContexts:
+                self.scp_ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+            self.scp_ae.maximum_associations = settings.get('move_associations', 16)
+        else:
+            # Add requested presentation contexts for C-GET and storage of images
+            self.ae.add_requested_context(PatientRootQueryRetrieveInformationModelGet)
+            for sop_class in STORAGE_SOP_CLASSES:
+                self.ae.add_requested_context(sop_class)
+
+            # Create an SCP/SCU Role Selection Negotiation item for each storage SOP class
+            self.roles = [build_role(sop_class, scp_role=True) for sop_class in STORAGE_SOP_CLASSES]
+
+    def connect(self):
+        self.conn = psycopg2.connect(
+            dbname=self.db_credentials['dbname'],
+            user=self.db_credentials['user'],
+            password=self.db_credentials['password'],
+            host=self.db_credentials['host'],
+            port=self.db_credentials['port']
+        )
+        self.cur = self.conn.cursor()
+
+        # Manifest of every instance written to disk, so validation never has to read the files again
+        self.manifest_writer = StagingWriter(
+            self.conn, 'fieldsite.instances',
+            ['sopinstanceuid', 'seriesinstanceuid', 'size_bytes', 'number_of_frames', 'checksum'],
+            ['sopinstanceuid']
+        )
+
+    def record_instance(self, series_instance_uid, filename, size, checksum, record):
+        """Add a committed instance to the manifest, called from the disk writer threads."""
+        sop_instance_uid, number_of_frames = record
+        with self.db_lock:
+            try:
+                self.manifest_writer.add((sop_instance_uid, series_instance_uid, size, number_of_frames, checksum))
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def flush_manifest(self):
+        with self.db_lock:
+            try:
+                self.manifest_writer.flush()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def touch_series(self, series_instance_uid):
+        """Record activity on a series so the heartbeat keeps renewing its lease."""
+        with self.held_lock:
+            self.held_series[series_instance_uid] = time.monotonic()
+
+    def drop_series(self, series_instance_uid):
+        with self.held_lock:
+            self.held_series.pop(series_instance_uid, None)
+
+    def series_dir(self, patient_id, series_name):
+        """Directory handle_store writes the instances of a series to."""
+        return os.path.join(self.storage_dir, patient_id, series_name or 'Unknown_Series')
+
+    # Define a handler for incoming C-STORE requests
+    def handle_store(self, event):
+        """Handle a C-STORE request event."""
+        if self.raw_store:
+            # Preamble, file meta and the dataset bytes as they were received,
+            # only the header is parsed to find where the file belongs
+            data = event.encoded_dataset(include_meta=True)
+            ds = dcmread(BytesIO(data), stop_before_pixels=True, specific_tags=STORE_TAGS)
+            sop_instance_uid = event.request.AffectedSOPInstanceUID
+        else:
+            ds = event.dataset
+            ds.file_meta = event.file_meta
+            sop_instance_uid = ds.SOPInstanceUID
+
+        # Define the filename and save the dataset
+        patient_id = ds.PatientID
+        series_instance_uid = ds.SeriesInstanceUID
+        series_name = ds.SeriesDescription if 'SeriesDescription' in ds else 'Unknown_Series'
+        number_of_frames = int(ds.NumberOfFrames or 1) if 'NumberOfFrames' in ds else 1
+
+        if self.retrieve == 'move':
+            # Anyone may connect to the Storage SCP, only keep instances of the series being moved
+            with self.held_lock:
+                series_dir = self.moves.get(series_instance_uid)
+            if series_dir is None:
+                print(f"{current_timestamp()} Refused an instance of SeriesInstanceUID {series_instance_uid}, "
+                      f"no C-MOVE of it is running")
+                return STATUS_UNEXPECTED_INSTANCE
+        else:
+            series_dir = self.series_dir(patient_id, series_name)
+        self.touch_series(series_instance_uid)
+
+        filename = os.path.join(series_dir, f"{sop_instance_uid}.dcm")
+        if not self.raw_store:
+            buffer = BytesIO()
+            ds.save_as(buffer, write_like_original=False)
+            data = buffer.getvalue()
+
+        # Queue the file for the disk writers, this only blocks when the queue is full
+        self.disk_writer.submit(series_instance_uid, filename, data, (sop_instance_uid, number_of_frames))
+        return 0x0000
+
+    def find_series_instances(self, assoc, patient_id, study_instance_uid, series_instance_uid):
+        """List the SOPInstanceUIDs of a series with an IMAGE level C-FIND, None if the query was cut short."""
+        ds = Dataset()
+        ds.QueryRetrieveLevel = 'IMAGE'
+        ds.PatientID = patient_id
+        ds.StudyInstanceUID = study_instance_uid
+        ds.SeriesInstanceUID = series_instance_uid
+        ds.SOPInstanceUID = ''
+
+        self.limiter.acquire()
+        sop_instance_uids = set()
+        for (status, identifier) in assoc.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind):
+            if status and hasattr(status, 'Status') and status.Status in (0xFF00, 0xFF01) and 'SOPInstanceUID' in identifier:
+                sop_instance_uids.add(identifier.SOPInstanceUID)
+
+        if not assoc.is_established:
+            return None
+        return sop_instance_uids
+
+    def save_progress(self, series_instance_uid):
+        """Record how many instances of the series are on disk, counted from its manifest.
+
+        Series with the same description share a directory, so the files of the
+        directory are not counted. Call flush_manifest() first.
+        """
+        with self.db_lock:
+            self.cur.execute("""
+                UPDATE fieldsite.series
+                SET instances_downloaded = (
+                    SELECT COUNT(*) FROM fieldsite.instances WHERE seriesinstanceuid = %(uid)s
+                )
+                WHERE seriesinstanceuid = %(uid)s
+            """, {'uid': series_instance_uid})
+            self.conn.commit()
+
+    def send_retrieve(self, assoc, request):
+        """Send a C-GET or C-MOVE request and return its responses."""
+        if self.retrieve == 'move':
+            return assoc.send_c_move(request, self.move_aet, PatientRootQueryRetrieveInformationModelMove)
+        return assoc.send_c_get(request, PatientRootQueryRetrieveInformationModelGet)
+
+    def download_series(self, patient_id, study_instance_uid, series_instance_uid, series_name, max_retries=20, wait_time=30):
+        """Download a series with C-GET or C-MOVE, retrying with only the missing instances, and return True once it is on disk."""
+        # Define the query dataset
+        ds = Dataset()
+        ds.QueryRetrieveLevel = 'SERIES'
+        ds.PatientID = patient_id
+        ds.StudyInstanceUID = study_instance_uid
+        ds.SeriesInstanceUID = series_instance_uid
+
+        series_dir = self.series_dir(patient_id, series_name)
+        with self.held_lock:
+            self.moves[series_instance_uid] = series_dir
+        try:
+            return self.retrieve_series(ds, patient_id, study_instance_uid, series_instance_uid, series_name,
+                                        series_dir, max_retries, wait_time)
+        finally:
+            with self.held_lock:
+                self.moves.pop(series_instance_uid, None)
+
+    def retrieve_series(self, ds, patient_id, study_instance_uid, series_instance_uid, series_name, series_dir, max_retries, wait_time):
+        """Run the associations of download_series until the series is on disk or max_retries attempts failed."""
+        retries = 0
+        while retries < max_retries:
+            try:
+                # Perform the association with the PACS for C-GET or C-MOVE
+                self.limiter.acquire()
+                assoc = self.ae.associate(self.pacs_ip, self.pacs_port, ae_title=self.pacs_aet,
+                                          ext_neg=self.roles, evt_handlers=self.handlers)
+
+                if assoc.is_established:
+                    requests = [ds]
+
+                    # If an earlier attempt got part of the series only ask for the missing instances
+                    on_disk = stored_instances(series_dir) if self.resume else set()
+                    expected = self.find_series_instances(assoc, patient_id, study_instance_uid, series_instance_uid) if on_disk else None
+                    if on_disk and expected is None:
+                        raise RuntimeError("association dropped during the IMAGE level C-FIND")
+                    if expected:
+                        missing = sorted(expected - on_disk)
+                        print(f"{current_timestamp()} RESUME: {patient_id} - {series_name} - "
+                              f"{len(expected) - len(missing)} of {len(expected)} instances already on disk")
+                        requests = []
+                        for i in range(0, len(missing), self.resume_chunk):
+                            request = Dataset()
+                            request.QueryRetrieveLevel = 'IMAGE'
+                            request.PatientID = patient_id
+                            request.StudyInstanceUID = study_instance_uid
+                            request.SeriesInstanceUID = series_instance_uid
+                            request.SOPInstanceUID = missing[i:i + self.resume_chunk]
+                            requests.append(request)
+
+                    # Final status of every request, anything but 0x0000 means instances are missing
+                    final_statuses = []
+                    for request in requests:
+                        # Send the C-GET or C-MOVE request, with C-MOVE the final response only
+                        # comes once the PACS got our response to every C-STORE it sent
+                        self.limiter.acquire()
+                        responses = self.send_retrieve(assoc, request)
+
+                        # Process the responses
+                        final_status = None
+                        for (status, identifier) in responses:
+                            if status and hasattr(status, 'Status') and status.Status in (0xFF00, 0xFF01):
+                                # Identifier contains the matched dataset
+                                pass
+                            elif status and hasattr(status, 'Status'):
+                                # Completed, with 0xB000 or a failure if some sub-operations failed
+                                final_status = status.Status
+                                break
+                        final_statuses.append(final_status)
+
+                    # An aborted retrieve ends the responses early, the series is not complete then
+                    if not assoc.is_established:
+                        raise RuntimeError("association dropped during the retrieve")
+
+                    # Release the association
+                    assoc.release()
+
+                    # Wait until the disk writers have committed every instance of the series
+                    written, failed = self.disk_writer.wait(series_instance_uid)
+                    self.flush_manifest()
+                    self.save_progress(series_instance_uid)
+
+                    # A resumed attempt knows every instance of the series, check that all of them arrived
+                    still_missing = len(expected - stored_instances(series_dir)) if expected else 0
+                    unsuccessful = [status for status in final_statuses if status != 0x0000]
+                    if failed:
+                        print(f"Failed to write {failed} instances of series {series_instance_uid} to disk")
+                    elif unsuccessful:
+                        print(f"Failed to retrieve series {series_instance_uid}: "
+                              f"{', '.join('no final status' if status is None else f'0x{status:04X}' for status in unsuccessful)}")
+                    elif still_missing:
+                        print(f"Failed to retrieve series {series_instance_uid}: {still_missing} instances still missing")
+                    else:
+                        # Update the download_status to 'complete'
+                        self.update_download_status(series_instance_uid, 'complete')
+                        return True
+                else:
+                    self.limiter.penalize()
+                    print(f"Association rejected, aborted or never connected for SeriesInstanceUID: {series_instance_uid}")
+
+            except (AttributeError, RuntimeError) as e:
+                # pynetdicom raises RuntimeError for requests on an association the PACS dropped
+                if isinstance(e, RuntimeError):
+                    self.limiter.penalize()
+                print(f"{type(e).__name__} for SeriesInstanceUID {series_instance_uid}: {e}")
+                self.disk_writer.wait(series_instance_uid)
+                self.flush_manifest()
+                self.save_progress(series_instance_uid)
+
+            retries += 1
+            if retries < max_retries:
+                print(f"Retrying in {wait_time} seconds... (Attempt {retries}/{max_retries})")
+                time.sleep(wait_time)
+
+        print(f"Failed to download series {series_instance_uid} after {max_retries} attempts")
+        return False
+
+    def update_download_status(self, series_instance_uid, status):
+        """Update the download status in the PostgreSQL database and drop the lease."""
+        with self.db_lock:
+            self.cur.execute("""
+                UPDATE fieldsite.series
+                SET download_status = %s, download_attempts = 0, lease_owner = NULL, lease_expires = NULL,
+                    date_modified = CURRENT_TIMESTAMP
+                WHERE seriesinstanceuid = %s
+            """, (status, series_instance_uid))
+            self.conn.commit()
+        self.drop_series(series_instance_uid)
+
+    def rollback(self):
+        """Roll back what a failed statement left of the shared connection's transaction.
+
+        If the connection was lost it is opened again, the new manifest writer
+        takes over the rows the old one had not written yet.
+        """
+        with self.db_lock:
+            if not self.conn.closed:
+                try:
+                    self.conn.rollback()
+                    return
+                except psycopg2.Error:
+                    pass
+            rows = self.manifest_writer.rows
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.connect()
+            self.manifest_writer.rows = rows
+
+    def release_series(self, series_instance_uid, failed=False):
+        """Hand a series held by this worker back so any downloader can claim it again.
+
+        With failed the series counts a failed download, and once max_attempts
+        downloads failed it is marked 'failed' instead of being claimed again.
+        """
+        with self.db_lock:
+            self.cur.execute("""
+                UPDATE fieldsite.series
+                SET download_attempts = download_attempts + %(failed)s,
+                    download_status = CASE WHEN download_attempts + %(failed)s >= %(max_attempts)s THEN 'failed' END,
+                    lease_owner = NULL, lease_expires = NULL, date_modified = CURRENT_TIMESTAMP
+                WHERE seriesinstanceuid = %(uid)s AND lease_owner = %(worker)s
+                RETURNING download_status, download_attempts
+            """, {'failed': int(failed), 'max_attempts': self.max_attempts,
+                  'uid': series_instance_uid, 'worker': self.worker_id})
+            released = self.cur.fetchone()
+            self.conn.commit()
+        self.drop_series(series_instance_uid)
+        if released is not None and released[0] == 'failed':
+            print(f"{current_timestamp()} FAILED: SeriesInstanceUID {series_instance_uid} after "
+                  f"{released[1]} failed downloads, it is not claimed again")
+
+    def renew_leases(self, series_instance_uids):
+        """Extend the leases of this worker and return the series it still holds."""
+        with self.db_lock:
+            self.cur.execute("""
+                UPDATE fieldsite.series
+                SET lease_expires = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+                WHERE seriesinstanceuid = ANY(%s) AND lease_owner = %s
+                RETURNING seriesinstanceuid
+            """, (self.lease_seconds, list(series_instance_uids), self.worker_id))
+            renewed = {row[0] for row in self.cur.fetchall()}
+            self.conn.commit()
+        return renewed
+
+    def claim_series(self, limit, series_instance_uids=None):
+        """Lease up to `limit` pending series, or series whose lease expired, and return them.
+
+        If series_instance_uids is given only those series are claimed.
+        """
+        with self.db_lock:
+            self.cur.execute(CLAIM_SERIES, {
+                'worker': self.worker_id,
+                'lease': self.lease_seconds,
+                'limit': limit,
+                'uids': list(series_instance_uids) if series_instance_uids is not None else None
+            })
+            claimed = self.cur.fetchall()
+            self.conn.commit()
+        for series_info in claimed:
+            self.touch_series(series_info[0])
+        return claimed
+
+    def heartbeat(self):
+        """Renew the leases of series that are queued or still receiving instances."""
+        while not self.stop_heartbeat.wait(self.heartbeat_seconds):
+            now = time.monotonic()
+            with self.held_lock:
+                active = [uid for uid, last_seen in self.held_series.items() if now - last_seen < self.lease_seconds]
+            if active:
+                try:
+                    lost = set(active) - self.renew_leases(active)
+                except psycopg2.Error as e:
+                    # Keep renewing once the database is back, the leases survive a missed beat
+                    print(f"{current_timestamp()} Could not renew leases: {e}")
+                    try:
+                        self.rollback()
+                    except psycopg2.Error:
+                        pass
+                    continue
+                for series_instance_uid in lost:
+                    print(f"{current_timestamp()} Lease lost for SeriesInstanceUID: {series_instance_uid}")
+
+    def start(self):
+        """Start the heartbeat thread that renews the leases and, for C-MOVE, the Storage SCP."""
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, name="heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+        if self.retrieve == 'move':
+            self.server = self.scp_ae.start_server(('', self.move_port), block=False, evt_handlers=self.handlers)
+            print(f"{current_timestamp()} Storage SCP {self.move_aet} listening on port {self.move_port}")
+
+    def listen(self):
+        """LISTEN for pending series on a separate autocommit connection.
+
+        Call this before looking for work, so a notification sent between an
+        empty claim and wait_for_series() is not lost.
+        """
+        self.listen_conn = psycopg2.connect(
+            dbname=self.db_credentials['dbname'],
+            user=self.db_credentials['user'],
+            password=self.db_credentials['password'],
+            host=self.db_credentials['host'],
+            port=self.db_credentials['port']
+        )
+        self.listen_conn.autocommit = True
+        with self.listen_conn.cursor() as cur:
+            cur.execute(f"LISTEN {PENDING_CHANNEL}")
+
+    def wait_for_series(self, timeout):
+        """Block until series become pending or timeout seconds passed, return True if notified.
+
+        The timeout is the fallback poll for work that sends no notification,
+        such as leases expiring. If the connection was lost it is opened again
+        and True is returned, since notifications may have been missed meanwhile.
+        """
+        try:
+            if self.listen_conn is None or self.listen_conn.closed:
+                self.listen()
+                return True
+            if select.select([self.listen_conn], [], [], timeout) == ([], [], []):
+                return False
+            self.listen_conn.poll()
+            notified = bool(self.listen_conn.notifies)
+            self.listen_conn.notifies.clear()
+            return notified
+        except (psycopg2.Error, OSError) as e:
+            print(f"{current_timestamp()} Lost the notification connection: {e}")
+            if self.listen_conn is not None:
+                self.listen_conn.close()
+            self.listen_conn = None
+            time.sleep(min(timeout, 30))
+            return False
+
+    def download(self, series_info):
+        """Download a claimed series and return True once it is complete.
+
+        series_info is a row returned by claim_series. Series that fail are
+        released so that any downloader can claim them again.
+        """
+        series_instance_uid, series_name, patient_id, study_instance_uid, numimages = series_info
+
+        # Another downloader may have taken over if the series waited in a queue past its lease
+        if not self.renew_leases([series_instance_uid]):
+            print(f"{current_timestamp()} SKIP: {patient_id} - {series_name} - lease taken over by another worker")
+            self.drop_series(series_instance_uid)
+            return False
+
+        self.touch_series(series_instance_uid)
+        print(f"{current_timestamp()} START: {patient_id} - {series_name} - {numimages}")
+
+        complete = self.download_series(patient_id, study_instance_uid, series_instance_uid, series_name)
+        if not complete:
+            self.release_series(series_instance_uid, failed=True)
+
+        print(f"{current_timestamp()} END: {patient_id} - {series_name} - {numimages}")
+        return complete
+
+    def close(self):
+        """Write every queued instance, stop the heartbeat and the Storage SCP and close the database connection."""
+        self.stop_heartbeat.set()
+        if self.server is not None:
+            self.server.shutdown()
+        if self.listen_conn is not None:
+            self.listen_conn.close()
+        self.disk_writer.close()
+        self.flush_manifest()
+        self.limiter.close()
+        self.cur.close()
+        self.conn.close()
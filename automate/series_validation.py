@@ -0,0 +1,217 @@
+import os
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from psycopg2 import extras
+from pydicom import dcmread
+from tqdm import tqdm
+
+from slice_geometry import check_slice_geometry
+from queries import VALIDATE_FROM_MANIFEST, SERIES_TO_VALIDATE
+
+# Only these tags are read from each file, the pixel data is never loaded
+HEADER_TAGS = ['SeriesInstanceUID', 'NumberOfFrames']
+GEOMETRY_TAGS = HEADER_TAGS + ['ImagePositionPatient', 'ImageOrientationPatient', 'InstanceNumber']
+
+def get_downloaded_images_count(series_dir):
+    """Count the slices in the given series directory per SeriesInstanceUID from the file headers.
+
+    Returns None if the directory does not exist. Several series with the same
+    description share a directory, so the counts are keyed by SeriesInstanceUID.
+    """
+    if not os.path.exists(series_dir):
+        return None
+
+    counts = defaultdict(int)
+    for filename in os.listdir(series_dir):
+        if filename.endswith('.dcm'):
+            filepath = os.path.join(series_dir, filename)
+            try:
+                ds = dcmread(filepath, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+            except Exception as e:
+                # Unreadable files are not counted so the series fails validation
+                print(f"Error reading {filepath}: {e}")
+                continue
+            if getattr(ds, 'NumberOfFrames', None):
+                counts[ds.SeriesInstanceUID] += int(ds.NumberOfFrames)
+            else:
+                counts[ds.SeriesInstanceUID] += 1
+    return dict(counts)
+
+def get_series_geometry(series_dir):
+    """Read the slice count and the geometry of every slice in the given series directory.
+
+    Returns None if the directory does not exist, otherwise a dict keyed by
+    SeriesInstanceUID with the frame count and one (x, y, z, orientation...,
+    InstanceNumber) row per slice. Series with multi-frame files or slices
+    without a position have their slices set to None.
+    """
+    if not os.path.exists(series_dir):
+        return None
+
+    series = {}
+    for filename in os.listdir(series_dir):
+        if filename.endswith('.dcm'):
+            filepath = os.path.join(series_dir, filename)
+            try:
+                ds = dcmread(filepath, stop_before_pixels=True, specific_tags=GEOMETRY_TAGS)
+            except Exception as e:
+                # Unreadable files are not counted so the series fails validation
+                print(f"Error reading {filepath}: {e}")
+                continue
+            entry = series.setdefault(ds.SeriesInstanceUID, {'frames': 0, 'slices': []})
+            frames = int(ds.NumberOfFrames) if getattr(ds, 'NumberOfFrames', None) else 1
+            entry['frames'] += frames
+
+            position = getattr(ds, 'ImagePositionPatient', None)
+            orientation = getattr(ds, 'ImageOrientationPatient', None)
+            if entry['slices'] is None:
+                continue
+            if frames > 1 or position is None or orientation is None or len(position) != 3 or len(orientation) != 6:
+                entry['slices'] = None
+                continue
+            instance_number = getattr(ds, 'InstanceNumber', None)
+            entry['slices'].append(tuple(float(value) for value in position)
+                                   + tuple(float(value) for value in orientation)
+                                   + (float(instance_number) if instance_number is not None else float('nan'),))
+    return series
+
+def check_geometry(candidates, tolerance):
+    """Run the vectorized slice geometry check over many series and return the problems of each series.
+
+    candidates maps SeriesInstanceUID to (slices, spacing_between_slices).
+    """
+    uids = list(candidates)
+    slices = np.concatenate([np.asarray(candidates[uid][0], dtype=np.float64) for uid in uids])
+    series_index = np.repeat(np.arange(len(uids)), [len(candidates[uid][0]) for uid in uids])
+    expected_spacing = np.array([parse_spacing(candidates[uid][1]) for uid in uids])
+
+    result = check_slice_geometry(series_index, slices[:, 0:3], slices[:, 3:9], slices[:, 9],
+                                  expected_spacing, tolerance)
+
+    problems = {}
+    for i, uid in enumerate(uids):
+        found = []
+        if result['missing'][i]:
+            found.append(f"{result['missing'][i]} missing")
+        if result['duplicates'][i]:
+            found.append(f"{result['duplicates'][i]} duplicated")
+        if result['uneven'][i]:
+            found.append(f"{result['uneven'][i]} uneven steps (spacing {result['spacing'][i]:.3g})")
+        if found:
+            problems[uid] = found
+    return problems
+
+def parse_spacing(value):
+    """Return spacing_between_slices as a float, NaN if it is empty or not a number."""
+    try:
+        return abs(float(value))
+    except (TypeError, ValueError):
+        return float('nan')
+
+def validate_from_manifest(conn, cur, skip_modalities=(), series_instance_uids=None):
+    """Validate every series the downloader recorded a manifest for without touching the files.
+
+    Series of skip_modalities are left for the slice geometry check, which needs the file headers.
+    If series_instance_uids is given only those series are validated.
+    """
+    cur.execute(VALIDATE_FROM_MANIFEST, {
+        'skip': list(skip_modalities),
+        'uids': list(series_instance_uids) if series_instance_uids is not None else None
+    })
+    validated = cur.fetchall()
+    conn.commit()
+    return validated
+
+def update_validation_statuses(conn, cur, statuses):
+    """Write the validation status of many series with a single UPDATE ... FROM (VALUES ...)."""
+    if not statuses:
+        return
+    extras.execute_values(cur, """
+        UPDATE fieldsite.series s
+        SET validation = v.status, date_modified = CURRENT_TIMESTAMP
+        FROM (VALUES %s) AS v(seriesinstanceuid, status)
+        WHERE s.seriesinstanceuid = v.seriesinstanceuid
+    """, statuses, page_size=10000)
+    conn.commit()
+
+def series_to_validate(cur, series_instance_uids=None):
+    """Return the downloaded series that were not validated yet, optionally only the given ones."""
+    cur.execute(SERIES_TO_VALIDATE, {'uids': list(series_instance_uids) if series_instance_uids is not None else None})
+    return cur.fetchall()
+
+def validate_from_headers(series_rows, storage_dir, workers=None, geometry=False, geometry_modalities=(),
+                          tolerance=0.1, progress=True):
+    """Validate series by reading the headers of their files.
+
+    series_rows are rows of series_to_validate. Returns the status of every
+    series keyed by SeriesInstanceUID, the missing slices report and the
+    slice geometry report.
+    """
+    # Group the series by the directory the downloader wrote them to
+    series_by_dir = defaultdict(list)
+    for series_instance_uid, patient_id, series_name, expected_num_images, modality, spacing in series_rows:
+        series_dir = os.path.join(storage_dir, patient_id, series_name or 'Unknown_Series')
+        series_by_dir[series_dir].append((series_instance_uid, patient_id, series_name, expected_num_images,
+                                          modality, spacing))
+
+    statuses = {}
+    missing_slices_report = []
+    geometry_report = []
+    geometry_candidates = {}
+    series_info = {}
+
+    # Read the headers of each directory in parallel and compare the downloaded images count with the expected number of images
+    read_headers = get_series_geometry if geometry else get_downloaded_images_count
+    # The pipeline calls this from a process running many threads, forking it could copy a lock
+    # another thread holds into the workers, so they are started by a fork server instead
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+        futures = {executor.submit(read_headers, series_dir): series_dir for series_dir in series_by_dir}
+        with tqdm(total=len(futures), desc="Checking series directories", unit="dir", disable=not progress) as pbar:
+            for future in as_completed(futures):
+                series_dir = futures[future]
+                headers = future.result()
+
+                if headers is None:
+                    print(f"Directory does not exist: {series_dir}")
+
+                for series_instance_uid, patient_id, series_name, expected_num_images, modality, spacing in series_by_dir[series_dir]:
+                    found = headers.get(series_instance_uid) if headers is not None else None
+                    if geometry:
+                        downloaded_num_images = found['frames'] if found else 0
+                    else:
+                        downloaded_num_images = found or 0
+
+                    if headers is None or downloaded_num_images < (expected_num_images or 0):
+                        missing_slices_report.append({
+                            "patient_id": patient_id,
+                            "series_name": series_name,
+                            "expected_num_images": expected_num_images,
+                            "downloaded_num_images": downloaded_num_images
+                        })
+                        statuses[series_instance_uid] = 'failed'
+                    else:
+                        statuses[series_instance_uid] = 'complete'
+                        # Stacks with a position for every slice are checked together once all headers are read
+                        if modality in geometry_modalities and found and found['slices'] and len(found['slices']) > 1:
+                            geometry_candidates[series_instance_uid] = (found['slices'], spacing)
+                            series_info[series_instance_uid] = (patient_id, series_name)
+
+                pbar.update(1)
+
+    # Series that have every slice can still have gaps filled by duplicates
+    if geometry_candidates:
+        problems = check_geometry(geometry_candidates, tolerance)
+        for series_instance_uid, found in problems.items():
+            statuses[series_instance_uid] = 'failed_geometry'
+            patient_id, series_name = series_info[series_instance_uid]
+            geometry_report.append({
+                "patient_id": patient_id,
+                "series_name": series_name,
+                "problems": ', '.join(found)
+            })
+        print(f"Checked the slice geometry of {len(geometry_candidates)} series")
+
+    return statuses, missing_slices_report, geometry_report
@@ -0,0 +1,95 @@
+import numpy as np
+
+# Slices closer than this many millimetres along the normal are at the same position
+DUPLICATE_EPSILON = 1e-3
+
+
+def _group_starts(counts):
+    """Return the index of the first element of each group of a grouped array."""
+    starts = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    return starts
+
+
+def check_slice_geometry(series_index, positions, orientations, instance_numbers, expected_spacing, tolerance=0.1):
+    """Check the slice stacks of many series at once.
+
+    All arrays hold one entry per slice and are grouped by series_index, which
+    numbers the series from 0. positions is (n, 3) ImagePositionPatient,
+    orientations is (n, 6) ImageOrientationPatient and expected_spacing holds
+    one spacing_between_slices per series, NaN where it is unknown. Unknown
+    spacings fall back to the median of the non-zero distances between
+    neighbouring slices.
+
+    Slices are projected onto the normal of the first slice of their series
+    and sorted along it, so every check is a handful of array operations over
+    all series together instead of a Python loop per series.
+
+    Returns a dict of per series arrays: missing (slices missing from gaps),
+    duplicates (slices at the same position or with the same InstanceNumber),
+    uneven (steps that are neither a gap nor the expected spacing) and mixed
+    (True if the slices do not share one orientation and were not checked).
+    """
+    series_index = np.asarray(series_index, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.float64)
+    orientations = np.asarray(orientations, dtype=np.float64)
+    instance_numbers = np.asarray(instance_numbers, dtype=np.float64)
+    expected_spacing = np.asarray(expected_spacing, dtype=np.float64)
+    n_series = len(expected_spacing)
+
+    counts = np.bincount(series_index, minlength=n_series)
+    first = _group_starts(counts)[series_index]
+
+    # A stack has one orientation, anything else (localizers, multi-planar series) is left alone
+    tilted = np.abs(orientations - orientations[first]).max(axis=1) > 1e-4
+    mixed = np.bincount(series_index, weights=tilted, minlength=n_series) > 0
+
+    # Distance of every slice along the normal of the first slice of its series
+    normals = np.cross(orientations[:, :3], orientations[:, 3:])
+    distance = np.einsum('ij,ij->i', positions, normals[first])
+
+    order = np.lexsort((distance, series_index))
+    same_series = series_index[order][1:] == series_index[order][:-1]
+    steps = np.diff(distance[order])[same_series]
+    step_series = series_index[order][1:][same_series]
+
+    # Steps of (almost) zero are duplicates whatever the spacing, and are left out of the median
+    zero_step = steps < DUPLICATE_EPSILON
+
+    # Lower median of the non-zero steps of each series for series without a known spacing
+    step_counts = np.bincount(step_series[~zero_step], minlength=n_series)
+    sorted_steps = steps[~zero_step][np.lexsort((steps[~zero_step], step_series[~zero_step]))]
+    median = np.full(n_series, np.nan)
+    has_steps = step_counts > 0
+    median[has_steps] = sorted_steps[_group_starts(step_counts)[has_steps] + (step_counts[has_steps] - 1) // 2]
+
+    spacing = np.where(np.isfinite(expected_spacing) & (expected_spacing > 0), expected_spacing, median)
+    step_spacing = spacing[step_series]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = steps / step_spacing
+    # Series without any spacing only have zero steps, which are counted as duplicates below
+    ratio = np.where(np.isfinite(ratio), ratio, 1.0)
+    duplicate_step = zero_step | (ratio < tolerance)
+    gap_step = ~duplicate_step & (ratio > 1.5)
+    uneven_step = ~duplicate_step & ~gap_step & (np.abs(ratio - 1) > tolerance)
+    missing_step = np.where(gap_step, np.rint(ratio) - 1, 0)
+
+    # InstanceNumber must be unique within a series as well
+    by_number = np.lexsort((instance_numbers, series_index))
+    same_number = ((series_index[by_number][1:] == series_index[by_number][:-1])
+                   & (instance_numbers[by_number][1:] == instance_numbers[by_number][:-1]))
+    number_duplicates = np.bincount(series_index[by_number][1:][same_number], minlength=n_series)
+
+    missing = np.bincount(step_series, weights=missing_step, minlength=n_series).astype(np.int64)
+    duplicates = np.bincount(step_series, weights=duplicate_step, minlength=n_series).astype(np.int64)
+    uneven = np.bincount(step_series, weights=uneven_step, minlength=n_series).astype(np.int64)
+
+    checked = ~mixed
+    return {
+        'missing': np.where(checked, missing, 0),
+        'duplicates': np.where(checked, np.maximum(duplicates, number_duplicates), 0),
+        'uneven': np.where(checked, uneven, 0),
+        'mixed': mixed,
+        'spacing': spacing,
+    }
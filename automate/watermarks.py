@@ -0,0 +1,37 @@
+import argparse
+from datetime import timedelta
+
+
+def discovery_settings(credentials, description):
+    """Parse the command line and return the incremental discovery settings.
+
+    Incremental mode is on by default and can be turned off with
+    discovery.incremental in the config or --full on the command line.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--full', action='store_true',
+                        help="Query every entity again and ignore the last checked watermarks")
+    args = parser.parse_args()
+    return load_discovery_settings(credentials, full=args.full)
+
+
+def load_discovery_settings(credentials, full=False):
+    """Return the incremental discovery settings of the config, with incremental mode off if full is set."""
+    settings = {
+        'incremental': True,
+        'refresh_days': 30,
+        'active_days': 14,
+        'date_range_matching': False,
+        'date_overlap_days': 2,
+    }
+    settings.update(credentials.get('discovery', {}))
+    if full:
+        settings['incremental'] = False
+    return settings
+
+
+def date_range_since(last_checked, overlap_days):
+    """Return an open ended DICOM date range starting overlap_days before last_checked."""
+    start = last_checked - timedelta(days=overlap_days)
+    return f"{start:%Y%m%d}-"
+
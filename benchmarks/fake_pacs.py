@@ -0,0 +1,316 @@
+import argparse
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import (
+    CTImageStorage,
+    PatientRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelGet,
+    PatientRootQueryRetrieveInformationModelMove,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+)
+
+
+def uid(*parts):
+    """Return a UID that is the same for the same parts on every run."""
+    return generate_uid(entropy_srcs=['fake-pacs'] + [str(part) for part in parts])
+
+
+class FakePACS:
+    """Query/Retrieve SCP serving a synthetic archive for the benchmarks.
+
+    The archive has `patients` patients with `studies` studies of `series`
+    CT series each, and every series has `slices` slices of rows x columns
+    pixels. Patient IDs match detect_thlhp_patient() in discovery.py.
+
+    C-MOVE sends to the (address, port) of the destination AE title in
+    destinations.
+
+    latency is added to every C-FIND, C-GET and C-MOVE request and bandwidth (bytes
+    per second, shared by all associations) caps how fast instances are sent.
+    Like the production PACS, once more than requests_per_minute
+    associations and requests arrive within a minute the association is
+    aborted, which the scripts see as a connection reset.
+    """
+
+    def __init__(self, patients=10, studies=2, series=3, slices=50, rows=64, columns=64,
+                 latency=0.0, bandwidth=None, requests_per_minute=700, ae_title='FAKEPACS', destinations=None):
+        self.slices = slices
+        self.rows = rows
+        self.columns = columns
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests_per_minute = requests_per_minute
+        self.ae_title = ae_title
+        # C-MOVE destinations, (address, port) keyed by AE title
+        self.destinations = destinations or {}
+
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.requests = 0
+        self.aborts = 0
+        self.instances_sent = 0
+        self.bytes_sent = 0
+        self.send_after = time.monotonic()
+
+        # Only the hierarchy is kept in memory, instances are built when they are retrieved
+        self.patients = []
+        for p in range(patients):
+            patient_id = f"{1000 + p:04d}-BENCH"
+            patient_studies = []
+            for s in range(studies):
+                study_uid = uid(patient_id, s)
+                patient_series = [(uid(study_uid, n), n + 1) for n in range(series)]
+                patient_studies.append((study_uid, f"2024{(s % 12) + 1:02d}15", patient_series))
+            self.patients.append((patient_id, patient_studies))
+
+        self.pixel_data = (np.arange(rows * columns, dtype=np.uint16) % 4096).tobytes()
+        self.server = None
+
+    def counters(self):
+        """Return a snapshot of the request, abort, instance and byte counters."""
+        with self.lock:
+            return {'requests': self.requests, 'aborts': self.aborts,
+                    'instances': self.instances_sent, 'bytes': self.bytes_sent}
+
+    def _over_limit(self):
+        """Count a request and return True if it exceeds the requests per minute."""
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            self.recent.append(now)
+            while self.recent and self.recent[0] < now - 60:
+                self.recent.popleft()
+            if self.requests_per_minute and len(self.recent) > self.requests_per_minute:
+                self.aborts += 1
+                return True
+        return False
+
+    def _throttle(self, size):
+        """Sleep until size bytes fit into the bandwidth shared by all associations."""
+        with self.lock:
+            self.instances_sent += 1
+            self.bytes_sent += size
+            if not self.bandwidth:
+                return
+            now = time.monotonic()
+            start = max(self.send_after, now)
+            self.send_after = start + size / self.bandwidth
+            delay = self.send_after - now
+        time.sleep(delay)
+
+    def instance(self, patient_id, study_uid, study_date, series_uid, series_number, i):
+        """Build slice i of a series."""
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+        ds.file_meta.MediaStorageSOPInstanceUID = uid(series_uid, i)
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.PatientID = patient_id
+        ds.PatientName = f"BENCH^{patient_id}"
+        ds.StudyInstanceUID = study_uid
+        ds.StudyDate = study_date
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesNumber = series_number
+        ds.SeriesDescription = f"Bench Series {series_number}"
+        ds.Modality = 'CT'
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(i)]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.SpacingBetweenSlices = 1.0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.Rows = self.rows
+        ds.Columns = self.columns
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.PixelData = self.pixel_data
+        return ds
+
+    def _matches(self, identifier, level=None):
+        """Yield the keys of every entity matching an identifier down to the given level.
+
+        level defaults to the QueryRetrieveLevel of the identifier, C-GET and C-MOVE ask
+        for the IMAGE level to get every instance below a patient, study or series.
+        """
+        level = level or identifier.QueryRetrieveLevel
+        wanted_patient = identifier.get('PatientID') or None
+        wanted_study = identifier.get('StudyInstanceUID') or None
+        wanted_series = identifier.get('SeriesInstanceUID') or None
+        wanted_instances = identifier.get('SOPInstanceUID') or None
+        if isinstance(wanted_instances, str):
+            wanted_instances = [wanted_instances]
+        wanted_instances = set(wanted_instances) if wanted_instances else None
+
+        for patient_id, studies in self.patients:
+            if wanted_patient and wanted_patient != patient_id:
+                continue
+            if level == 'PATIENT':
+                yield patient_id, None, None, None, None, None
+                continue
+            for study_uid, study_date, series in studies:
+                if wanted_study and wanted_study != study_uid:
+                    continue
+                if level == 'STUDY':
+                    yield patient_id, study_uid, study_date, None, None, None
+                    continue
+                for series_uid, series_number in series:
+                    if wanted_series and wanted_series != series_uid:
+                        continue
+                    if level == 'SERIES':
+                        yield patient_id, study_uid, study_date, series_uid, series_number, None
+                        continue
+                    for i in range(self.slices):
+                        if wanted_instances and uid(series_uid, i) not in wanted_instances:
+                            continue
+                        yield patient_id, study_uid, study_date, series_uid, series_number, i
+
+    def handle_find(self, event):
+        """Answer C-FIND requests at the PATIENT, STUDY, SERIES and IMAGE levels."""
+        if self._over_limit():
+            event.assoc.abort()
+            return
+        time.sleep(self.latency)
+
+        identifier = event.identifier
+        for patient_id, study_uid, study_date, series_uid, series_number, i in self._matches(identifier):
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            ds = Dataset()
+            ds.QueryRetrieveLevel = identifier.QueryRetrieveLevel
+            ds.PatientID = patient_id
+            ds.PatientName = f"BENCH^{patient_id}"
+            ds.PatientSex = 'O'
+            if study_uid:
+                ds.StudyInstanceUID = study_uid
+                ds.StudyDate = study_date
+                ds.StudyTime = '120000'
+                # studies.studyid is the primary key, so every study needs its own StudyID
+                ds.StudyID = study_uid[-16:]
+                ds.AccessionNumber = study_uid[-12:]
+            if series_uid:
+                ds.SeriesInstanceUID = series_uid
+                ds.SeriesNumber = series_number
+                ds.SeriesDate = study_date
+                ds.SeriesTime = '120000'
+                ds.Modality = 'CT'
+                ds.SeriesDescription = f"Bench Series {series_number}"
+                ds.NumberOfSeriesRelatedInstances = self.slices
+                ds.SpacingBetweenSlices = 1.0
+            if i is not None:
+                ds.SOPInstanceUID = uid(series_uid, i)
+            yield 0xFF00, ds
+
+    def handle_get(self, event):
+        """Send the instances matching a C-GET request back over the same association."""
+        if self._over_limit():
+            event.assoc.abort()
+            return
+        time.sleep(self.latency)
+
+        matches = list(self._matches(event.identifier, 'IMAGE'))
+        yield len(matches)
+        for match in matches:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            ds = self.instance(*match)
+            self._throttle(len(self.pixel_data))
+            yield 0xFF00, ds
+
+    def handle_move(self, event):
+        """Send the instances matching a C-MOVE request over a new association to the destination."""
+        if self._over_limit():
+            event.assoc.abort()
+            return
+        time.sleep(self.latency)
+
+        destination = self.destinations.get(event.move_destination.strip())
+        if destination is None:
+            yield None, None
+            return
+        yield destination[0], destination[1]
+
+        matches = list(self._matches(event.identifier, 'IMAGE'))
+        yield len(matches)
+        for match in matches:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            ds = self.instance(*match)
+            self._throttle(len(self.pixel_data))
+            yield 0xFF00, ds
+
+    def handle_open(self, event):
+        """Reset connections once the request budget of the last minute is used up."""
+        if self._over_limit():
+            event.assoc.abort()
+
+    def start(self, port=11112, address='127.0.0.1', block=False):
+        """Start serving, in the background unless block is set."""
+        ae = AE(ae_title=self.ae_title)
+        ae.maximum_associations = 64
+        for context in (PatientRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelFind,
+                        PatientRootQueryRetrieveInformationModelGet, StudyRootQueryRetrieveInformationModelGet,
+                        PatientRootQueryRetrieveInformationModelMove, StudyRootQueryRetrieveInformationModelMove):
+            ae.add_supported_context(context)
+        # C-GET sends the instances over the requestor's association, which takes the Storage SCP role
+        ae.add_supported_context(CTImageStorage, scu_role=False, scp_role=True)
+        # C-MOVE opens its own association to the destination's Storage SCP
+        ae.add_requested_context(CTImageStorage)
+
+        handlers = [
+            (evt.EVT_C_FIND, self.handle_find),
+            (evt.EVT_C_GET, self.handle_get),
+            (evt.EVT_C_MOVE, self.handle_move),
+            (evt.EVT_REQUESTED, self.handle_open),
+        ]
+        self.server = ae.start_server((address, port), block=block, evt_handlers=handlers)
+        return self.server
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a synthetic PACS for the benchmarks")
+    parser.add_argument('--port', type=int, default=11112)
+    parser.add_argument('--ae-title', default='FAKEPACS')
+    parser.add_argument('--patients', type=int, default=10)
+    parser.add_argument('--studies', type=int, default=2, help="Studies per patient")
+    parser.add_argument('--series', type=int, default=3, help="Series per study")
+    parser.add_argument('--slices', type=int, default=50, help="Slices per series")
+    parser.add_argument('--rows', type=int, default=64)
+    parser.add_argument('--columns', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument('--bandwidth', type=float, default=None, help="Bytes per second shared by all associations")
+    parser.add_argument('--requests-per-minute', type=int, default=700,
+                        help="Associations and requests per minute before connections are reset, 0 for no limit")
+    parser.add_argument('--move-destination', action='append', default=[], metavar='AET=HOST:PORT',
+                        help="C-MOVE destination, can be given several times")
+    args = parser.parse_args()
+
+    destinations = {}
+    for destination in args.move_destination:
+        ae_title, _, address = destination.partition('=')
+        host, _, port = address.rpartition(':')
+        destinations[ae_title] = (host, int(port))
+
+    pacs = FakePACS(args.patients, args.studies, args.series, args.slices, args.rows, args.columns,
+                    args.latency, args.bandwidth, args.requests_per_minute, args.ae_title, destinations)
+    print(f"Serving {args.patients} patients as {args.ae_title} on port {args.port}")
+    pacs.start(args.port, '0.0.0.0', block=True)
@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+from fake_pacs import FakePACS
+
+self_dir = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.dirname(self_dir)
+automate_dir = os.path.join(repo_dir, 'automate')
+
+# Stages in the order they run, each is one script run against the fake PACS and the benchmark database
+STAGES = [
+    ('patients', '01_db_insert_patients.py', []),
+    ('studies', '02_db_insert_studies.py', ['--full']),
+    ('series', '03_db_insert_series.py', ['--full']),
+    ('download', '04_db_downloading_dicoms.py', []),
+    ('validate', '06_validate_slices.py', ['--geometry']),
+    ('package', '05_db_compress_dicoms.py', []),
+    ('inventory', '07_dicom_inventory_generator.py', ['--full']),
+    ('organize', '08_organizer.py', []),
+]
+
+# Throughput metrics regress when they drop, cost metrics when they grow
+HIGHER_IS_BETTER = ('requests_per_s', 'instances_per_s', 'mb_per_s')
+LOWER_IS_BETTER = ('seconds', 'cpu_seconds', 'peak_rss_mb')
+
+def reset_database(config_path, db_credentials):
+    """Drop the fieldsite schema of the benchmark database and recreate it with the migrations."""
+    conn = psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['user'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+    cur = conn.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS fieldsite CASCADE")
+    conn.commit()
+    cur.close()
+    conn.close()
+    subprocess.run([sys.executable, 'migrate.py'], cwd=automate_dir, check=True,
+                   env=dict(os.environ, DICOM_DOWNLOADER_CONFIG=config_path))
+
+def directory_size(path):
+    """Return the number of files and bytes below path."""
+    files = 0
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+def run_stage(script, script_args, env, log_path):
+    """Run one script and return its exit code, wall time and resource usage."""
+    with open(log_path, 'w') as log:
+        start = time.monotonic()
+        process = subprocess.Popen([sys.executable, script] + script_args, cwd=automate_dir, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        # wait4 returns the resource usage of the script including the worker processes it started
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, elapsed, usage
+
+def compare(results, baseline, tolerance):
+    """Return a line for every metric that is worse than the baseline by more than tolerance."""
+    regressions = []
+    for stage, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(stage, {}).get(metric)
+            if not previous or value is None:
+                continue
+            if metric in HIGHER_IS_BETTER and value < previous * (1 - tolerance):
+                regressions.append(f"{stage} {metric}: {value:.2f} < {previous:.2f}")
+            elif metric in LOWER_IS_BETTER and value > previous * (1 + tolerance):
+                regressions.append(f"{stage} {metric}: {value:.2f} > {previous:.2f}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run every pipeline stage against a fake PACS and report its throughput")
+    parser.add_argument('--config', default=os.path.join(automate_dir, 'config.json'),
+                        help="Config whose database section points at the benchmark database")
+    parser.add_argument('--reset-db', action='store_true',
+                        help="Drop the fieldsite schema of the benchmark database and migrate it from scratch first")
+    parser.add_argument('--stages', default=','.join(stage for stage, _, _ in STAGES),
+                        help="Comma separated stages to run")
+    parser.add_argument('--workdir', default=None, help="Directory for downloads and outputs, a new temporary directory by default")
+    parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, help="Compare against the results JSON of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative regression against the baseline")
+    parser.add_argument('--port', type=int, default=11112)
+    parser.add_argument('--retrieve', choices=['get', 'move'], default='get',
+                        help="Download with C-GET, or with C-MOVE to the downloader's Storage SCP")
+    parser.add_argument('--move-port', type=int, default=11113, help="Port of the downloader's Storage SCP for C-MOVE")
+    parser.add_argument('--patients', type=int, default=10)
+    parser.add_argument('--studies', type=int, default=2)
+    parser.add_argument('--series', type=int, default=3)
+    parser.add_argument('--slices', type=int, default=50)
+    parser.add_argument('--rows', type=int, default=256)
+    parser.add_argument('--columns', type=int, default=256)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=float, default=None)
+    parser.add_argument('--requests-per-minute', type=int, default=700,
+                        help="Fake PACS limit before connections are reset")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        base_config = json.load(f)
+    db_credentials = base_config['database']
+
+    # Dropping the schema of the production database would lose every download status
+    if args.reset_db:
+        if 'bench' not in db_credentials['dbname']:
+            sys.exit(f"Refusing to reset database {db_credentials['dbname']}, its name has to contain 'bench'")
+        reset_database(args.config, db_credentials)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dicom_downloader_bench_')
+    paths = {name: os.path.join(workdir, name) for name in ('download', 'compressed', 'organized', 'inventory')}
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+
+    # Same settings as the base config, pointed at the fake PACS and the work directory
+    config = dict(base_config)
+    config['pacs'] = dict(base_config.get('pacs', {}), ip='127.0.0.1', port=args.port, aet='FAKEPACS', local_aet='BENCH')
+    config['request_budget'] = dict(base_config.get('request_budget', {}), shared=False)
+    config['download'] = dict(base_config.get('download', {}), retrieve=args.retrieve, move_port=args.move_port)
+    config['path'] = {
+        'download': paths['download'] + '/',
+        'compressed': paths['compressed'] + '/',
+        'organized': paths['organized'],
+        'asu_path': paths['inventory'],
+        'studies_csv': os.path.join(workdir, 'studies_data.csv'),
+    }
+    config['delimiter'] = base_config.get('delimiter', '__seriesCount')
+    config['healthchecks'] = False
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    env = dict(os.environ, DICOM_DOWNLOADER_CONFIG=config_path)
+
+    pacs = FakePACS(args.patients, args.studies, args.series, args.slices, args.rows, args.columns,
+                    args.latency, args.bandwidth, args.requests_per_minute,
+                    destinations={'BENCH': ('127.0.0.1', args.move_port)})
+    pacs.start(args.port)
+    print(f"Fake PACS with {args.patients * args.studies * args.series} series of {args.slices} slices on port {args.port}, "
+          f"work directory {workdir}")
+
+    selected = args.stages.split(',')
+    results = {}
+    failed = False
+    try:
+        for stage, script, script_args in STAGES:
+            if stage not in selected:
+                continue
+            before = pacs.counters()
+            files, size = directory_size(paths['download'])
+
+            code, elapsed, usage = run_stage(script, script_args, env, os.path.join(workdir, f"{stage}.log"))
+
+            after = pacs.counters()
+            requests = after['requests'] - before['requests']
+            if stage == 'download':
+                instances, size = after['instances'] - before['instances'], after['bytes'] - before['bytes']
+            elif stage in ('validate', 'package', 'organize'):
+                instances = files
+            else:
+                instances, size = None, None
+
+            results[stage] = {
+                'seconds': elapsed,
+                'cpu_seconds': usage.ru_utime + usage.ru_stime,
+                'peak_rss_mb': usage.ru_maxrss / 1024,
+                'requests': requests,
+                'aborts': after['aborts'] - before['aborts'],
+                'requests_per_s': requests / elapsed if requests else None,
+                'instances_per_s': instances / elapsed if instances else None,
+                'mb_per_s': size / elapsed / 1e6 if size else None,
+            }
+            if code != 0:
+                print(f"{stage} exited with {code}, see {os.path.join(workdir, stage + '.log')}")
+                failed = True
+                break
+    finally:
+        pacs.stop()
+
+    # Print the report
+    print(f"{'stage':<10} {'seconds':>8} {'cpu s':>8} {'rss MB':>8} {'req/s':>8} {'inst/s':>8} {'MB/s':>8} {'aborts':>7}")
+    for stage, metrics in results.items():
+        row = [metrics['seconds'], metrics['cpu_seconds'], metrics['peak_rss_mb'],
+               metrics['requests_per_s'], metrics['instances_per_s'], metrics['mb_per_s']]
+        print(f"{stage:<10} " + ' '.join(f"{value:>8.1f}" if value is not None else f"{'-':>8}" for value in row)
+              + f" {metrics['aborts']:>7}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        failed = failed or bool(regressions)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,203 @@
+-- Baseline: the schema the scripts used before migrations were versioned.
+-- Every statement is idempotent, so databases created from any earlier
+-- schema.sql, or patched by hand, are brought to the same state.
+CREATE SCHEMA IF NOT EXISTS fieldsite;
+
+-- Create patients table
+CREATE TABLE IF NOT EXISTS fieldsite.patients (
+    patient_id VARCHAR PRIMARY KEY,
+    patient_name VARCHAR,
+    patient_sex VARCHAR,
+    date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    date_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Create studies table
+CREATE TABLE IF NOT EXISTS fieldsite.studies (
+    studyid VARCHAR(64) PRIMARY KEY,
+    patient_id VARCHAR(64) REFERENCES fieldsite.patients(patient_id) ON DELETE CASCADE,
+    study_datetime TIMESTAMP,
+    studyinstanceuid VARCHAR(64),
+    accession_number VARCHAR(64),
+    date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    date_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Create series table
+CREATE TABLE IF NOT EXISTS fieldsite.series (
+    series_id SERIAL PRIMARY KEY,
+    studyid VARCHAR(64) REFERENCES fieldsite.studies(studyid) ON DELETE CASCADE,
+    seriesinstanceuid VARCHAR(64) UNIQUE,
+    series_datetime TIMESTAMP,
+    seriesnumber INTEGER,
+    modality VARCHAR(16),
+    institutionname VARCHAR(255),
+    institutionaldepartmentname VARCHAR(255),
+    seriesdescription VARCHAR(255),
+    bodypartexamined VARCHAR(64),
+    numberofimages INTEGER,
+    date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    date_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE fieldsite.series
+ADD COLUMN IF NOT EXISTS download_status VARCHAR(16);
+
+-- Trigger to update date_modified column
+CREATE OR REPLACE FUNCTION update_modified_column()
+RETURNS TRIGGER AS $$
+BEGIN
+   NEW.date_modified = CURRENT_TIMESTAMP;
+   RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Trigger for patients table
+DROP TRIGGER IF EXISTS update_patients_modtime ON fieldsite.patients;
+CREATE TRIGGER update_patients_modtime
+BEFORE UPDATE ON fieldsite.patients
+FOR EACH ROW
+EXECUTE FUNCTION update_modified_column();
+
+-- Trigger for studies table
+DROP TRIGGER IF EXISTS update_studies_modtime ON fieldsite.studies;
+CREATE TRIGGER update_studies_modtime
+BEFORE UPDATE ON fieldsite.studies
+FOR EACH ROW
+EXECUTE FUNCTION update_modified_column();
+
+-- Trigger for series table
+DROP TRIGGER IF EXISTS update_series_modtime ON fieldsite.series;
+CREATE TRIGGER update_series_modtime
+BEFORE UPDATE ON fieldsite.series
+FOR EACH ROW
+EXECUTE FUNCTION update_modified_column();
+
+-- Create view for determining if all downloads are complete for a patient
+CREATE OR REPLACE VIEW fieldsite.series_download_status AS
+SELECT 
+    p.patient_id,
+    COUNT(s.series_id) AS total_series,
+    COUNT(CASE WHEN s.download_status = 'complete' THEN 1 END) AS series_downloaded,
+    ROUND(
+        COUNT(CASE WHEN s.download_status = 'complete' THEN 1 END)::numeric / COUNT(s.series_id) * 100, 2
+    ) AS percentage_downloaded
+FROM 
+    fieldsite.patients p
+JOIN 
+    fieldsite.studies st ON p.patient_id = st.patient_id
+JOIN 
+    fieldsite.series s ON st.studyid = s.studyid
+GROUP BY 
+    p.patient_id;
+
+
+-- Shared PACS request budget drawn from by every script that talks to the PACS
+CREATE TABLE IF NOT EXISTS fieldsite.pacs_request_budget (
+    name VARCHAR(64) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    capacity DOUBLE PRECISION NOT NULL,
+    rate_per_second DOUBLE PRECISION NOT NULL,
+    max_rate_per_second DOUBLE PRECISION NOT NULL,
+    refilled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    penalized_at TIMESTAMP
+);
+
+-- Watermarks recording when each patient ('patient') and study ('study') was last queried on the PACS
+CREATE TABLE IF NOT EXISTS fieldsite.discovery_watermarks (
+    level VARCHAR(16),
+    key VARCHAR(64),
+    last_checked TIMESTAMP,
+    PRIMARY KEY (level, key)
+);
+
+-- Leases held by downloaders on the series they are downloading, expired leases can be claimed again
+ALTER TABLE fieldsite.series
+ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(128),
+ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP;
+
+-- Number of instances of each series on disk after the last download attempt
+ALTER TABLE fieldsite.series
+ADD COLUMN IF NOT EXISTS instances_downloaded INTEGER;
+
+-- Manifest of every instance written by the downloader, used for validation without reading the files
+CREATE TABLE IF NOT EXISTS fieldsite.instances (
+    sopinstanceuid VARCHAR(64) PRIMARY KEY,
+    seriesinstanceuid VARCHAR(64),
+    size_bytes BIGINT,
+    number_of_frames INTEGER,
+    checksum VARCHAR(64),
+    date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    date_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS instances_seriesinstanceuid_idx ON fieldsite.instances (seriesinstanceuid);
+
+-- Every series archive written by the packaging stage with the checksum of the archive,
+-- the per-file checksums are in the <archive>.manifest.json written next to it
+CREATE TABLE IF NOT EXISTS fieldsite.archives (
+    archive VARCHAR(512) PRIMARY KEY,
+    patient_id VARCHAR(64),
+    series_name VARCHAR(255),
+    codec VARCHAR(16),
+    files INTEGER,
+    size_bytes BIGINT,
+    checksum VARCHAR(64),
+    date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    date_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS archives_checksum_idx ON fieldsite.archives (checksum);
+
+-- Columns written by 03_db_insert_series.py and 06_validate_slices.py
+ALTER TABLE fieldsite.series
+ADD COLUMN IF NOT EXISTS studyinstanceuid VARCHAR(64),
+ADD COLUMN IF NOT EXISTS comments_on_radiation_dose VARCHAR,
+ADD COLUMN IF NOT EXISTS convolution_kernel VARCHAR,
+ADD COLUMN IF NOT EXISTS protocol_name VARCHAR,
+ADD COLUMN IF NOT EXISTS slice_thickness VARCHAR,
+ADD COLUMN IF NOT EXISTS number_of_slices VARCHAR,
+ADD COLUMN IF NOT EXISTS spacing_between_slices VARCHAR,
+ADD COLUMN IF NOT EXISTS kvp VARCHAR,
+ADD COLUMN IF NOT EXISTS detector_configuration VARCHAR,
+ADD COLUMN IF NOT EXISTS aice VARCHAR,
+ADD COLUMN IF NOT EXISTS aidr_3d_estd VARCHAR,
+ADD COLUMN IF NOT EXISTS patient_comments VARCHAR,
+ADD COLUMN IF NOT EXISTS scan_options VARCHAR,
+ADD COLUMN IF NOT EXISTS vol VARCHAR,
+ADD COLUMN IF NOT EXISTS validation VARCHAR(16);
+
+-- 02_db_insert_studies.py merges studies on their StudyInstanceUID
+CREATE UNIQUE INDEX IF NOT EXISTS studies_studyinstanceuid_key ON fieldsite.studies (studyinstanceuid);
+
+-- Patients whose series have all been downloaded, used by 05_db_compress_dicoms.smk
+CREATE OR REPLACE VIEW fieldsite.patients_with_complete_downloads AS
+SELECT patient_id, total_series
+FROM fieldsite.series_download_status
+WHERE series_downloaded = total_series;
+
+-- Wake up idle downloaders (04_db_downloading_dicoms.py --daemon) once per statement that leaves series pending,
+-- e.g. the series merged by 03_db_insert_series.py or a series released after a failed download
+CREATE OR REPLACE FUNCTION fieldsite.notify_series_pending()
+RETURNS TRIGGER AS $$
+BEGIN
+   IF EXISTS (SELECT 1 FROM changed_series WHERE download_status IS NULL OR download_status = '') THEN
+      PERFORM pg_notify('series_pending', '');
+   END IF;
+   RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notify_series_pending_insert ON fieldsite.series;
+CREATE TRIGGER notify_series_pending_insert
+AFTER INSERT ON fieldsite.series
+REFERENCING NEW TABLE AS changed_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.notify_series_pending();
+
+DROP TRIGGER IF EXISTS notify_series_pending_update ON fieldsite.series;
+CREATE TRIGGER notify_series_pending_update
+AFTER UPDATE ON fieldsite.series
+REFERENCING NEW TABLE AS changed_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.notify_series_pending();
@@ -0,0 +1,16 @@
+-- Indexes for the queries the pipeline runs all the time, checked with automate/migrate.py --explain
+
+-- Series still to be claimed by a downloader (series_downloader.CLAIM_SERIES), including
+-- 'in_progress' series whose lease may have expired. Only the pending rows are indexed,
+-- so the index stays small however many series have been downloaded.
+CREATE INDEX IF NOT EXISTS series_pending_download_idx ON fieldsite.series (series_id)
+WHERE download_status IS NULL OR download_status = '' OR download_status = 'in_progress';
+
+-- Downloaded series that were not validated yet (06_validate_slices.py and the pipeline validate step)
+CREATE INDEX IF NOT EXISTS series_pending_validation_idx ON fieldsite.series (seriesinstanceuid)
+WHERE download_status = 'complete' AND (validation IS NULL OR validation = '');
+
+-- Join keys between patients, studies and series
+CREATE INDEX IF NOT EXISTS series_studyinstanceuid_idx ON fieldsite.series (studyinstanceuid);
+CREATE INDEX IF NOT EXISTS series_studyid_idx ON fieldsite.series (studyid);
+CREATE INDEX IF NOT EXISTS studies_patient_id_idx ON fieldsite.studies (patient_id);
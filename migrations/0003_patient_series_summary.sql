@@ -0,0 +1,147 @@
+-- Per patient series counts kept up to date by triggers on fieldsite.series, so finding the
+-- patients ready to package no longer joins and groups every series of the archive
+
+CREATE TABLE IF NOT EXISTS fieldsite.patient_series_summary (
+    patient_id VARCHAR PRIMARY KEY REFERENCES fieldsite.patients(patient_id) ON DELETE CASCADE,
+    total_series INTEGER NOT NULL DEFAULT 0,
+    series_downloaded INTEGER NOT NULL DEFAULT 0,
+    series_validated INTEGER NOT NULL DEFAULT 0,
+    last_change TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Only the patients whose series are all downloaded, the lookup of 05_db_compress_dicoms.py
+CREATE INDEX IF NOT EXISTS patient_series_summary_complete_idx ON fieldsite.patient_series_summary (patient_id)
+WHERE total_series > 0 AND series_downloaded = total_series;
+
+-- Add the counts of the series rows a statement inserted, minus those of the rows it removed.
+-- The rows are summed per patient first, so one statement updates each patient once, and
+-- patients are locked in patient_id order so concurrent downloaders cannot deadlock.
+-- Series deleted together with their study (ON DELETE CASCADE) can no longer be matched to a
+-- patient, run fieldsite.refresh_patient_series_summary() after deleting studies.
+CREATE OR REPLACE FUNCTION fieldsite.update_patient_series_summary()
+RETURNS TRIGGER AS $$
+BEGIN
+   IF TG_OP = 'INSERT' THEN
+      INSERT INTO fieldsite.patient_series_summary AS summary (patient_id, total_series, series_downloaded, series_validated)
+      SELECT st.patient_id, SUM(d.total), SUM(d.downloaded), SUM(d.validated)
+      FROM (
+         SELECT studyid, 1 AS total,
+                CASE WHEN download_status = 'complete' THEN 1 ELSE 0 END AS downloaded,
+                CASE WHEN validation = 'complete' THEN 1 ELSE 0 END AS validated
+         FROM new_series
+      ) d
+      JOIN fieldsite.studies st ON st.studyid = d.studyid
+      GROUP BY st.patient_id
+      HAVING SUM(d.total) <> 0 OR SUM(d.downloaded) <> 0 OR SUM(d.validated) <> 0
+      ORDER BY st.patient_id
+      ON CONFLICT (patient_id) DO UPDATE
+      SET total_series = summary.total_series + EXCLUDED.total_series,
+          series_downloaded = summary.series_downloaded + EXCLUDED.series_downloaded,
+          series_validated = summary.series_validated + EXCLUDED.series_validated,
+          last_change = CURRENT_TIMESTAMP;
+   ELSIF TG_OP = 'UPDATE' THEN
+      INSERT INTO fieldsite.patient_series_summary AS summary (patient_id, total_series, series_downloaded, series_validated)
+      SELECT st.patient_id, SUM(d.total), SUM(d.downloaded), SUM(d.validated)
+      FROM (
+         SELECT studyid, 1 AS total,
+                CASE WHEN download_status = 'complete' THEN 1 ELSE 0 END AS downloaded,
+                CASE WHEN validation = 'complete' THEN 1 ELSE 0 END AS validated
+         FROM new_series
+         UNION ALL
+         SELECT studyid, -1 AS total,
+                CASE WHEN download_status = 'complete' THEN -1 ELSE 0 END AS downloaded,
+                CASE WHEN validation = 'complete' THEN -1 ELSE 0 END AS validated
+         FROM old_series
+      ) d
+      JOIN fieldsite.studies st ON st.studyid = d.studyid
+      GROUP BY st.patient_id
+      HAVING SUM(d.total) <> 0 OR SUM(d.downloaded) <> 0 OR SUM(d.validated) <> 0
+      ORDER BY st.patient_id
+      ON CONFLICT (patient_id) DO UPDATE
+      SET total_series = summary.total_series + EXCLUDED.total_series,
+          series_downloaded = summary.series_downloaded + EXCLUDED.series_downloaded,
+          series_validated = summary.series_validated + EXCLUDED.series_validated,
+          last_change = CURRENT_TIMESTAMP;
+   ELSE
+      INSERT INTO fieldsite.patient_series_summary AS summary (patient_id, total_series, series_downloaded, series_validated)
+      SELECT st.patient_id, SUM(d.total), SUM(d.downloaded), SUM(d.validated)
+      FROM (
+         SELECT studyid, -1 AS total,
+                CASE WHEN download_status = 'complete' THEN -1 ELSE 0 END AS downloaded,
+                CASE WHEN validation = 'complete' THEN -1 ELSE 0 END AS validated
+         FROM old_series
+      ) d
+      JOIN fieldsite.studies st ON st.studyid = d.studyid
+      GROUP BY st.patient_id
+      HAVING SUM(d.total) <> 0 OR SUM(d.downloaded) <> 0 OR SUM(d.validated) <> 0
+      ORDER BY st.patient_id
+      ON CONFLICT (patient_id) DO UPDATE
+      SET total_series = summary.total_series + EXCLUDED.total_series,
+          series_downloaded = summary.series_downloaded + EXCLUDED.series_downloaded,
+          series_validated = summary.series_validated + EXCLUDED.series_validated,
+          last_change = CURRENT_TIMESTAMP;
+   END IF;
+   RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS update_patient_series_summary_insert ON fieldsite.series;
+CREATE TRIGGER update_patient_series_summary_insert
+AFTER INSERT ON fieldsite.series
+REFERENCING NEW TABLE AS new_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.update_patient_series_summary();
+
+DROP TRIGGER IF EXISTS update_patient_series_summary_update ON fieldsite.series;
+CREATE TRIGGER update_patient_series_summary_update
+AFTER UPDATE ON fieldsite.series
+REFERENCING OLD TABLE AS old_series NEW TABLE AS new_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.update_patient_series_summary();
+
+DROP TRIGGER IF EXISTS update_patient_series_summary_delete ON fieldsite.series;
+CREATE TRIGGER update_patient_series_summary_delete
+AFTER DELETE ON fieldsite.series
+REFERENCING OLD TABLE AS old_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.update_patient_series_summary();
+
+-- Recount every patient from scratch, e.g. after deleting studies or to check the counters
+CREATE OR REPLACE FUNCTION fieldsite.refresh_patient_series_summary()
+RETURNS VOID AS $$
+BEGIN
+   LOCK TABLE fieldsite.series IN SHARE MODE;
+   DELETE FROM fieldsite.patient_series_summary;
+   INSERT INTO fieldsite.patient_series_summary (patient_id, total_series, series_downloaded, series_validated)
+   SELECT st.patient_id,
+          COUNT(s.series_id),
+          COUNT(CASE WHEN s.download_status = 'complete' THEN 1 END),
+          COUNT(CASE WHEN s.validation = 'complete' THEN 1 END)
+   FROM fieldsite.studies st
+   JOIN fieldsite.series s ON st.studyid = s.studyid
+   GROUP BY st.patient_id;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT fieldsite.refresh_patient_series_summary();
+
+-- The views keep their columns but read the counters instead of grouping every series
+DROP VIEW IF EXISTS fieldsite.patients_with_complete_downloads;
+DROP VIEW IF EXISTS fieldsite.series_download_status;
+
+CREATE VIEW fieldsite.series_download_status AS
+SELECT
+    patient_id,
+    total_series,
+    series_downloaded,
+    ROUND(series_downloaded::numeric / total_series * 100, 2) AS percentage_downloaded,
+    series_validated,
+    last_change
+FROM fieldsite.patient_series_summary
+WHERE total_series > 0;
+
+-- Patients whose series have all been downloaded, answered from patient_series_summary_complete_idx
+CREATE VIEW fieldsite.patients_with_complete_downloads AS
+SELECT patient_id, total_series
+FROM fieldsite.patient_series_summary
+WHERE total_series > 0 AND series_downloaded = total_series;
@@ -0,0 +1,63 @@
+-- Lets 07_dicom_inventory_generator.py refresh the Parquet inventory from the rows changed since
+-- its last run instead of the whole archive
+
+-- Rows modified since the watermark
+CREATE INDEX IF NOT EXISTS patients_date_modified_idx ON fieldsite.patients (date_modified);
+CREATE INDEX IF NOT EXISTS studies_date_modified_idx ON fieldsite.studies (date_modified);
+CREATE INDEX IF NOT EXISTS series_date_modified_idx ON fieldsite.series (date_modified);
+
+-- Partition of the Parquet inventory every row was last written to, keyed by 's:<series_id>' for
+-- series, 't:<studyid>' for studies without series and 'p:<patient_id>' for patients without studies
+CREATE TABLE IF NOT EXISTS fieldsite.inventory_partitions (
+    row_key VARCHAR PRIMARY KEY,
+    study_year VARCHAR(16),
+    modality_key VARCHAR(64)
+);
+
+-- Inventory rows whose patient, study or series was deleted, removed from their partition by the next run
+CREATE TABLE IF NOT EXISTS fieldsite.inventory_deleted (
+    row_key VARCHAR,
+    deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS inventory_deleted_deleted_at_idx ON fieldsite.inventory_deleted (deleted_at);
+
+-- Log the deleted rows and touch their parent, whose rows change when its last child goes away
+CREATE OR REPLACE FUNCTION fieldsite.log_inventory_deletes()
+RETURNS TRIGGER AS $$
+BEGIN
+   IF TG_TABLE_NAME = 'series' THEN
+      INSERT INTO fieldsite.inventory_deleted (row_key) SELECT 's:' || series_id FROM deleted_rows;
+      UPDATE fieldsite.studies SET date_modified = CURRENT_TIMESTAMP
+      WHERE studyid IN (SELECT studyid FROM deleted_rows);
+   ELSIF TG_TABLE_NAME = 'studies' THEN
+      INSERT INTO fieldsite.inventory_deleted (row_key) SELECT 't:' || studyid FROM deleted_rows;
+      UPDATE fieldsite.patients SET date_modified = CURRENT_TIMESTAMP
+      WHERE patient_id IN (SELECT patient_id FROM deleted_rows);
+   ELSE
+      INSERT INTO fieldsite.inventory_deleted (row_key) SELECT 'p:' || patient_id FROM deleted_rows;
+   END IF;
+   RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS log_inventory_deletes ON fieldsite.patients;
+CREATE TRIGGER log_inventory_deletes
+AFTER DELETE ON fieldsite.patients
+REFERENCING OLD TABLE AS deleted_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.log_inventory_deletes();
+
+DROP TRIGGER IF EXISTS log_inventory_deletes ON fieldsite.studies;
+CREATE TRIGGER log_inventory_deletes
+AFTER DELETE ON fieldsite.studies
+REFERENCING OLD TABLE AS deleted_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.log_inventory_deletes();
+
+DROP TRIGGER IF EXISTS log_inventory_deletes ON fieldsite.series;
+CREATE TRIGGER log_inventory_deletes
+AFTER DELETE ON fieldsite.series
+REFERENCING OLD TABLE AS deleted_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.log_inventory_deletes();
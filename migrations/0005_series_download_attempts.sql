@@ -0,0 +1,6 @@
+-- Failed downloads of every series. Series released after a failed download are claimed again
+-- until download.max_attempts downloads failed, then they are marked 'failed' and left alone.
+-- Retry them with UPDATE fieldsite.series SET download_status = NULL, download_attempts = 0
+-- WHERE download_status = 'failed';
+ALTER TABLE fieldsite.series
+ADD COLUMN IF NOT EXISTS download_attempts INTEGER NOT NULL DEFAULT 0;
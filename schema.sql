@@ -1,3 +1,6 @@
+-- Schema of a new database. Existing databases are brought up to date with automate/migrate.py,
+-- which applies the versioned files in migrations/, so every change also needs a new migration.
+
 -- Create patients table
 CREATE TABLE fieldsite.patients (
     patient_id VARCHAR PRIMARY KEY,
@@ -65,20 +68,326 @@ BEFORE UPDATE ON fieldsite.series
 FOR EACH ROW
 EXECUTE FUNCTION update_modified_column();
 
+-- Shared PACS request budget drawn from by every script that talks to the PACS
+CREATE TABLE IF NOT EXISTS fieldsite.pacs_request_budget (
+    name VARCHAR(64) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    capacity DOUBLE PRECISION NOT NULL,
+    rate_per_second DOUBLE PRECISION NOT NULL,
+    max_rate_per_second DOUBLE PRECISION NOT NULL,
+    refilled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    penalized_at TIMESTAMP
+);
+
+-- Watermarks recording when each patient ('patient') and study ('study') was last queried on the PACS
+CREATE TABLE IF NOT EXISTS fieldsite.discovery_watermarks (
+    level VARCHAR(16),
+    key VARCHAR(64),
+    last_checked TIMESTAMP,
+    PRIMARY KEY (level, key)
+);
+
+-- Leases held by downloaders on the series they are downloading, expired leases can be claimed again
+ALTER TABLE fieldsite.series
+ADD COLUMN lease_owner VARCHAR(128),
+ADD COLUMN lease_expires TIMESTAMP;
+
+-- Number of instances of each series on disk after the last download attempt
+ALTER TABLE fieldsite.series
+ADD COLUMN instances_downloaded INTEGER;
+
+-- Failed downloads of every series, once download.max_attempts downloads failed the series is marked 'failed'
+ALTER TABLE fieldsite.series
+ADD COLUMN download_attempts INTEGER NOT NULL DEFAULT 0;
+
+-- Manifest of every instance written by the downloader, used for validation without reading the files
+CREATE TABLE IF NOT EXISTS fieldsite.instances (
+    sopinstanceuid VARCHAR(64) PRIMARY KEY,
+    seriesinstanceuid VARCHAR(64),
+    size_bytes BIGINT,
+    number_of_frames INTEGER,
+    checksum VARCHAR(64),
+    date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    date_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS instances_seriesinstanceuid_idx ON fieldsite.instances (seriesinstanceuid);
+
+-- Every series archive written by the packaging stage with the checksum of the archive,
+-- the per-file checksums are in the <archive>.manifest.json written next to it
+CREATE TABLE IF NOT EXISTS fieldsite.archives (
+    archive VARCHAR(512) PRIMARY KEY,
+    patient_id VARCHAR(64),
+    series_name VARCHAR(255),
+    codec VARCHAR(16),
+    files INTEGER,
+    size_bytes BIGINT,
+    checksum VARCHAR(64),
+    date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    date_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS archives_checksum_idx ON fieldsite.archives (checksum);
+
+-- Columns written by 03_db_insert_series.py and 06_validate_slices.py
+ALTER TABLE fieldsite.series
+ADD COLUMN IF NOT EXISTS studyinstanceuid VARCHAR(64),
+ADD COLUMN IF NOT EXISTS comments_on_radiation_dose VARCHAR,
+ADD COLUMN IF NOT EXISTS convolution_kernel VARCHAR,
+ADD COLUMN IF NOT EXISTS protocol_name VARCHAR,
+ADD COLUMN IF NOT EXISTS slice_thickness VARCHAR,
+ADD COLUMN IF NOT EXISTS number_of_slices VARCHAR,
+ADD COLUMN IF NOT EXISTS spacing_between_slices VARCHAR,
+ADD COLUMN IF NOT EXISTS kvp VARCHAR,
+ADD COLUMN IF NOT EXISTS detector_configuration VARCHAR,
+ADD COLUMN IF NOT EXISTS aice VARCHAR,
+ADD COLUMN IF NOT EXISTS aidr_3d_estd VARCHAR,
+ADD COLUMN IF NOT EXISTS patient_comments VARCHAR,
+ADD COLUMN IF NOT EXISTS scan_options VARCHAR,
+ADD COLUMN IF NOT EXISTS vol VARCHAR,
+ADD COLUMN IF NOT EXISTS validation VARCHAR(16);
+
+-- 02_db_insert_studies.py merges studies on their StudyInstanceUID
+ALTER TABLE fieldsite.studies
+ADD CONSTRAINT studies_studyinstanceuid_key UNIQUE (studyinstanceuid);
+
+-- Wake up idle downloaders (04_db_downloading_dicoms.py --daemon) once per statement that leaves series pending,
+-- e.g. the series merged by 03_db_insert_series.py or a series released after a failed download
+CREATE OR REPLACE FUNCTION fieldsite.notify_series_pending()
+RETURNS TRIGGER AS $$
+BEGIN
+   IF EXISTS (SELECT 1 FROM changed_series WHERE download_status IS NULL OR download_status = '') THEN
+      PERFORM pg_notify('series_pending', '');
+   END IF;
+   RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_series_pending_insert
+AFTER INSERT ON fieldsite.series
+REFERENCING NEW TABLE AS changed_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.notify_series_pending();
+
+CREATE TRIGGER notify_series_pending_update
+AFTER UPDATE ON fieldsite.series
+REFERENCING NEW TABLE AS changed_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.notify_series_pending();
+
+-- Partial indexes for the series still to be downloaded or validated, and the join keys
+CREATE INDEX IF NOT EXISTS series_pending_download_idx ON fieldsite.series (series_id)
+WHERE download_status IS NULL OR download_status = '' OR download_status = 'in_progress';
+
+CREATE INDEX IF NOT EXISTS series_pending_validation_idx ON fieldsite.series (seriesinstanceuid)
+WHERE download_status = 'complete' AND (validation IS NULL OR validation = '');
+
+CREATE INDEX IF NOT EXISTS series_studyinstanceuid_idx ON fieldsite.series (studyinstanceuid);
+CREATE INDEX IF NOT EXISTS series_studyid_idx ON fieldsite.series (studyid);
+CREATE INDEX IF NOT EXISTS studies_patient_id_idx ON fieldsite.studies (patient_id);
+
+-- Per patient series counts kept up to date by triggers on fieldsite.series, so finding the
+-- patients ready to package no longer joins and groups every series of the archive
+
+CREATE TABLE IF NOT EXISTS fieldsite.patient_series_summary (
+    patient_id VARCHAR PRIMARY KEY REFERENCES fieldsite.patients(patient_id) ON DELETE CASCADE,
+    total_series INTEGER NOT NULL DEFAULT 0,
+    series_downloaded INTEGER NOT NULL DEFAULT 0,
+    series_validated INTEGER NOT NULL DEFAULT 0,
+    last_change TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Only the patients whose series are all downloaded, the lookup of 05_db_compress_dicoms.py
+CREATE INDEX IF NOT EXISTS patient_series_summary_complete_idx ON fieldsite.patient_series_summary (patient_id)
+WHERE total_series > 0 AND series_downloaded = total_series;
+
+-- Add the counts of the series rows a statement inserted, minus those of the rows it removed.
+-- The rows are summed per patient first, so one statement updates each patient once, and
+-- patients are locked in patient_id order so concurrent downloaders cannot deadlock.
+-- Series deleted together with their study (ON DELETE CASCADE) can no longer be matched to a
+-- patient, run fieldsite.refresh_patient_series_summary() after deleting studies.
+CREATE OR REPLACE FUNCTION fieldsite.update_patient_series_summary()
+RETURNS TRIGGER AS $$
+BEGIN
+   IF TG_OP = 'INSERT' THEN
+      INSERT INTO fieldsite.patient_series_summary AS summary (patient_id, total_series, series_downloaded, series_validated)
+      SELECT st.patient_id, SUM(d.total), SUM(d.downloaded), SUM(d.validated)
+      FROM (
+         SELECT studyid, 1 AS total,
+                CASE WHEN download_status = 'complete' THEN 1 ELSE 0 END AS downloaded,
+                CASE WHEN validation = 'complete' THEN 1 ELSE 0 END AS validated
+         FROM new_series
+      ) d
+      JOIN fieldsite.studies st ON st.studyid = d.studyid
+      GROUP BY st.patient_id
+      HAVING SUM(d.total) <> 0 OR SUM(d.downloaded) <> 0 OR SUM(d.validated) <> 0
+      ORDER BY st.patient_id
+      ON CONFLICT (patient_id) DO UPDATE
+      SET total_series = summary.total_series + EXCLUDED.total_series,
+          series_downloaded = summary.series_downloaded + EXCLUDED.series_downloaded,
+          series_validated = summary.series_validated + EXCLUDED.series_validated,
+          last_change = CURRENT_TIMESTAMP;
+   ELSIF TG_OP = 'UPDATE' THEN
+      INSERT INTO fieldsite.patient_series_summary AS summary (patient_id, total_series, series_downloaded, series_validated)
+      SELECT st.patient_id, SUM(d.total), SUM(d.downloaded), SUM(d.validated)
+      FROM (
+         SELECT studyid, 1 AS total,
+                CASE WHEN download_status = 'complete' THEN 1 ELSE 0 END AS downloaded,
+                CASE WHEN validation = 'complete' THEN 1 ELSE 0 END AS validated
+         FROM new_series
+         UNION ALL
+         SELECT studyid, -1 AS total,
+                CASE WHEN download_status = 'complete' THEN -1 ELSE 0 END AS downloaded,
+                CASE WHEN validation = 'complete' THEN -1 ELSE 0 END AS validated
+         FROM old_series
+      ) d
+      JOIN fieldsite.studies st ON st.studyid = d.studyid
+      GROUP BY st.patient_id
+      HAVING SUM(d.total) <> 0 OR SUM(d.downloaded) <> 0 OR SUM(d.validated) <> 0
+      ORDER BY st.patient_id
+      ON CONFLICT (patient_id) DO UPDATE
+      SET total_series = summary.total_series + EXCLUDED.total_series,
+          series_downloaded = summary.series_downloaded + EXCLUDED.series_downloaded,
+          series_validated = summary.series_validated + EXCLUDED.series_validated,
+          last_change = CURRENT_TIMESTAMP;
+   ELSE
+      INSERT INTO fieldsite.patient_series_summary AS summary (patient_id, total_series, series_downloaded, series_validated)
+      SELECT st.patient_id, SUM(d.total), SUM(d.downloaded), SUM(d.validated)
+      FROM (
+         SELECT studyid, -1 AS total,
+                CASE WHEN download_status = 'complete' THEN -1 ELSE 0 END AS downloaded,
+                CASE WHEN validation = 'complete' THEN -1 ELSE 0 END AS validated
+         FROM old_series
+      ) d
+      JOIN fieldsite.studies st ON st.studyid = d.studyid
+      GROUP BY st.patient_id
+      HAVING SUM(d.total) <> 0 OR SUM(d.downloaded) <> 0 OR SUM(d.validated) <> 0
+      ORDER BY st.patient_id
+      ON CONFLICT (patient_id) DO UPDATE
+      SET total_series = summary.total_series + EXCLUDED.total_series,
+          series_downloaded = summary.series_downloaded + EXCLUDED.series_downloaded,
+          series_validated = summary.series_validated + EXCLUDED.series_validated,
+          last_change = CURRENT_TIMESTAMP;
+   END IF;
+   RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS update_patient_series_summary_insert ON fieldsite.series;
+CREATE TRIGGER update_patient_series_summary_insert
+AFTER INSERT ON fieldsite.series
+REFERENCING NEW TABLE AS new_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.update_patient_series_summary();
+
+DROP TRIGGER IF EXISTS update_patient_series_summary_update ON fieldsite.series;
+CREATE TRIGGER update_patient_series_summary_update
+AFTER UPDATE ON fieldsite.series
+REFERENCING OLD TABLE AS old_series NEW TABLE AS new_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.update_patient_series_summary();
+
+DROP TRIGGER IF EXISTS update_patient_series_summary_delete ON fieldsite.series;
+CREATE TRIGGER update_patient_series_summary_delete
+AFTER DELETE ON fieldsite.series
+REFERENCING OLD TABLE AS old_series
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.update_patient_series_summary();
+
+-- Recount every patient from scratch, e.g. after deleting studies or to check the counters
+CREATE OR REPLACE FUNCTION fieldsite.refresh_patient_series_summary()
+RETURNS VOID AS $$
+BEGIN
+   LOCK TABLE fieldsite.series IN SHARE MODE;
+   DELETE FROM fieldsite.patient_series_summary;
+   INSERT INTO fieldsite.patient_series_summary (patient_id, total_series, series_downloaded, series_validated)
+   SELECT st.patient_id,
+          COUNT(s.series_id),
+          COUNT(CASE WHEN s.download_status = 'complete' THEN 1 END),
+          COUNT(CASE WHEN s.validation = 'complete' THEN 1 END)
+   FROM fieldsite.studies st
+   JOIN fieldsite.series s ON st.studyid = s.studyid
+   GROUP BY st.patient_id;
+END;
+$$ LANGUAGE plpgsql;
+
 -- Create view for determining if all downloads are complete for a patient
 CREATE VIEW fieldsite.series_download_status AS
-SELECT 
-    p.patient_id,
-    COUNT(s.series_id) AS total_series,
-    COUNT(CASE WHEN s.download_status = 'complete' THEN 1 END) AS series_downloaded,
-    ROUND(
-        COUNT(CASE WHEN s.download_status = 'complete' THEN 1 END)::numeric / COUNT(s.series_id) * 100, 2
-    ) AS percentage_downloaded
-FROM 
-    fieldsite.patients p
-JOIN 
-    fieldsite.studies st ON p.patient_id = st.patient_id
-JOIN 
-    fieldsite.series s ON st.studyid = s.studyid
-GROUP BY 
-    p.patient_id;
+SELECT
+    patient_id,
+    total_series,
+    series_downloaded,
+    ROUND(series_downloaded::numeric / total_series * 100, 2) AS percentage_downloaded,
+    series_validated,
+    last_change
+FROM fieldsite.patient_series_summary
+WHERE total_series > 0;
+
+-- Patients whose series have all been downloaded, answered from patient_series_summary_complete_idx
+CREATE VIEW fieldsite.patients_with_complete_downloads AS
+SELECT patient_id, total_series
+FROM fieldsite.patient_series_summary
+WHERE total_series > 0 AND series_downloaded = total_series;
+
+-- Tables and triggers that let 07_dicom_inventory_generator.py refresh the Parquet inventory
+-- from the rows changed since its last run instead of the whole archive
+-- Rows modified since the watermark
+CREATE INDEX IF NOT EXISTS patients_date_modified_idx ON fieldsite.patients (date_modified);
+CREATE INDEX IF NOT EXISTS studies_date_modified_idx ON fieldsite.studies (date_modified);
+CREATE INDEX IF NOT EXISTS series_date_modified_idx ON fieldsite.series (date_modified);
+
+-- Partition of the Parquet inventory every row was last written to, keyed by 's:<series_id>' for
+-- series, 't:<studyid>' for studies without series and 'p:<patient_id>' for patients without studies
+CREATE TABLE IF NOT EXISTS fieldsite.inventory_partitions (
+    row_key VARCHAR PRIMARY KEY,
+    study_year VARCHAR(16),
+    modality_key VARCHAR(64)
+);
+
+-- Inventory rows whose patient, study or series was deleted, removed from their partition by the next run
+CREATE TABLE IF NOT EXISTS fieldsite.inventory_deleted (
+    row_key VARCHAR,
+    deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS inventory_deleted_deleted_at_idx ON fieldsite.inventory_deleted (deleted_at);
+
+-- Log the deleted rows and touch their parent, whose rows change when its last child goes away
+CREATE OR REPLACE FUNCTION fieldsite.log_inventory_deletes()
+RETURNS TRIGGER AS $$
+BEGIN
+   IF TG_TABLE_NAME = 'series' THEN
+      INSERT INTO fieldsite.inventory_deleted (row_key) SELECT 's:' || series_id FROM deleted_rows;
+      UPDATE fieldsite.studies SET date_modified = CURRENT_TIMESTAMP
+      WHERE studyid IN (SELECT studyid FROM deleted_rows);
+   ELSIF TG_TABLE_NAME = 'studies' THEN
+      INSERT INTO fieldsite.inventory_deleted (row_key) SELECT 't:' || studyid FROM deleted_rows;
+      UPDATE fieldsite.patients SET date_modified = CURRENT_TIMESTAMP
+      WHERE patient_id IN (SELECT patient_id FROM deleted_rows);
+   ELSE
+      INSERT INTO fieldsite.inventory_deleted (row_key) SELECT 'p:' || patient_id FROM deleted_rows;
+   END IF;
+   RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS log_inventory_deletes ON fieldsite.patients;
+CREATE TRIGGER log_inventory_deletes
+AFTER DELETE ON fieldsite.patients
+REFERENCING OLD TABLE AS deleted_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.log_inventory_deletes();
+
+DROP TRIGGER IF EXISTS log_inventory_deletes ON fieldsite.studies;
+CREATE TRIGGER log_inventory_deletes
+AFTER DELETE ON fieldsite.studies
+REFERENCING OLD TABLE AS deleted_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.log_inventory_deletes();
+
+DROP TRIGGER IF EXISTS log_inventory_deletes ON fieldsite.series;
+CREATE TRIGGER log_inventory_deletes
+AFTER DELETE ON fieldsite.series
+REFERENCING OLD TABLE AS deleted_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION fieldsite.log_inventory_deletes();